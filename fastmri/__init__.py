@@ -27,4 +27,8 @@ from .math import (
     tensor_to_complex_np,
 )
 from .utils import convert_fnames_to_v2, save_reconstructions
-from .utils_qalas import save_reconstructions_qalas, save_reconstructions_qalas_forward
+from .utils_qalas import (
+    ReconstructionWriterQALAS,
+    save_reconstructions_qalas,
+    save_reconstructions_qalas_forward,
+)
@@ -1,5 +1,16 @@
 
 from .mri_data import SliceDataset, CombinedSliceDataset
-from .mri_data_qalas import SliceDatasetQALAS, CombinedSliceDatasetQALAS
+from .mri_data_qalas import (
+    SliceDatasetQALAS,
+    CombinedSliceDatasetQALAS,
+    FileCacheQALAS,
+    GroupedSliceDatasetQALAS,
+    collate_grouped_qalas,
+    collate_qalas,
+    find_sessions_qalas,
+    session_name_qalas,
+)
 from .volume_sampler import VolumeSampler
 from .volume_sampler_qalas import VolumeSamplerQALAS
+from .sequence_params_qalas import SEQUENCE_PARAM_FIELDS, SequenceParams
+from .synthetic_qalas import SyntheticSliceDatasetQALAS, generate_corpus_qalas
@@ -5,11 +5,13 @@ This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
 
+import bisect
 import logging
 import os
 import pickle
 import random
 import xml.etree.ElementTree as etree
+from collections import OrderedDict
 from pathlib import Path
 from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
 from warnings import warn
@@ -19,6 +21,67 @@ import numpy as np
 import torch
 import yaml
 
+from .transforms_qalas import QALASSample, QALASVolume
+
+# datasets that are often constant, e.g. the placeholder maps and the fully
+# sampled masks written by ssl_qalas_save_h5.m without reference maps
+CONSTANT_CANDIDATES_QALAS = (
+    "reconstruction_t1", "reconstruction_t2", "reconstruction_pd", "reconstruction_ie", "reconstruction_b1",
+    "mask_acq1", "mask_acq2", "mask_acq3", "mask_acq4", "mask_acq5",
+)
+
+
+def find_constant_datasets(hf: h5py.File, keys: Sequence[str] = CONSTANT_CANDIDATES_QALAS) -> Dict[str, float]:
+    """
+    Find the datasets of a QALAS file that hold a single value.
+
+    A dataset is constant if it has a "constant_value" attribute (see
+    ssl_qalas_save_h5.m), or else if all its slices hold the same value. The
+    scan reads one slice at a time and stops at the first slice that differs,
+    which is usually the first one for real maps.
+
+    Args:
+        hf: Open h5 file.
+        keys: Datasets to check.
+
+    Returns:
+        A dict mapping the constant datasets to their value.
+    """
+    constants = {}
+    for key in keys:
+        if key not in hf:
+            continue
+        dataset = hf[key]
+        if "constant_value" in dataset.attrs:
+            constants[key] = float(np.ravel(dataset.attrs["constant_value"])[0])
+            continue
+
+        first = None
+        for i in range(dataset.shape[0]):
+            data = dataset[i]
+            if first is None:
+                first = np.ravel(data)[0]
+            if np.any(data != first):
+                break
+        else:
+            if first is not None:
+                constants[key] = float(first)
+
+    return constants
+
+
+def _read_dataset(hf: h5py.File, key: str, dataslice: Optional[int], constants: Dict[str, float]) -> Optional[np.ndarray]:
+    """
+    A slice (or the whole of a per-file dataset if `dataslice` is None), or
+    a 0-d array for a constant dataset, which the transform broadcasts.
+    """
+    if key in constants:
+        return np.array(constants[key], dtype=np.float32)
+    if key not in hf:
+        return None
+
+    return hf[key][dataslice] if dataslice is not None else np.asarray(hf[key])
+
 
 def et_query(
     root: etree.Element,
@@ -98,6 +161,133 @@ def fetch_dir(
     return Path(data_dir)
 
 
+def find_sessions_qalas(
+    data_path: Union[str, Path, os.PathLike],
+    challenge: str = "multicoil",
+    sessions_file: Optional[Union[str, Path, os.PathLike]] = None,
+) -> List[Path]:
+    """
+    Find the session directories of a multi-session data directory.
+
+    A session directory holds the `{challenge}_train` and `{challenge}_val`
+    splits of one QALAS run, as written by `ssl_qalas_save_h5.m` under
+    `matlab/h5_data`.
+
+    Args:
+        data_path: Directory with one subdirectory per session.
+        challenge: "singlecoil" or "multicoil".
+        sessions_file: Optional; Text file listing the sessions to use, one
+            directory per line, absolute or relative to data_path. Defaults
+            to every session under data_path.
+
+    Returns:
+        The sorted session directories.
+    """
+    data_path = Path(data_path)
+    if sessions_file is None:
+        sessions = [path for path in data_path.iterdir() if (path / f"{challenge}_train").is_dir()]
+    else:
+        with open(sessions_file, "r") as f:
+            sessions = [data_path / line.strip() for line in f if line.strip()]
+        missing = [str(path) for path in sessions if not (path / f"{challenge}_train").is_dir()]
+        if missing:
+            raise ValueError(f"Sessions without a {challenge}_train split: {', '.join(missing)}")
+
+    return sorted(sessions)
+
+
+def session_name_qalas(session: Union[str, Path, os.PathLike], data_path: Union[str, Path, os.PathLike]) -> str:
+    """
+    Name of a session directory, unique among the sessions of a data
+    directory.
+
+    Sessions listed in a sessions file may be nested and share their last
+    path component (e.g. "siteA/sub01/h5_data" and "siteB/sub01/h5_data"),
+    so they are named by their path relative to data_path. Sessions outside
+    data_path are named by their absolute path without its root.
+
+    Args:
+        session: Session directory, as returned by `find_sessions_qalas`.
+        data_path: Directory the sessions were found in.
+
+    Returns:
+        The relative path of the session, with "/" separators.
+    """
+    session = Path(session).resolve()
+    try:
+        return session.relative_to(Path(data_path).resolve()).as_posix()
+    except ValueError:
+        return session.relative_to(session.anchor).as_posix()
+
+
+class FileCacheQALAS:
+    """
+    Per-process HDF5 handles and per-file static content of QALAS files.
+
+    Each DataLoader worker lazily opens and keeps its own handles, which are
+    reopened after a fork. The sampling masks and the attributes, which are
+    the same for all slices of a file, are read once per file. Both are kept
+    in least-recently-used order and bounded in size.
+    """
+
+    def __init__(self, max_open_files: int = 16, static_cache_size: int = 64):
+        """
+        Args:
+            max_open_files: Maximum number of open HDF5 files per process.
+            static_cache_size: Maximum number of files whose masks and
+                attributes are kept in memory.
+        """
+        self.max_open_files = max_open_files
+        self.static_cache_size = static_cache_size
+        self._handles: "OrderedDict[Path, h5py.File]" = OrderedDict()
+        self._handles_pid = os.getpid()
+        self._static: "OrderedDict[Path, Dict[str, object]]" = OrderedDict()
+
+    def __getstate__(self):
+        # open HDF5 handles cannot be pickled (e.g. for spawned workers)
+        state = self.__dict__.copy()
+        state["_handles"] = OrderedDict()
+        return state
+
+    def handle(self, fname: Path) -> h5py.File:
+        # HDF5 handles are not fork-safe, so a forked worker drops the handles
+        # it inherited and opens its own
+        if self._handles_pid != os.getpid():
+            self._handles = OrderedDict()
+            self._handles_pid = os.getpid()
+
+        if fname in self._handles:
+            self._handles.move_to_end(fname)
+        else:
+            self._handles[fname] = h5py.File(fname, "r")
+            while len(self._handles) > self.max_open_files:
+                self._handles.popitem(last=False)[1].close()
+
+        return self._handles[fname]
+
+    def static(self, fname: Path, hf: h5py.File, metadata: Dict) -> Dict[str, object]:
+        if fname in self._static:
+            self._static.move_to_end(fname)
+            return self._static[fname]
+
+        attrs = dict(hf.attrs)
+        attrs.update(metadata)
+        constants = metadata.get("constants", {})
+        static = {
+            "mask_acq1": _read_dataset(hf, "mask_acq1", None, constants),
+            "mask_acq2": _read_dataset(hf, "mask_acq2", None, constants),
+            "mask_acq3": _read_dataset(hf, "mask_acq3", None, constants),
+            "mask_acq4": _read_dataset(hf, "mask_acq4", None, constants),
+            "mask_acq5": _read_dataset(hf, "mask_acq5", None, constants),
+            "attrs": attrs,
+        }
+        self._static[fname] = static
+        while len(self._static) > self.static_cache_size:
+            self._static.popitem(last=False)
+
+        return static
+
+
 class CombinedSliceDatasetQALAS(torch.utils.data.Dataset):
     """
     A container for combining slice datasets.
@@ -113,6 +303,10 @@ class CombinedSliceDatasetQALAS(torch.utils.data.Dataset):
         use_dataset_cache: bool = False,
         dataset_cache_file: Union[str, Path, os.PathLike] = "dataset_cache.pkl",
         num_cols: Optional[Tuple[int]] = None,
+        preload: bool = False,
+        max_open_files: int = 16,
+        static_cache_size: int = 64,
+        name_prefixes: Optional[Sequence[str]] = None,
     ):
         """
         Args:
@@ -140,6 +334,15 @@ class CombinedSliceDatasetQALAS(torch.utils.data.Dataset):
                 information for faster load times.
             num_cols: Optional; If provided, only slices with the desired
                 number of columns will be considered.
+            preload: Whether to read all volumes into shared memory at
+                construction (see SliceDatasetQALAS).
+            max_open_files: Maximum number of HDF5 files each DataLoader
+                worker keeps open, over all datasets.
+            static_cache_size: Maximum number of files whose sampling masks
+                and attributes are kept in memory, over all datasets.
+            name_prefixes: Optional; A sequence of prefixes of the file names
+                of every dataset (see SliceDatasetQALAS), e.g. the session of
+                each root, so that files of the same name stay apart.
         """
         if sample_rates is not None and volume_sample_rates is not None:
             raise ValueError(
@@ -151,17 +354,21 @@ class CombinedSliceDatasetQALAS(torch.utils.data.Dataset):
             sample_rates = [None] * len(roots)
         if volume_sample_rates is None:
             volume_sample_rates = [None] * len(roots)
+        if name_prefixes is None:
+            name_prefixes = [""] * len(roots)
         if not (
             len(roots)
             == len(transforms)
             == len(challenges)
             == len(sample_rates)
             == len(volume_sample_rates)
+            == len(name_prefixes)
         ):
             raise ValueError(
-                "Lengths of roots, transforms, challenges, sample_rates do not match"
+                "Lengths of roots, transforms, challenges, sample_rates, name_prefixes do not match"
             )
 
+        self.file_cache = FileCacheQALAS(max_open_files, static_cache_size)
         self.datasets = []
         self.examples: List[Tuple[Path, int, Dict[str, object]]] = []
         for i in range(len(roots)):
@@ -175,20 +382,115 @@ class CombinedSliceDatasetQALAS(torch.utils.data.Dataset):
                     use_dataset_cache=use_dataset_cache,
                     dataset_cache_file=dataset_cache_file,
                     num_cols=num_cols,
+                    preload=preload,
+                    file_cache=self.file_cache,
+                    name_prefix=name_prefixes[i],
                 )
             )
 
-            self.examples = self.examples + self.datasets[-1].examples
+            self.examples.extend(self.datasets[-1].examples)
+
+        # index of the first example of every dataset, to find the dataset
+        # of an example in O(log(len(datasets)))
+        self.offsets = [0]
+        for dataset in self.datasets:
+            self.offsets.append(self.offsets[-1] + len(dataset))
 
     def __len__(self):
-        return sum(len(dataset) for dataset in self.datasets)
+        return self.offsets[-1]
 
     def __getitem__(self, i):
-        for dataset in self.datasets:
-            if i < len(dataset):
-                return dataset[i]
+        if i < 0:
+            i = i + len(self)
+        d = bisect.bisect_right(self.offsets, i) - 1
+        return self.datasets[d][i - self.offsets[d]]
+
+
+class GroupedSliceDatasetQALAS(torch.utils.data.Dataset):
+    """
+    Slices of several datasets served side by side, one dataset per mapping
+    network of a grouped model (see `QALAS_MAP`).
+
+    Item i holds the i-th slice of every dataset, the shorter datasets
+    wrapping around, so that every batch has the same number of slices of
+    each dataset. Use `collate_grouped_qalas` to concatenate them.
+    """
+
+    def __init__(
+        self,
+        groups: Sequence[Union["SliceDatasetQALAS", CombinedSliceDatasetQALAS]],
+    ):
+        """
+        Args:
+            groups: The dataset of every mapping network, in model order.
+        """
+        empty = [i for i, group in enumerate(groups) if len(group) == 0]
+        if empty:
+            raise ValueError(f"Grouped datasets {empty} have no slices.")
+
+        self.groups = list(groups)
+        # the slice datasets of all groups, e.g. to seed their transforms
+        self.datasets = []
+        for group in self.groups:
+            if isinstance(group, CombinedSliceDatasetQALAS):
+                self.datasets.extend(group.datasets)
             else:
-                i = i - len(dataset)
+                self.datasets.append(group)
+
+    def __len__(self):
+        return max(len(group) for group in self.groups)
+
+    def __getitem__(self, i):
+        return tuple(group[i % len(group)] for group in self.groups)
+
+
+def _stack(tensors: Sequence[torch.Tensor]) -> torch.Tensor:
+    first = tensors[0]
+    out = first.new_empty((len(tensors),) + first.shape)
+    if torch.utils.data.get_worker_info() is not None:
+        # like default_collate, write the batch of a worker in shared memory,
+        # so that it is not copied again to the main process
+        out.share_memory_()
+
+    return torch.stack(tensors, out=out)
+
+
+def collate_qalas(batch: Sequence[QALASSample]) -> QALASSample:
+    """
+    Collate QALASSamples in one batch.
+
+    Every tensor field of the batch is written into one preallocated tensor,
+    without the recursive walk of `default_collate`.
+    """
+    volume = QALASVolume(*[_stack(field) for field in zip(*[sample.volume for sample in batch])])
+
+    return QALASSample(
+        images=_stack([sample.images for sample in batch]),
+        masks=_stack([sample.masks for sample in batch]),
+        mask_brain=_stack([sample.mask_brain for sample in batch]),
+        b1=_stack([sample.b1 for sample in batch]),
+        ie=_stack([sample.ie for sample in batch]),
+        targets=_stack([sample.targets for sample in batch]),
+        fname=[sample.fname for sample in batch],
+        slice_num=torch.tensor([sample.slice_num for sample in batch]),
+        volume=volume,
+    )
+
+
+def collate_grouped_qalas(batch):
+    """
+    Collate the items of a `GroupedSliceDatasetQALAS` in one batch.
+
+    The slices of every group are concatenated in group order, i.e. a batch
+    of B items of K groups has K * B samples, the first B of group 0. All
+    groups must have the same image size.
+    """
+    samples = [item[k] for k in range(len(batch[0])) for item in batch]
+    shapes = {tuple(sample.images.shape[-2:]) for sample in samples}
+    if len(shapes) > 1:
+        raise ValueError(f"Grouped datasets have different image sizes {sorted(shapes)}.")
+
+    return collate_qalas(samples)
 
 
 class SliceDatasetQALAS(torch.utils.data.Dataset):
@@ -206,6 +508,11 @@ class SliceDatasetQALAS(torch.utils.data.Dataset):
         volume_sample_rate: Optional[float] = None,
         dataset_cache_file: Union[str, Path, os.PathLike] = "dataset_cache.pkl",
         num_cols: Optional[Tuple[int]] = None,
+        preload: bool = False,
+        max_open_files: int = 16,
+        static_cache_size: int = 64,
+        file_cache: Optional["FileCacheQALAS"] = None,
+        name_prefix: str = "",
     ):
         """
         Args:
@@ -230,6 +537,20 @@ class SliceDatasetQALAS(torch.utils.data.Dataset):
                 information for faster load times.
             num_cols: Optional; If provided, only slices with the desired
                 number of columns will be considered.
+            preload: Whether to read every volume once at construction into
+                contiguous tensors in shared memory. Slices are then served as
+                zero-copy views without any HDF5 I/O, so `num_workers=0` (or
+                forked workers sharing the tensors) can be used.
+            max_open_files: Maximum number of HDF5 files each DataLoader
+                worker keeps open between items.
+            static_cache_size: Maximum number of files whose sampling masks
+                and attributes are kept in memory.
+            file_cache: Optional; A FileCacheQALAS shared with other datasets.
+                Overrides max_open_files and static_cache_size.
+            name_prefix: Prefix of the file names passed to the transform,
+                e.g. "sub01ses01run1/" for the files of one session. The file
+                names identify volumes in the B1 terms cache and in the
+                validation metrics.
         """
         if challenge not in ("singlecoil", "multicoil"):
             raise ValueError('challenge should be either "singlecoil" or "multicoil"')
@@ -242,6 +563,7 @@ class SliceDatasetQALAS(torch.utils.data.Dataset):
         self.dataset_cache_file = Path(dataset_cache_file)
 
         self.transform = transform
+        self.name_prefix = name_prefix
         self.recons_key = (
             "reconstruction_esc" if challenge == "singlecoil" else "reconstruction_rss"
         )
@@ -301,6 +623,47 @@ class SliceDatasetQALAS(torch.utils.data.Dataset):
                 if ex[2]["encoding_size"][1] in num_cols  # type: ignore
             ]
 
+        if file_cache is None:
+            file_cache = FileCacheQALAS(max_open_files, static_cache_size)
+        self.file_cache = file_cache
+
+        self.volumes: Dict[Path, Dict[str, object]] = {}
+        if preload:
+            self.preload_volumes([example[0] for example in self.examples])
+
+    def preload_volumes(self, fnames: Sequence[Path]):
+        """
+        Read the given volumes into shared memory (see `preload`), and
+        release the volumes preloaded before.
+
+        Args:
+            fnames: Files of the volumes, as in `examples`.
+        """
+        file_metadata = {example[0]: example[2] for example in self.examples}
+        self.volumes = {}
+        for fname in sorted(set(fnames)):
+            self.volumes[fname] = self._preload_volume(fname, file_metadata[fname].get("constants", {}))
+
+    @staticmethod
+    def _preload_volume(fname, constants: Dict[str, float]) -> Dict[str, object]:
+        def to_shared(data) -> torch.Tensor:
+            return torch.from_numpy(np.ascontiguousarray(data[()])).share_memory_()
+
+        # constant datasets are not loaded
+        volume: Dict[str, object] = {"constants": constants}
+        with h5py.File(fname, "r") as hf:
+            for key in (
+                "kspace_acq1", "kspace_acq2", "kspace_acq3", "kspace_acq4", "kspace_acq5",
+                "mask_acq1", "mask_acq2", "mask_acq3", "mask_acq4", "mask_acq5",
+                "mask_brain", "reconstruction_b1", "reconstruction_ie",
+                "reconstruction_t1", "reconstruction_t2", "reconstruction_pd",
+            ):
+                volume[key] = to_shared(hf[key]) if key in hf and key not in constants else None
+
+            volume["attrs"] = dict(hf.attrs)
+
+        return volume
+
     def _retrieve_metadata(self, fname):
         with h5py.File(fname, "r") as hf:
             et_root = etree.fromstring(hf["ismrmrd_header"][()])
@@ -326,12 +689,14 @@ class SliceDatasetQALAS(torch.utils.data.Dataset):
             padding_right = padding_left + enc_limits_max
 
             num_slices = hf["kspace_acq1"].shape[0]
+            constants = find_constant_datasets(hf)
 
         metadata = {
             "padding_left": padding_left,
             "padding_right": padding_right,
             "encoding_size": enc_size,
             "recon_size": recon_size,
+            "constants": constants,
         }
 
         return metadata, num_slices
@@ -342,44 +707,98 @@ class SliceDatasetQALAS(torch.utils.data.Dataset):
     def __getitem__(self, i: int):
         fname, dataslice, metadata = self.examples[i]
 
-        with h5py.File(fname, "r") as hf:
-            kspace_acq1 = hf["kspace_acq1"][dataslice]
-            kspace_acq2 = hf["kspace_acq2"][dataslice]
-            kspace_acq3 = hf["kspace_acq3"][dataslice]
-            kspace_acq4 = hf["kspace_acq4"][dataslice]
-            kspace_acq5 = hf["kspace_acq5"][dataslice]
+        if fname in self.volumes:
+            return self._get_preloaded(fname, dataslice, metadata)
 
-            # coil_sens = hf["coil_sens"][dataslice]
+        hf = self.file_cache.handle(fname)
+        static = self.file_cache.static(fname, hf, metadata)
 
-            mask_acq1 = np.asarray(hf["mask_acq1"]) if "mask_acq1" in hf else None
-            mask_acq2 = np.asarray(hf["mask_acq2"]) if "mask_acq2" in hf else None
-            mask_acq3 = np.asarray(hf["mask_acq3"]) if "mask_acq3" in hf else None
-            mask_acq4 = np.asarray(hf["mask_acq4"]) if "mask_acq4" in hf else None
-            mask_acq5 = np.asarray(hf["mask_acq5"]) if "mask_acq5" in hf else None
+        kspace_acq1 = hf["kspace_acq1"][dataslice]
+        kspace_acq2 = hf["kspace_acq2"][dataslice]
+        kspace_acq3 = hf["kspace_acq3"][dataslice]
+        kspace_acq4 = hf["kspace_acq4"][dataslice]
+        kspace_acq5 = hf["kspace_acq5"][dataslice]
 
-            mask_brain = hf["mask_brain"][dataslice]
+        # coil_sens = hf["coil_sens"][dataslice]
 
-            b1 = hf["reconstruction_b1"][dataslice]
-            ie = hf["reconstruction_ie"][dataslice]
+        mask_acq1 = static["mask_acq1"]
+        mask_acq2 = static["mask_acq2"]
+        mask_acq3 = static["mask_acq3"]
+        mask_acq4 = static["mask_acq4"]
+        mask_acq5 = static["mask_acq5"]
 
-            target_t1 = hf["reconstruction_t1"][dataslice]
-            target_t2 = hf["reconstruction_t2"][dataslice]
-            target_pd = hf["reconstruction_pd"][dataslice]
+        mask_brain = hf["mask_brain"][dataslice]
 
-            attrs = dict(hf.attrs)
-            attrs.update(metadata)
+        # constant datasets are not read, see find_constant_datasets
+        constants = metadata.get("constants", {})
+        b1 = _read_dataset(hf, "reconstruction_b1", dataslice, constants)
+        ie = _read_dataset(hf, "reconstruction_ie", dataslice, constants)
+
+        target_t1 = _read_dataset(hf, "reconstruction_t1", dataslice, constants)
+        target_t2 = _read_dataset(hf, "reconstruction_t2", dataslice, constants)
+        target_pd = _read_dataset(hf, "reconstruction_pd", dataslice, constants)
+
+        attrs = dict(static["attrs"])
 
         if self.transform is None:
             sample = (kspace_acq1, kspace_acq2, kspace_acq3, kspace_acq4, kspace_acq5, \
                     mask_acq1, mask_acq2, mask_acq3, mask_acq4, mask_acq5, mask_brain, \
                     # coil_sens, \
                     b1, ie, target_t1, target_t2, target_pd, \
-                    attrs, fname.name, dataslice)
+                    attrs, self.name_prefix + fname.name, dataslice)
         else:
             sample = self.transform(kspace_acq1, kspace_acq2, kspace_acq3, kspace_acq4, kspace_acq5, \
                                     mask_acq1, mask_acq2, mask_acq3, mask_acq4, mask_acq5, mask_brain, \
                                     # coil_sens, \
                                     b1, ie, target_t1, target_t2, target_pd, \
-                                    attrs, fname.name, dataslice)
+                                    attrs, self.name_prefix + fname.name, dataslice)
+
+        return sample
+
+    def _get_preloaded(self, fname: Path, dataslice: int, metadata: Dict):
+        volume = self.volumes[fname]
+
+        def view(key: str, dataslice: Optional[int] = None):
+            if key in volume["constants"]:
+                return np.array(volume["constants"][key], dtype=np.float32)
+            if volume[key] is None:
+                return None
+            data = volume[key] if dataslice is None else volume[key][dataslice]
+            return data.numpy()
+
+        kspace_acq1 = view("kspace_acq1", dataslice)
+        kspace_acq2 = view("kspace_acq2", dataslice)
+        kspace_acq3 = view("kspace_acq3", dataslice)
+        kspace_acq4 = view("kspace_acq4", dataslice)
+        kspace_acq5 = view("kspace_acq5", dataslice)
+
+        mask_acq1 = view("mask_acq1")
+        mask_acq2 = view("mask_acq2")
+        mask_acq3 = view("mask_acq3")
+        mask_acq4 = view("mask_acq4")
+        mask_acq5 = view("mask_acq5")
+
+        mask_brain = view("mask_brain", dataslice)
+
+        b1 = view("reconstruction_b1", dataslice)
+        ie = view("reconstruction_ie", dataslice)
+
+        target_t1 = view("reconstruction_t1", dataslice)
+        target_t2 = view("reconstruction_t2", dataslice)
+        target_pd = view("reconstruction_pd", dataslice)
+
+        attrs = dict(volume["attrs"])
+        attrs.update(metadata)
+
+        if self.transform is None:
+            sample = (kspace_acq1, kspace_acq2, kspace_acq3, kspace_acq4, kspace_acq5, \
+                    mask_acq1, mask_acq2, mask_acq3, mask_acq4, mask_acq5, mask_brain, \
+                    b1, ie, target_t1, target_t2, target_pd, \
+                    attrs, self.name_prefix + fname.name, dataslice)
+        else:
+            sample = self.transform(kspace_acq1, kspace_acq2, kspace_acq3, kspace_acq4, kspace_acq5, \
+                                    mask_acq1, mask_acq2, mask_acq3, mask_acq4, mask_acq5, mask_brain, \
+                                    b1, ie, target_t1, target_t2, target_pd, \
+                                    attrs, self.name_prefix + fname.name, dataslice)
 
         return sample
@@ -0,0 +1,285 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import json
+import os
+from pathlib import Path
+from typing import Dict, NamedTuple, Union
+
+import h5py
+import numpy as np
+import torch
+
+
+def _attr_value(value):
+    # MATLAB's h5writeatt stores scalars as 1-element arrays and strings as bytes
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, np.ndarray):
+        return _attr_value(value.reshape(-1)[0]) if value.size > 0 else None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+# numeric fields of SequenceParams, in the order of SequenceParams.to_tensor
+SEQUENCE_PARAM_FIELDS = (
+    "flip_ang",
+    "tf",
+    "esp",
+    "t2_prep",
+    "gap_bw_ro",
+    "tr",
+    "time_relax_end",
+    "echo2use",
+    "crusher_after_t2prep",
+    "inv_pulse",
+    "gap_inv_readout",
+    "etl",
+    "delt_m0_m1",
+    "delt_m3_m4",
+    "delt_m7_m8",
+    "delt_m13_end",
+)
+
+
+class SequenceParams(NamedTuple):
+    """
+    3D-QALAS sequence parameters and the timings derived from them.
+
+    All timings are in seconds and stored as plain floats, so that the
+    structure can be built once per subject, passed to the model at
+    construction and saved in the checkpoint hyperparameters.
+
+    Args:
+        flip_ang: Readout flip angle in degrees.
+        tf: Turbo factor.
+        esp: Echo spacing.
+        t2_prep: Duration of the T2 preparation.
+        gap_bw_ro: Gap between the start of two consecutive readouts.
+        tr: Repetition time of the whole QALAS block.
+        time_relax_end: Additional relaxation time at the end of the block.
+        echo2use: Index of the echo to use.
+        crusher_after_t2prep: Duration of the crusher after the T2 preparation.
+        inv_pulse: Duration of the inversion pulse (delT_M4_M5).
+        gap_inv_readout: Gap between the end of the inversion pulse and the
+            start of readout #2 (delT_M5_M6).
+        manufacturer: Scanner manufacturer.
+        etl: Duration of one readout (tf * esp).
+        delt_m0_m1: Gap between the end of readout #5 relaxation and the
+            start of the T2 preparation.
+        delt_m3_m4: Gap between the end of readout #1 and the start of the
+            inversion pulse.
+        delt_m7_m8: Gap between the end of a readout and the start of the
+            next one (readouts #2 to #5).
+        delt_m13_end: Relaxation time between the end of readout #5 and the
+            end of the block.
+    """
+
+    flip_ang: float
+    tf: float
+    esp: float
+    t2_prep: float
+    gap_bw_ro: float
+    tr: float
+    time_relax_end: float
+    echo2use: int
+    crusher_after_t2prep: float
+    inv_pulse: float
+    gap_inv_readout: float
+    manufacturer: str
+    etl: float
+    delt_m0_m1: float
+    delt_m3_m4: float
+    delt_m7_m8: float
+    delt_m13_end: float
+
+    @classmethod
+    def from_scan_params(
+        cls,
+        flip_ang: float,
+        tf: float,
+        esp: float,
+        t2_prep: float,
+        gap_bw_ro: float,
+        tr: float,
+        time_relax_end: float,
+        echo2use: int,
+        crusher_after_t2prep: float,
+        inv_pulse: float,
+        gap_inv_readout: float,
+        manufacturer: str = "",
+    ) -> "SequenceParams":
+        """
+        Build the parameters from the raw scan values and derive the timings.
+        """
+        etl = tf * esp
+        delt_m0_m1 = gap_bw_ro - etl - t2_prep
+        delt_m3_m4 = gap_bw_ro - etl - inv_pulse - gap_inv_readout
+        delt_m7_m8 = gap_bw_ro - etl
+        total_duration = (
+            delt_m0_m1
+            + t2_prep
+            + etl
+            + delt_m3_m4
+            + inv_pulse
+            + gap_inv_readout
+            + etl
+            + 3 * (delt_m7_m8 + etl)
+        )
+        delt_m13_end = max(tr - total_duration, 0.0)
+        if time_relax_end > 0:
+            delt_m13_end = delt_m13_end + time_relax_end
+
+        return cls(
+            flip_ang=float(flip_ang),
+            tf=float(tf),
+            esp=float(esp),
+            t2_prep=float(t2_prep),
+            gap_bw_ro=float(gap_bw_ro),
+            tr=float(tr),
+            time_relax_end=float(time_relax_end),
+            echo2use=int(echo2use),
+            crusher_after_t2prep=float(crusher_after_t2prep),
+            inv_pulse=float(inv_pulse),
+            gap_inv_readout=float(gap_inv_readout),
+            manufacturer=str(manufacturer),
+            etl=float(etl),
+            delt_m0_m1=float(delt_m0_m1),
+            delt_m3_m4=float(delt_m3_m4),
+            delt_m7_m8=float(delt_m7_m8),
+            delt_m13_end=float(delt_m13_end),
+        )
+
+    def to_tensor(self) -> torch.Tensor:
+        """
+        The numeric parameters as a float64 tensor of shape
+        `(len(SEQUENCE_PARAM_FIELDS),)`, so that every sample of a batch can
+        carry its own parameters. The manufacturer is not stored.
+        """
+        return torch.tensor([getattr(self, field) for field in SEQUENCE_PARAM_FIELDS], dtype=torch.float64)
+
+    @classmethod
+    def from_tensor(cls, values: torch.Tensor, manufacturer: str = "") -> "SequenceParams":
+        """
+        Build the parameters from a tensor written by `to_tensor`.
+
+        Args:
+            values: Tensor of shape `(len(SEQUENCE_PARAM_FIELDS), ...)`. With
+                one dimension the parameters are plain numbers, otherwise
+                they are tensors of the trailing shape, which broadcast
+                against the maps of the forward model.
+            manufacturer: Scanner manufacturer.
+        """
+        if values.dim() == 1:
+            fields = dict(zip(SEQUENCE_PARAM_FIELDS, values.tolist()))
+            fields["echo2use"] = int(fields["echo2use"])
+        else:
+            fields = dict(zip(SEQUENCE_PARAM_FIELDS, values.unbind(0)))
+
+        return cls(manufacturer=manufacturer, **fields)
+
+    @classmethod
+    def from_attrs(cls, attrs: Dict) -> "SequenceParams":
+        """
+        Build the parameters from the `scan_*` attributes of a QALAS h5 file.
+
+        Args:
+            attrs: Attributes written by `ssl_qalas_save_h5.m`.
+        """
+        manufacturer = attrs.get("scan_manufacturer", "")
+        return cls.from_scan_params(
+            flip_ang=_attr_value(attrs["scan_flip_ang"]),
+            tf=_attr_value(attrs["scan_tf"]),
+            esp=_attr_value(attrs["scan_esp"]),
+            t2_prep=_attr_value(attrs["scan_t2_prep"]),
+            gap_bw_ro=_attr_value(attrs["scan_gap_bw_ro"]),
+            tr=_attr_value(attrs["scan_tr"]),
+            time_relax_end=_attr_value(attrs["scan_time_relax_end"]),
+            echo2use=_attr_value(attrs["scan_echo2use"]),
+            crusher_after_t2prep=_attr_value(attrs["scan_crusher_after_T2prep"]),
+            inv_pulse=_attr_value(attrs["scan_inv_pulse"]),
+            gap_inv_readout=_attr_value(attrs["scan_gap_inv_readout"]),
+            manufacturer=_attr_value(manufacturer),
+        )
+
+    @classmethod
+    def from_h5(cls, fname: Union[str, Path, os.PathLike]) -> "SequenceParams":
+        """
+        Read the parameters from a QALAS h5 file.
+
+        Args:
+            fname: Path to an h5 file written by `ssl_qalas_save_h5.m`.
+        """
+        with h5py.File(fname, "r") as hf:
+            attrs = dict(hf.attrs)
+
+        return cls.from_attrs(attrs)
+
+    @classmethod
+    def from_bids_json(cls, fname: Union[str, Path, os.PathLike]) -> "SequenceParams":
+        """
+        Derive the parameters from the BIDS sidecar of a 3D-QALAS NIfTI file.
+
+        This mirrors the vendor table in `ssl_qalas_save_h5.m`, which assumes
+        that no modifications beyond resolution were made to the sequence.
+
+        Args:
+            fname: Path to the .json sidecar of the 3D-QALAS run.
+        """
+        with open(fname, "r") as f:
+            json_contents = json.load(f)
+
+        manufacturer = json_contents["Manufacturer"].upper()
+        if "SIEMENS" in manufacturer:
+            return cls.from_scan_params(
+                flip_ang=4,
+                tf=json_contents["EchoTrainLength"],
+                esp=json_contents["RepetitionTime"],
+                t2_prep=0.1097,
+                gap_bw_ro=0.9,
+                tr=4.5,
+                time_relax_end=0,
+                echo2use=1,
+                crusher_after_t2prep=9.7e-3,
+                inv_pulse=12.8e-3,
+                gap_inv_readout=100e-3 - 6.45e-3,
+                manufacturer="SIEMENS",
+            )
+        elif "PHILIPS" in manufacturer:
+            return cls.from_scan_params(
+                flip_ang=4,
+                tf=json_contents["EchoTrainLength"],
+                esp=json_contents["RepetitionTime"],
+                t2_prep=106.98e-3,
+                gap_bw_ro=0.9,
+                tr=4.5,
+                time_relax_end=0,
+                echo2use=1,
+                crusher_after_t2prep=6.22e-3,
+                inv_pulse=13.059e-3,
+                gap_inv_readout=106.98e-3,
+                manufacturer="PHILIPS",
+            )
+        elif "GE" in manufacturer:
+            inv_pulse = 16.2e-3
+            return cls.from_scan_params(
+                flip_ang=4,
+                tf=128,
+                esp=json_contents["RepetitionTime"],
+                t2_prep=0.0928,
+                gap_bw_ro=60 / 66.67,
+                tr=4.5,
+                time_relax_end=0,
+                echo2use=3,
+                crusher_after_t2prep=2.34e-3,
+                inv_pulse=inv_pulse,
+                gap_inv_readout=97.34e-3 + 160e-6 - inv_pulse / 2,
+                manufacturer="GE",
+            )
+        else:
+            raise ValueError(f"Unsupported manufacturer {json_contents['Manufacturer']}")
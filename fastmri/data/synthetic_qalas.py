@@ -0,0 +1,312 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import json
+import multiprocessing
+import os
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional, Tuple, Union
+
+import h5py
+import numpy as np
+import torch
+
+from .mri_data_qalas import FileCacheQALAS
+from .sequence_params_qalas import SequenceParams
+
+# Tissue classes of the brain sampled by the corpus generator: probability,
+# then mean and standard deviation of T1 (s), T2 (s) and PD. The last class
+# covers the whole parameter range (partial volumes, lesions, vessels).
+TISSUES_QALAS = {
+    "wm": (0.35, (0.85, 0.10), (0.070, 0.008), (0.70, 0.05)),
+    "gm": (0.35, (1.35, 0.15), (0.090, 0.012), (0.80, 0.05)),
+    "csf": (0.10, (4.00, 0.50), (1.500, 0.400), (1.00, 0.05)),
+    "uniform": (0.20, (0.20, 4.50), (0.010, 2.000), (0.10, 1.00)),
+}
+
+
+class SyntheticSampleQALAS(NamedTuple):
+    """
+    A pseudo-slice of the synthetic pretraining corpus.
+
+    Args:
+        signals: Magnitude of the five QALAS readouts, shape `(5, H, W)`,
+            normalized by their maximum like the real images.
+        b1: B1 map.
+        t1: T1 map in seconds.
+        t2: T2 map in seconds.
+        pd: PD map, normalized with the signals.
+        ie: Inversion efficiency map.
+        mask: Foreground (tissue) mask.
+    """
+
+    signals: torch.Tensor
+    b1: torch.Tensor
+    t1: torch.Tensor
+    t2: torch.Tensor
+    pd: torch.Tensor
+    ie: torch.Tensor
+    mask: torch.Tensor
+
+
+# leading dimensions of every dataset of a corpus, after the slice index
+_CORPUS_CHANNELS = {
+    "signals": (5,),
+    "b1": (),
+    "t1": (),
+    "t2": (),
+    "pd": (),
+    "ie": (),
+    "mask": (),
+}
+
+
+def sample_tissue_params(
+    rng: np.random.Generator,
+    num_voxels: int,
+    max_t1: float = 5.0,
+    max_t2: float = 2.5,
+) -> Dict[str, np.ndarray]:
+    """
+    Sample physiological T1, T2, PD, IE and B1 values for a set of voxels.
+
+    Args:
+        rng: Random number generator.
+        num_voxels: Number of voxels to sample.
+        max_t1: Upper bound of T1, i.e. the scaling of the T1 map.
+        max_t2: Upper bound of T2, i.e. the scaling of the T2 map.
+
+    Returns:
+        A dict of `(num_voxels,)` arrays with keys t1, t2, pd, ie and b1.
+    """
+    probs = np.array([tissue[0] for tissue in TISSUES_QALAS.values()])
+    labels = rng.choice(len(probs), size=num_voxels, p=probs / probs.sum())
+
+    t1 = np.empty(num_voxels)
+    t2 = np.empty(num_voxels)
+    pd = np.empty(num_voxels)
+    for label, (name, (_, t1_dist, t2_dist, pd_dist)) in enumerate(TISSUES_QALAS.items()):
+        idx = labels == label
+        n = int(idx.sum())
+        if name == "uniform":
+            t1[idx] = np.exp(rng.uniform(np.log(t1_dist[0]), np.log(t1_dist[1]), n))
+            t2[idx] = np.exp(rng.uniform(np.log(t2_dist[0]), np.log(t2_dist[1]), n))
+            pd[idx] = rng.uniform(pd_dist[0], pd_dist[1], n)
+        else:
+            t1[idx] = rng.normal(t1_dist[0], t1_dist[1], n)
+            t2[idx] = rng.normal(t2_dist[0], t2_dist[1], n)
+            pd[idx] = rng.normal(pd_dist[0], pd_dist[1], n)
+
+    t1 = np.clip(t1, 0.05, max_t1)
+    t2 = np.clip(np.minimum(t2, t1), 0.005, max_t2)
+    pd = np.clip(pd, 0.05, 1.0)
+    ie = np.clip(rng.normal(0.85, 0.05, num_voxels), 0.5, 1.0)
+    b1 = np.clip(rng.normal(1.0, 0.1, num_voxels), 0.6, 1.4)
+
+    return {"t1": t1, "t2": t2, "pd": pd, "ie": ie, "b1": b1}
+
+
+def create_corpus_qalas(
+    hf: h5py.File,
+    num_slices: int,
+    slice_shape: Tuple[int, int],
+    seq_params: SequenceParams,
+    max_t1: float,
+    max_t2: float,
+    compression: Optional[str] = None,
+):
+    """
+    Create the datasets and attributes of a corpus read by
+    `SyntheticSliceDatasetQALAS`, with one chunk per slice.
+
+    Args:
+        hf: Open h5 file.
+        num_slices: Number of slices.
+        slice_shape: Shape `(H, W)` of a slice.
+        seq_params: Sequence parameters of the signals.
+        max_t1: Scaling of the T1 map.
+        max_t2: Scaling of the T2 map.
+        compression: Optional; h5py compression filter.
+    """
+    for key, channels in _CORPUS_CHANNELS.items():
+        shape = (num_slices,) + channels + tuple(slice_shape)
+        hf.create_dataset(
+            key,
+            shape=shape,
+            dtype=np.float32,
+            chunks=(1,) + shape[1:],
+            compression=compression,
+        )
+    hf.attrs["seq_params"] = json.dumps(seq_params._asdict())
+    hf.attrs["max_t1"] = max_t1
+    hf.attrs["max_t2"] = max_t2
+
+
+def _generate_chunk(args) -> Dict[str, np.ndarray]:
+    # the models package depends on fastmri.data, import it in the worker
+    from fastmri.models.qalas_map import QALASBlock
+
+    seq_params, chunk_idx, num_slices, slice_size, max_t1, max_t2, noise_level, seed = args
+    torch.set_num_threads(1)
+    rng = np.random.default_rng([seed, chunk_idx])
+    block = QALASBlock(seq_params=SequenceParams(**seq_params))
+
+    num_voxels = slice_size * slice_size
+    chunk = {
+        "signals": np.zeros((num_slices, 5, slice_size, slice_size), dtype=np.float32),
+        "b1": np.zeros((num_slices, slice_size, slice_size), dtype=np.float32),
+        "t1": np.zeros((num_slices, slice_size, slice_size), dtype=np.float32),
+        "t2": np.zeros((num_slices, slice_size, slice_size), dtype=np.float32),
+        "pd": np.zeros((num_slices, slice_size, slice_size), dtype=np.float32),
+        "ie": np.zeros((num_slices, slice_size, slice_size), dtype=np.float32),
+        "mask": np.zeros((num_slices, slice_size, slice_size), dtype=np.float32),
+    }
+    for i in range(num_slices):
+        params = sample_tissue_params(rng, num_voxels, max_t1=max_t1, max_t2=max_t2)
+        # like a brain slice, part of the pseudo-slice is background (no signal)
+        mask = rng.random(num_voxels) >= rng.uniform(0.2, 0.6)
+        params["pd"] = params["pd"] * mask
+
+        with torch.no_grad():
+            signals = block.qalas_forward_eq(
+                torch.from_numpy(params["t1"]),
+                torch.from_numpy(params["t2"]),
+                torch.from_numpy(params["pd"]),
+                torch.from_numpy(params["ie"]),
+                torch.from_numpy(params["b1"]),
+            )
+        signals = torch.stack(signals).numpy()
+
+        # magnitude images with noise, normalized by their maximum as in
+        # ssl_qalas_save_h5.m
+        signals = np.abs(signals + rng.normal(0, noise_level * np.abs(signals).max(), signals.shape))
+        scale = signals.max()
+
+        chunk["signals"][i] = (signals / scale).reshape(5, slice_size, slice_size)
+        chunk["pd"][i] = (params["pd"] / scale).reshape(slice_size, slice_size)
+        for key in ("b1", "t1", "t2", "ie"):
+            chunk[key][i] = params[key].reshape(slice_size, slice_size)
+        chunk["mask"][i] = mask.reshape(slice_size, slice_size)
+
+    return chunk
+
+
+def generate_corpus_qalas(
+    out_file: Union[str, Path, os.PathLike],
+    seq_params: SequenceParams,
+    num_slices: int = 2048,
+    slice_size: int = 64,
+    chunk_slices: int = 32,
+    max_t1: float = 5.0,
+    max_t2: float = 2.5,
+    noise_level: float = 0.01,
+    num_workers: Optional[int] = None,
+    compression: Optional[str] = None,
+    seed: int = 0,
+):
+    """
+    Generate a synthetic corpus of QALAS signals for supervised pretraining.
+
+    Tissue parameters are sampled with `sample_tissue_params`, and the five
+    readouts are simulated with `QALASBlock.qalas_forward_eq` for the given
+    sequence parameters. Voxels are grouped in `(slice_size, slice_size)`
+    pseudo-slices with a random background fraction, so that the instance
+    normalization of the mapping network sees brain-like statistics. Chunks
+    of pseudo-slices are simulated in parallel and written in order to a
+    chunked h5 file.
+
+    Args:
+        out_file: Path to the h5 file to write.
+        seq_params: Sequence parameters of the vendor protocol.
+        num_slices: Number of pseudo-slices.
+        slice_size: Size of a pseudo-slice.
+        chunk_slices: Number of pseudo-slices simulated per task.
+        max_t1: Upper bound of T1, i.e. the scaling of the T1 map.
+        max_t2: Upper bound of T2, i.e. the scaling of the T2 map.
+        noise_level: Standard deviation of the noise, relative to the
+            maximum signal of a pseudo-slice.
+        num_workers: Number of processes, defaults to the number of CPUs.
+        compression: Optional; h5py compression filter.
+        seed: Random seed.
+    """
+    out_file = Path(out_file)
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+
+    tasks = []
+    for chunk_idx, start in enumerate(range(0, num_slices, chunk_slices)):
+        tasks.append(
+            (
+                seq_params._asdict(),
+                chunk_idx,
+                min(chunk_slices, num_slices - start),
+                slice_size,
+                max_t1,
+                max_t2,
+                noise_level,
+                seed,
+            )
+        )
+
+    with h5py.File(out_file, "w") as hf:
+        create_corpus_qalas(
+            hf, num_slices, (slice_size, slice_size), seq_params, max_t1, max_t2, compression
+        )
+
+        start = 0
+        with multiprocessing.Pool(num_workers) as pool:
+            for chunk in pool.imap(_generate_chunk, tasks):
+                stop = start + chunk["signals"].shape[0]
+                for key, value in chunk.items():
+                    hf[key][start:stop] = value
+                start = stop
+
+
+class SyntheticSliceDatasetQALAS(torch.utils.data.Dataset):
+    """
+    A PyTorch Dataset over a synthetic corpus written by
+    `generate_corpus_qalas`.
+    """
+
+    def __init__(
+        self,
+        fname: Union[str, Path, os.PathLike],
+        start: int = 0,
+        stop: Optional[int] = None,
+    ):
+        """
+        Args:
+            fname: Path to the corpus.
+            start: First pseudo-slice of the split.
+            stop: Optional; end of the split, defaults to the whole corpus.
+        """
+        self.fname = Path(fname)
+        self.file_cache = FileCacheQALAS(max_open_files=1)
+
+        with h5py.File(self.fname, "r") as hf:
+            num_slices = hf["signals"].shape[0]
+            self.seq_params = SequenceParams(**json.loads(hf.attrs["seq_params"]))
+            self.max_t1 = float(hf.attrs["max_t1"])
+            self.max_t2 = float(hf.attrs["max_t2"])
+
+        self.indices = range(num_slices)[start:stop]
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i: int) -> SyntheticSampleQALAS:
+        hf = self.file_cache.handle(self.fname)
+        idx = self.indices[i]
+
+        return SyntheticSampleQALAS(
+            signals=torch.from_numpy(hf["signals"][idx]),
+            b1=torch.from_numpy(hf["b1"][idx]),
+            t1=torch.from_numpy(hf["t1"][idx]),
+            t2=torch.from_numpy(hf["t2"][idx]),
+            pd=torch.from_numpy(hf["pd"][idx]),
+            ie=torch.from_numpy(hf["ie"][idx]),
+            mask=torch.from_numpy(hf["mask"][idx]),
+        )
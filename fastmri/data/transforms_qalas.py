@@ -11,6 +11,7 @@ import fastmri
 import numpy as np
 import torch
 
+from .sequence_params_qalas import SequenceParams
 from .subsample import MaskFunc
 
 
@@ -388,48 +389,92 @@ class UnetDataTransform:
         )
 
 
-class QALASSample(NamedTuple):
+class QALASVolume(NamedTuple):
     """
-    A sample of masked k-space for variational network reconstruction.
+    The fields of a QALASSample that are the same for all slices of a file.
+
+    They are built once per file, and collated once per file of a batch.
 
     Args:
-        masked_kspace: k-space after applying sampling mask.
-        mask: The applied sampling mask.
-        img_sense: SENSE reconstructed images.
-        coil_sens: The coil sensitivity maps estimated with ESPIRiT.
+        max_value: Maximum T1, T2 and PD values.
+        crop_size: The size to crop the final image.
         num_low_frequencies: The number of samples for the densely-sampled
             center.
-        target: The target image (if applicable).
+        seq_params: Sequence parameters of the scan (see
+            `SequenceParams.to_tensor`), so that a batch can mix vendors.
+    """
+
+    max_value: torch.Tensor
+    crop_size: torch.Tensor
+    num_low_frequencies: torch.Tensor
+    seq_params: torch.Tensor
+
+
+class QALASSample(NamedTuple):
+    """
+    A slice of QALAS images for mapping.
+
+    A batch collated by `collate_qalas` is a QALASSample of the same fields
+    with a leading batch dimension.
+
+    Args:
+        images: The five QALAS images, of shape `(5, H, W)`.
+        masks: The sampling masks of the five acquisitions, of shape
+            `(5, W)`.
+        mask_brain: Brain mask.
+        b1: B1 map.
+        ie: Inversion efficiency map.
+        targets: The T1, T2 and PD target maps, of shape `(3, H, W)`.
         fname: File name.
         slice_num: The slice index.
-        max_value: Maximum image value.
-        crop_size: The size to crop the final image.
+        volume: The per-file fields, shared by all slices of the file.
     """
 
-    masked_kspace_acq1: torch.Tensor
-    masked_kspace_acq2: torch.Tensor
-    masked_kspace_acq3: torch.Tensor
-    masked_kspace_acq4: torch.Tensor
-    masked_kspace_acq5: torch.Tensor
-    mask_acq1: torch.Tensor
-    mask_acq2: torch.Tensor
-    mask_acq3: torch.Tensor
-    mask_acq4: torch.Tensor
-    mask_acq5: torch.Tensor
+    images: torch.Tensor
+    masks: torch.Tensor
     mask_brain: torch.Tensor
-    # coil_sens: torch.Tensor
     b1: torch.Tensor
     ie: torch.Tensor
-    num_low_frequencies: Optional[int]
-    target_t1: torch.Tensor
-    target_t2: torch.Tensor
-    target_pd: torch.Tensor
+    targets: torch.Tensor
     fname: str
     slice_num: int
-    max_value_t1: float
-    max_value_t2: float
-    max_value_pd: float
-    crop_size: Tuple[int, int]
+    volume: QALASVolume
+
+    @property
+    def target_t1(self) -> torch.Tensor:
+        return self.targets[..., 0, :, :]
+
+    @property
+    def target_t2(self) -> torch.Tensor:
+        return self.targets[..., 1, :, :]
+
+    @property
+    def target_pd(self) -> torch.Tensor:
+        return self.targets[..., 2, :, :]
+
+    @property
+    def max_value_t1(self) -> torch.Tensor:
+        return self.volume.max_value[..., 0]
+
+    @property
+    def max_value_t2(self) -> torch.Tensor:
+        return self.volume.max_value[..., 1]
+
+    @property
+    def max_value_pd(self) -> torch.Tensor:
+        return self.volume.max_value[..., 2]
+
+    @property
+    def crop_size(self) -> torch.Tensor:
+        return self.volume.crop_size
+
+    @property
+    def num_low_frequencies(self) -> torch.Tensor:
+        return self.volume.num_low_frequencies
+
+    @property
+    def seq_params(self) -> torch.Tensor:
+        return self.volume.seq_params
 
 
 class QALASDataTransform:
@@ -453,6 +498,27 @@ class QALASDataTransform:
         self.mask_func_acq4 = mask_func_acq4
         self.mask_func_acq5 = mask_func_acq5
         self.use_seed = use_seed
+        # QALASVolume of every file, keyed by file name
+        self.volumes: Dict[str, QALASVolume] = {}
+
+    def volume(self, attrs: Dict, fname: str, has_target: bool, num_low_frequencies: int) -> QALASVolume:
+        """
+        The QALASVolume of a file, built from the attributes of its first
+        slice.
+        """
+        if fname not in self.volumes:
+            if has_target:
+                max_value = np.concatenate([np.ravel(attrs[key]) for key in ("max_t1", "max_t2", "max_pd")])
+            else:
+                max_value = np.zeros(3)
+            self.volumes[fname] = QALASVolume(
+                max_value=torch.from_numpy(max_value.astype(np.float64)),
+                crop_size=torch.tensor(attrs["recon_size"][:2]),
+                num_low_frequencies=torch.tensor(num_low_frequencies),
+                seq_params=SequenceParams.from_attrs(attrs).to_tensor(),
+            )
+
+        return self.volumes[fname]
 
     def __call__(
         self,
@@ -488,141 +554,59 @@ class QALASDataTransform:
             slice_num: Serial number of the slice.
 
         Returns:
-            A QALASSample with the masked k-space, sampling mask, target
-            image, the filename, the slice number, the maximum image value
-            (from target), the target crop size, and the number of low
-            frequency lines sampled.
+            A QALASSample with the stacked images, sampling masks and target
+            maps, the filename, the slice number, and the QALASVolume of the
+            file.
         """
+        # constant maps and masks are read as 0-d arrays (see
+        # find_constant_datasets), and broadcast to the slice
+        shape = kspace_acq1.shape[-2:]
         if target_t1 is not None:
-            target_torch_t1 = to_tensor(target_t1)
-            target_torch_t2 = to_tensor(target_t2)
-            target_torch_pd = to_tensor(target_pd)
-            max_value_t1 = attrs["max_t1"]
-            max_value_t2 = attrs["max_t2"]
-            max_value_pd = attrs["max_pd"]
+            targets = torch.stack([to_tensor(np.asarray(target)).expand(shape) for target in (target_t1, target_t2, target_pd)])
         else:
-            target_torch_t1 = torch.tensor(0)
-            target_torch_t2 = torch.tensor(0)
-            target_torch_pd = torch.tensor(0)
-            max_value_t1 = 0.0
-            max_value_t2 = 0.0
-            max_value_pd = 0.0
-
-        kspace_torch_acq1 = to_tensor(kspace_acq1)
-        kspace_torch_acq2 = to_tensor(kspace_acq2)
-        kspace_torch_acq3 = to_tensor(kspace_acq3)
-        kspace_torch_acq4 = to_tensor(kspace_acq4)
-        kspace_torch_acq5 = to_tensor(kspace_acq5)
-        mask_brain_torch = to_tensor(mask_brain)
-        # coil_sens_torch = to_tensor(coil_sens)
-        b1_torch = to_tensor(b1)
-        ie_torch = to_tensor(ie)
-        seed = None if not self.use_seed else tuple(map(ord, fname))
+            targets = torch.zeros(3, 1, 1)
+
         acq_start = attrs["padding_left"]
         acq_end = attrs["padding_right"]
 
-        crop_size = (attrs["recon_size"][0], attrs["recon_size"][1])
-
         if self.mask_func_acq1 is not None:
-            masked_kspace_acq1, mask_torch_acq1, num_low_frequencies = apply_mask(
-                kspace_torch_acq1, self.mask_func_acq1, seed=seed, padding=(acq_start, acq_end)
-            )
-            masked_kspace_acq2, mask_torch_acq2, num_low_frequencies = apply_mask(
-                kspace_torch_acq2, self.mask_func_acq2, seed=seed, padding=(acq_start, acq_end)
-            )
-            masked_kspace_acq3, mask_torch_acq3, num_low_frequencies = apply_mask(
-                kspace_torch_acq3, self.mask_func_acq3, seed=seed, padding=(acq_start, acq_end)
-            )
-            masked_kspace_acq4, mask_torch_acq4, num_low_frequencies = apply_mask(
-                kspace_torch_acq4, self.mask_func_acq4, seed=seed, padding=(acq_start, acq_end)
-            )
-            masked_kspace_acq5, mask_torch_acq5, num_low_frequencies = apply_mask(
-                kspace_torch_acq5, self.mask_func_acq5, seed=seed, padding=(acq_start, acq_end)
-            )
-
-            sample = QALASSample(
-                masked_kspace_acq1=masked_kspace_acq1,
-                masked_kspace_acq2=masked_kspace_acq2,
-                masked_kspace_acq3=masked_kspace_acq3,
-                masked_kspace_acq4=masked_kspace_acq4,
-                masked_kspace_acq5=masked_kspace_acq5,
-                mask_acq1=mask_torch_acq1.to(torch.bool),
-                mask_acq2=mask_torch_acq2.to(torch.bool),
-                mask_acq3=mask_torch_acq3.to(torch.bool),
-                mask_acq4=mask_torch_acq4.to(torch.bool),
-                mask_acq5=mask_torch_acq5.to(torch.bool),
-                mask_brain=mask_brain_torch,
-                # coil_sens=coil_sens_torch,
-                b1=b1_torch,
-                ie=ie_torch,
-                num_low_frequencies=num_low_frequencies,
-                target_t1=target_torch_t1,
-                target_t2=target_torch_t2,
-                target_pd=target_torch_pd,
-                fname=fname,
-                slice_num=slice_num,
-                max_value_t1=max_value_t1,
-                max_value_t2=max_value_t2,
-                max_value_pd=max_value_pd,
-                crop_size=crop_size,
-            )
+            seed = None if not self.use_seed else tuple(map(ord, fname))
+            masked = [
+                apply_mask(to_tensor(kspace), mask_func, seed=seed, padding=(acq_start, acq_end))
+                for kspace, mask_func in (
+                    (kspace_acq1, self.mask_func_acq1),
+                    (kspace_acq2, self.mask_func_acq2),
+                    (kspace_acq3, self.mask_func_acq3),
+                    (kspace_acq4, self.mask_func_acq4),
+                    (kspace_acq5, self.mask_func_acq5),
+                )
+            ]
+            images = torch.cat([masked_kspace for masked_kspace, _, _ in masked])
+            masks = torch.stack([mask.reshape(-1) for _, mask, _ in masked]).to(torch.bool)
+            num_low_frequencies = masked[-1][2]
         else:
-            masked_kspace_acq1 = kspace_torch_acq1
-            masked_kspace_acq2 = kspace_torch_acq2
-            masked_kspace_acq3 = kspace_torch_acq3
-            masked_kspace_acq4 = kspace_torch_acq4
-            masked_kspace_acq5 = kspace_torch_acq5
-            shape = np.array(kspace_torch_acq1.shape)
-            num_cols = shape[-2]
-            shape[:-3] = 1
-            mask_shape = [1] * len(shape)
-            mask_shape[-2] = num_cols
-            mask_torch_acq1 = torch.from_numpy(mask_acq1.reshape(*mask_shape).astype(np.float32))
-            mask_torch_acq1 = mask_torch_acq1.reshape(*mask_shape)
-            mask_torch_acq1[:, :, :acq_start] = 0
-            mask_torch_acq1[:, :, acq_end:] = 0
-            mask_torch_acq2 = torch.from_numpy(mask_acq2.reshape(*mask_shape).astype(np.float32))
-            mask_torch_acq2 = mask_torch_acq2.reshape(*mask_shape)
-            mask_torch_acq2[:, :, :acq_start] = 0
-            mask_torch_acq2[:, :, acq_end:] = 0
-            mask_torch_acq3 = torch.from_numpy(mask_acq3.reshape(*mask_shape).astype(np.float32))
-            mask_torch_acq3 = mask_torch_acq3.reshape(*mask_shape)
-            mask_torch_acq3[:, :, :acq_start] = 0
-            mask_torch_acq3[:, :, acq_end:] = 0
-            mask_torch_acq4 = torch.from_numpy(mask_acq4.reshape(*mask_shape).astype(np.float32))
-            mask_torch_acq4 = mask_torch_acq4.reshape(*mask_shape)
-            mask_torch_acq4[:, :, :acq_start] = 0
-            mask_torch_acq4[:, :, acq_end:] = 0
-            mask_torch_acq5 = torch.from_numpy(mask_acq5.reshape(*mask_shape).astype(np.float32))
-            mask_torch_acq5 = mask_torch_acq5.reshape(*mask_shape)
-            mask_torch_acq5[:, :, :acq_start] = 0
-            mask_torch_acq5[:, :, acq_end:] = 0
-
-            sample = QALASSample(
-                masked_kspace_acq1=masked_kspace_acq1,
-                masked_kspace_acq2=masked_kspace_acq2,
-                masked_kspace_acq3=masked_kspace_acq3,
-                masked_kspace_acq4=masked_kspace_acq4,
-                masked_kspace_acq5=masked_kspace_acq5,
-                mask_acq1=mask_torch_acq1.to(torch.bool),
-                mask_acq2=mask_torch_acq2.to(torch.bool),
-                mask_acq3=mask_torch_acq3.to(torch.bool),
-                mask_acq4=mask_torch_acq4.to(torch.bool),
-                mask_acq5=mask_torch_acq5.to(torch.bool),
-                mask_brain=mask_brain_torch,
-                # coil_sens=coil_sens_torch,
-                b1=b1_torch,
-                ie=ie_torch,
-                num_low_frequencies=0,
-                target_t1=target_torch_t1,
-                target_t2=target_torch_t2,
-                target_pd=target_torch_pd,
-                fname=fname,
-                slice_num=slice_num,
-                max_value_t1=max_value_t1,
-                max_value_t2=max_value_t2,
-                max_value_pd=max_value_pd,
-                crop_size=crop_size,
-            )
-
-        return sample
+            images = to_tensor(np.concatenate((kspace_acq1, kspace_acq2, kspace_acq3, kspace_acq4, kspace_acq5)))
+            num_cols = images.shape[-2]
+            file_masks = (mask_acq1, mask_acq2, mask_acq3, mask_acq4, mask_acq5)
+            if all(mask.ndim == 0 and mask == 1 for mask in file_masks) and acq_start <= 0 and acq_end >= num_cols:
+                # fully sampled
+                masks = torch.ones(1, 1, dtype=torch.bool).expand(5, num_cols)
+            else:
+                masks = np.stack([np.broadcast_to(mask.reshape(-1), (num_cols,)) for mask in file_masks]) != 0
+                masks[:, :acq_start] = False
+                masks[:, acq_end:] = False
+                masks = torch.from_numpy(masks)
+            num_low_frequencies = 0
+
+        return QALASSample(
+            images=images,
+            masks=masks,
+            mask_brain=to_tensor(mask_brain),
+            # coil_sens=to_tensor(coil_sens),
+            b1=to_tensor(np.asarray(b1)).expand(shape),
+            ie=to_tensor(np.asarray(ie)).expand(shape),
+            targets=targets,
+            fname=fname,
+            slice_num=slice_num,
+            volume=self.volume(attrs, fname, target_t1 is not None, num_low_frequencies),
+        )
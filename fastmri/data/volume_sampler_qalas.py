@@ -21,6 +21,12 @@ class VolumeSamplerQALAS(Sampler):
     from the same MRI volume need to go to the same node for distributed
     training. Dataset example is a list of tuples (fname, instance), where
     fname is essentially the volume name (actually a filename).
+
+    With fewer volumes than processes, e.g. the single val volume of a
+    session, a process without a volume of its own evaluates a copy of the
+    volumes of rank `rank % num_volumes`. Every process then runs the same
+    validation loop, and the per-volume metrics summed over the processes
+    are averaged over the copies.
     """
 
     def __init__(
@@ -88,6 +94,8 @@ class VolumeSamplerQALAS(Sampler):
         self.num_samples = max(len(indices) for indices in rank_indices)
         self.total_size = self.num_samples * self.num_replicas
         self.indices = rank_indices[self.rank]
+        if not self.indices:
+            self.indices = rank_indices[self.rank % len(self.all_volume_names)]
 
     def __iter__(self):
         if self.shuffle:
@@ -29,7 +29,21 @@ class SSIMLoss(nn.Module):
         NP = win_size ** 2
         self.cov_norm = NP / (NP - 1)
 
-    def forward(self, X: torch.Tensor, Y: torch.Tensor, data_range: torch.Tensor):
+    def forward(
+        self,
+        X: torch.Tensor,
+        Y: torch.Tensor,
+        data_range: torch.Tensor,
+        reduced: bool = True,
+    ):
+        """
+        Args:
+            X: Images, shape `(N, 1, H, W)`.
+            Y: Images, shape `(N, 1, H, W)`.
+            data_range: Data range of every image, shape `(N,)`.
+            reduced: Whether to return the mean loss, or the loss map of
+                every image, shape `(N, 1, H - win_size + 1, W - win_size + 1)`.
+        """
         assert isinstance(self.w, torch.Tensor)
 
         data_range = data_range[:, None, None, None]
@@ -52,4 +66,7 @@ class SSIMLoss(nn.Module):
         D = B1 * B2
         S = (A1 * A2) / D
 
-        return 1 - S.mean()
+        if reduced:
+            return 1 - S.mean()
+        else:
+            return 1 - S
@@ -1,3 +1,3 @@
 from .unet import Unet
 from .cnn import CNN
-from .qalas_map import NormUnet, QALAS_MAP, QALASBlock
\ No newline at end of file
+from .qalas_map import MapOutput, NormUnet, QALAS_MAP, QALASBlock, QALASLookupTable
\ No newline at end of file
@@ -5,6 +5,8 @@ This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
 
+from typing import Dict, List
+
 import torch
 from torch import nn
 from torch.nn import functional as F
@@ -22,6 +24,7 @@ class CNN(nn.Module):
         chans: int = 64,
         num_layers: int = 5,
         drop_prob: float = 0.0,
+        num_models: int = 1,
     ):
         """
         Args:
@@ -29,6 +32,10 @@ class CNN(nn.Module):
             out_chans: Number of channels in the output to the U-Net model.
             chans: Number of output channels of the first convolution layer.
             drop_prob: Dropout probability.
+            num_models: Number of independent CNNs run side by side as one
+                grouped CNN. Every convolution then has `num_models` groups,
+                and the weights of CNN k are the k-th chunk of every weight
+                (see `split_state_dict`).
         """
         super().__init__()
 
@@ -37,27 +44,95 @@ class CNN(nn.Module):
         self.chans = chans
         self.num_layers = num_layers
         self.drop_prob = drop_prob
+        self.num_models = num_models
 
+        # the InstanceNorm statistics are per channel, so they do not mix the
+        # groups either
+        in_chans, out_chans, chans = in_chans * num_models, out_chans * num_models, chans * num_models
         self.conv_layers = nn.Sequential(
-            nn.Conv2d(in_chans, chans, kernel_size=1, padding=0, bias=False),
+            nn.Conv2d(in_chans, chans, kernel_size=1, padding=0, bias=False, groups=num_models),
             nn.InstanceNorm2d(out_chans),
             nn.LeakyReLU(negative_slope=0.2, inplace=True),
             # nn.Dropout2d(drop_prob),
            )
         for _ in range(num_layers - 2):
-            self.conv_layers.append(nn.Conv2d(chans, chans, kernel_size=1, padding=0, bias=False))
+            self.conv_layers.append(nn.Conv2d(chans, chans, kernel_size=1, padding=0, bias=False, groups=num_models))
             self.conv_layers.append(nn.InstanceNorm2d(out_chans))
             self.conv_layers.append(nn.LeakyReLU(negative_slope=0.2, inplace=True))
             # self.conv_layers.append(nn.Dropout2d(drop_prob))
-        self.conv_layers.append(nn.Conv2d(chans, out_chans, kernel_size=1, padding=0, bias=False))
+        self.conv_layers.append(nn.Conv2d(chans, out_chans, kernel_size=1, padding=0, bias=False, groups=num_models))
         self.conv_layers.append(nn.Sigmoid())
 
     def forward(self, image: torch.Tensor) -> torch.Tensor:
         """
         Args:
-            image: Input 4D tensor of shape `(N, in_chans, H, W)`.
+            image: Input 4D tensor of shape `(N, in_chans, H, W)`. For a
+                grouped CNN, the `N = num_models * B` images are ordered by
+                model, the first B going through CNN 0.
 
         Returns:
             Output tensor of shape `(N, out_chans, H, W)`.
         """
-        return self.conv_layers(image)
+        if self.num_models == 1:
+            return self.conv_layers(image)
+
+        # (K * B, C, H, W) -> (B, K * C, H, W) and back
+        n, c, h, w = image.shape
+        k = self.num_models
+        image = image.reshape(k, n // k, c, h, w).transpose(0, 1).reshape(n // k, k * c, h, w)
+        output = self.conv_layers(image)
+
+        return output.reshape(n // k, k, -1, h, w).transpose(0, 1).reshape(n, -1, h, w)
+
+    @staticmethod
+    def split_state_dict(state_dict: Dict[str, torch.Tensor], num_models: int) -> List[Dict[str, torch.Tensor]]:
+        """
+        Split the state dict of a grouped CNN into the state dicts of its
+        `num_models` independent CNNs.
+        """
+        states: List[Dict[str, torch.Tensor]] = [{} for _ in range(num_models)]
+        for key, value in state_dict.items():
+            for state, chunk in zip(states, value.chunk(num_models)):
+                state[key] = chunk.clone()
+
+        return states
+
+    def forward_voxels(self, image: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        """
+        Voxel-packed equivalent of `forward` for the voxels inside a mask.
+
+        All convolutions are 1x1, so each one is a single matrix product with
+        the `(chans, N * H * W)` voxel features. The InstanceNorm statistics are
+        taken over all H * W voxels of each image, as in `forward`, and only
+        the voxels inside the mask go through the last layer.
+
+        Args:
+            image: Input 4D tensor of shape `(N, in_chans, H, W)`.
+            mask: Boolean tensor of shape `(N, H, W)`.
+
+        Returns:
+            Output tensor of shape `(out_chans, num_voxels)` with the voxels in
+            the order of `image[:, c][mask]`.
+        """
+        if self.num_models != 1:
+            raise ValueError("Voxel-packed mode does not support grouped CNNs.")
+
+        n, c, h, w = image.shape
+        x = image.reshape(n, c, h * w).transpose(0, 1).reshape(c, n * h * w)
+        last_conv = max(i for i, layer in enumerate(self.conv_layers) if isinstance(layer, nn.Conv2d))
+
+        for i, layer in enumerate(self.conv_layers):
+            if i == last_conv:
+                x = x[:, mask.reshape(-1)]
+            if isinstance(layer, nn.Conv2d):
+                x = torch.mm(layer.weight.flatten(1), x)
+                if layer.bias is not None:
+                    x = x + layer.bias.unsqueeze(-1)
+            elif isinstance(layer, nn.InstanceNorm2d):
+                # per (channel, image) statistics over the H * W voxels
+                x = F.batch_norm(x.reshape(1, -1, h * w), None, None, training=True, eps=layer.eps)
+                x = x.reshape(-1, n * h * w)
+            else:
+                x = layer(x)
+
+        return x
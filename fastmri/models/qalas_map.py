@@ -6,21 +6,55 @@ LICENSE file in the root directory of this source tree.
 """
 
 import math
-from typing import List, Tuple, Optional
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
 
 import fastmri
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from fastmri.data import transforms_qalas
+from fastmri.data.sequence_params_qalas import SEQUENCE_PARAM_FIELDS, SequenceParams
 import numpy as np
 
 from .unet import Unet
 from .cnn import CNN
 eps = 1e-5
 
-import os
-import h5py
+
+class B1Terms(NamedTuple):
+    """
+    B1-dependent terms of the QALAS forward model.
+
+    They only depend on the (fixed) B1 map of a slice, so they can be computed
+    once per slice and reused at every training step.
+
+    Args:
+        sin_flip_ang: sin of the B1-corrected readout flip angle.
+        log_cos_flip_ang: log(cos) of the B1-corrected readout flip angle.
+        sin2_t2_rad: sin^2 of the B1-corrected T2 preparation angle.
+        cos2_t2_rad: cos^2 of the B1-corrected T2 preparation angle.
+    """
+
+    sin_flip_ang: torch.Tensor
+    log_cos_flip_ang: torch.Tensor
+    sin2_t2_rad: torch.Tensor
+    cos2_t2_rad: torch.Tensor
+
+
+class MapOutput(NamedTuple):
+    """
+    Output of QALAS_MAP.
+
+    Args:
+        maps: T1, T2, PD, IE and B1 maps stacked in this order, of shape
+            `(B, 5, H, W)`.
+        images: The five simulated QALAS images, of shape `(B, 5, H, W)`, or
+            None if they were not requested.
+    """
+
+    maps: torch.Tensor
+    images: Optional[torch.Tensor]
 
 
 class NormUnet(nn.Module):
@@ -136,6 +170,7 @@ class MappingModel(nn.Module):
         in_chans: int = 5,
         out_chans: int = 4, # number of quantitative maps
         drop_prob: float = 0.0,
+        num_models: int = 1,
     ):
         """
         Args:
@@ -143,6 +178,8 @@ class MappingModel(nn.Module):
             in_chans: Number of channels in the input to the CNN model.
             out_chans: Number of channels in the output to the CNN model.
             drop_prob: Dropout probability.
+            num_models: Number of independent mapping CNNs, trained side by
+                side as one grouped CNN.
         """
         super().__init__()
 
@@ -152,6 +189,7 @@ class MappingModel(nn.Module):
             chans=chans,
             num_layers=num_layers,
             drop_prob=drop_prob,
+            num_models=num_models,
         )
         # self.cnn = NormUnet(
         #     in_chans=in_chans,
@@ -172,6 +210,9 @@ class MappingModel(nn.Module):
 
         return x
 
+    def forward_voxels(self, x: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        return self.cnn.forward_voxels(x, mask)
+
 
 class QALAS_MAP(nn.Module):
     """
@@ -189,6 +230,12 @@ class QALAS_MAP(nn.Module):
         chans: int = 18,
         pools: int = 4,
         mask_center: bool = True,
+        seq_params: Optional[SequenceParams] = None,
+        steady_state: str = "closed_form",
+        forward_model: str = "analytic",
+        voxel_packed: bool = False,
+        num_models: int = 1,
+        b1_cache_size: int = 512,
     ):
         """
         Args:
@@ -202,71 +249,248 @@ class QALAS_MAP(nn.Module):
                 U-Net.
             mask_center: Whether to mask center of k-space for sensitivity map
                 calculation.
+            seq_params: QALAS sequence parameters used by the forward model.
+            steady_state: Steady-state solver of the forward model, either
+                "closed_form" or "iterative".
+            forward_model: "analytic" forward model, or its "lookup" table
+                approximation (see QALASLookupTable).
+            voxel_packed: Whether to run the mapping network output layer and
+                the forward model only on the voxels inside `mask_brain`.
+                Voxels outside the mask are returned as zeros.
+            num_models: Number of independent mapping networks, one per
+                session, trained side by side (see `CNN`). A batch then holds
+                the same number of samples of every session, ordered by
+                session, and the forward model uses the per-sample sequence
+                parameters.
+            b1_cache_size: Maximum number of slices whose B1 terms are kept
+                in the least recently used cache of `b1_terms`. Every entry
+                holds 4 maps of the slice size. 0 disables the cache.
         """
         super().__init__()
 
+        if voxel_packed and num_models > 1:
+            raise ValueError("Voxel-packed mode does not support several mapping networks.")
+
         self.maps_net = MappingModel(
             chans=maps_chans,
             num_layers=maps_layers,
             drop_prob = 0.0,
+            num_models=num_models,
         )
         self.cascades = nn.ModuleList(
-            [QALASBlock() for _ in range(num_cascades)]
+            [QALASBlock(seq_params=seq_params, steady_state=steady_state, forward_model=forward_model) for _ in range(num_cascades)]
         )
+        self.seq_params = seq_params
+        self.voxel_packed = voxel_packed
+        self.num_models = num_models
+        self.b1_cache_size = b1_cache_size
+        # B1Terms of the b1_cache_size most recently used slices, keyed by
+        # (fname, slice_num) and stacked as a (4, 1, H, W) tensor
+        self.b1_terms_cache: "OrderedDict[Tuple[str, int], torch.Tensor]" = OrderedDict()
+
+    def sample_seq_params(self, seq_params: Optional[torch.Tensor], b1: torch.Tensor) -> Optional[SequenceParams]:
+        """
+        Per-sample sequence parameters broadcast against `(B, 1, H, W)` maps,
+        or None to use the parameters of the model.
+        """
+        if seq_params is None:
+            return None
+
+        return SequenceParams.from_tensor(seq_params.t().reshape(seq_params.shape[1], -1, 1, 1, 1).to(b1))
+
+    def b1_terms(
+        self,
+        b1: torch.Tensor,
+        slice_keys: Optional[Sequence[Tuple[str, int]]] = None,
+        seq_params: Optional[torch.Tensor] = None,
+    ) -> B1Terms:
+        """
+        B1-dependent terms of the forward model for a batch.
+
+        Args:
+            b1: B1 maps of shape `(B, 1, H, W)`.
+            slice_keys: Optional; `(fname, slice_num)` of every batch element.
+                If given, the terms are computed once per slice and served
+                from the cache while the slice is among the `b1_cache_size`
+                most recently used ones.
+            seq_params: Optional; Per-sample sequence parameters of shape
+                `(B, len(SEQUENCE_PARAM_FIELDS))`.
+
+        Returns:
+            The B1Terms of the batch, each of shape `(B, 1, H, W)`.
+        """
+        if slice_keys is None or self.b1_cache_size <= 0:
+            return QALASBlock.compute_b1_terms(b1, self.sample_seq_params(seq_params, b1) or self.seq_params)
+
+        terms: Dict[Tuple[str, int], torch.Tensor] = {}
+        for key in slice_keys:
+            if key in self.b1_terms_cache:
+                self.b1_terms_cache.move_to_end(key)
+                terms[key] = self.b1_terms_cache[key]
+
+        missing = [i for i, key in enumerate(slice_keys) if key not in terms]
+        if missing:
+            missing_seq_params = None if seq_params is None else seq_params[missing]
+            with torch.no_grad():
+                missing_terms = torch.stack(QALASBlock.compute_b1_terms(
+                    b1[missing], self.sample_seq_params(missing_seq_params, b1) or self.seq_params
+                ))
+            for j, i in enumerate(missing):
+                terms[slice_keys[i]] = self.b1_terms_cache[slice_keys[i]] = missing_terms[:, j]
+            while len(self.b1_terms_cache) > self.b1_cache_size:
+                self.b1_terms_cache.popitem(last=False)
+
+        return B1Terms(*torch.stack([terms[key] for key in slice_keys], dim=1).unbind(0))
 
     def forward(
         self,
-        masked_kspace_acq1: torch.Tensor,
-        masked_kspace_acq2: torch.Tensor,
-        masked_kspace_acq3: torch.Tensor,
-        masked_kspace_acq4: torch.Tensor,
-        masked_kspace_acq5: torch.Tensor,
-        mask_acq1: torch.Tensor,
-        mask_acq2: torch.Tensor,
-        mask_acq3: torch.Tensor,
-        mask_acq4: torch.Tensor,
-        mask_acq5: torch.Tensor,
-        mask_brain: torch.Tensor,
-        # coil_sens: torch.Tensor,
+        images: torch.Tensor,
         b1: torch.Tensor,
-        ie: torch.Tensor,
         max_value_t1: torch.Tensor,
         max_value_t2: torch.Tensor,
-        max_value_pd: torch.Tensor,
-        max_value_ie: torch.Tensor,
-        num_low_frequencies: Optional[int] = None,
+        mask_brain: Optional[torch.Tensor] = None,
+        seq_params: Optional[torch.Tensor] = None,
+        slice_keys: Optional[List[Tuple[str, int]]] = None,
+        return_images: bool = True,
+    ) -> MapOutput:
+        """
+        Args:
+            images: QALAS images of shape `(B, 5, H, W)`.
+            b1: B1 maps of shape `(B, H, W)`.
+            max_value_t1: Scaling of the T1 map, of shape `(B,)`.
+            max_value_t2: Scaling of the T2 map, of shape `(B,)`.
+            mask_brain: Optional; Brain mask of shape `(B, H, W)`, required in
+                voxel-packed mode.
+            seq_params: Optional; Sequence parameters of every sample, of
+                shape `(B, len(SEQUENCE_PARAM_FIELDS))` (see
+                `SequenceParams.to_tensor`), so that a batch can mix vendors.
+                Defaults to the parameters of the model.
+            slice_keys: Optional; `(fname, slice_num)` of every sample, the
+                keys of the B1 terms cache.
+            return_images: Whether to simulate the images with the forward
+                model. Inference only needs the maps.
+
+        Returns:
+            The MapOutput of the batch.
+        """
+        # If raw k-space data were used, the images are the coil combinations
+        # of the masked k-space of every acquisition:
+        # fastmri.complex_abs(fastmri.complex_mul(fastmri.ifft2c(masked_kspace), fastmri.complex_conj(coil_sens)).sum(dim=1, keepdim=True) / np.sqrt(masked_kspace.shape[2] * masked_kspace.shape[3]))
+        # If DICOM data were used, they are the inputs.
+
+        if self.voxel_packed:
+            if mask_brain is None:
+                raise ValueError("Voxel-packed mode needs a brain mask.")
+            return self.forward_voxels(images, mask_brain, b1, max_value_t1, max_value_t2, slice_keys, return_images, seq_params)
+
+        # Using CNN for Mapping
+        map_pred = self.maps_net(images)
+        # map_pred = self.maps_net(torch.cat((images, b1.unsqueeze(1).to(images.device)), 1))
+
+        maps = torch.cat(
+            (
+                map_pred[:, 0:1] * max_value_t1.reshape(-1, 1, 1, 1),
+                map_pred[:, 1:2] * max_value_t2.reshape(-1, 1, 1, 1),
+                map_pred[:, 2:3] / math.sin(math.pi / 180 * 4),
+                map_pred[:, 3:4] * (1 - 0.5) + 0.5, # 0.5-1.0
+                b1.unsqueeze(1).to(map_pred),
+            ),
+            1,
+        )
+
+        # Maps only (inference): the simulated images are not needed
+        if not return_images:
+            return MapOutput(maps, None)
+
+        return MapOutput(maps, self.simulate(maps, slice_keys, seq_params))
+
+    @torch.jit.unused
+    def simulate(
+        self,
+        maps: torch.Tensor,
+        slice_keys: Optional[List[Tuple[str, int]]] = None,
+        seq_params: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
+        """
+        Simulate the five images of `(B, 5, H, W)` maps with the cascades.
+
+        The forward model is not scriptable (its sequence parameters are a
+        Python NamedTuple), so it runs in Python when the model is scripted.
+        """
+        map_t1, map_t2, map_pd, map_ie, map_b1 = maps.split(1, dim=1)
+        b1_terms = self.b1_terms(map_b1, slice_keys, seq_params)
+        if seq_params is not None:
+            seq_params = seq_params.t().reshape(seq_params.shape[1], -1, 1, 1, 1)
 
-        # If raw k-space data were used, use following 5 lines
-        # image_pred_acq1 = fastmri.complex_abs(fastmri.complex_mul(fastmri.ifft2c(masked_kspace_acq1), fastmri.complex_conj(coil_sens)).sum(dim=1, keepdim=True) / np.sqrt(masked_kspace_acq1.shape[2] * masked_kspace_acq1.shape[3]))
-        # image_pred_acq2 = fastmri.complex_abs(fastmri.complex_mul(fastmri.ifft2c(masked_kspace_acq2), fastmri.complex_conj(coil_sens)).sum(dim=1, keepdim=True) / np.sqrt(masked_kspace_acq2.shape[2] * masked_kspace_acq2.shape[3]))
-        # image_pred_acq3 = fastmri.complex_abs(fastmri.complex_mul(fastmri.ifft2c(masked_kspace_acq3), fastmri.complex_conj(coil_sens)).sum(dim=1, keepdim=True) / np.sqrt(masked_kspace_acq3.shape[2] * masked_kspace_acq3.shape[3]))
-        # image_pred_acq4 = fastmri.complex_abs(fastmri.complex_mul(fastmri.ifft2c(masked_kspace_acq4), fastmri.complex_conj(coil_sens)).sum(dim=1, keepdim=True) / np.sqrt(masked_kspace_acq4.shape[2] * masked_kspace_acq4.shape[3]))
-        # image_pred_acq5 = fastmri.complex_abs(fastmri.complex_mul(fastmri.ifft2c(masked_kspace_acq5), fastmri.complex_conj(coil_sens)).sum(dim=1, keepdim=True) / np.sqrt(masked_kspace_acq5.shape[2] * masked_kspace_acq5.shape[3]))
+        for cascade in self.cascades:
+            img_acqs = cascade(map_t1, map_t2, map_pd, map_ie, map_b1, b1_terms, seq_params)
+        return torch.cat(img_acqs, 1)
 
-        # If DICOM data were used, use following 5 lines
-        image_pred_acq1 = masked_kspace_acq1
-        image_pred_acq2 = masked_kspace_acq2
-        image_pred_acq3 = masked_kspace_acq3
-        image_pred_acq4 = masked_kspace_acq4
-        image_pred_acq5 = masked_kspace_acq5
+    @torch.jit.unused
+    def forward_voxels(
+        self,
+        images: torch.Tensor,
+        mask_brain: torch.Tensor,
+        b1: torch.Tensor,
+        max_value_t1: torch.Tensor,
+        max_value_t2: torch.Tensor,
+        slice_keys: Optional[List[Tuple[str, int]]] = None,
+        return_images: bool = True,
+        seq_params: Optional[torch.Tensor] = None,
+    ) -> MapOutput:
+        """
+        Voxel-packed forward pass.
+
+        The maps and the simulated images are only computed for the voxels
+        inside `mask_brain` and scattered back into zero-filled
+        `(B, 5, H, W)` stacks at the end.
+
+        Args:
+            images: QALAS images of shape `(B, 5, H, W)`.
+            mask_brain: Brain mask of shape `(B, H, W)`.
+            b1: B1 maps of shape `(B, H, W)`.
+            max_value_t1: Scaling of the T1 map.
+            max_value_t2: Scaling of the T2 map.
+            slice_keys: Optional; keys of the B1 terms cache.
+            return_images: Whether to run the forward model.
+            seq_params: Optional; Per-sample sequence parameters.
+        """
+        if mask_brain.shape[-2:] != images.shape[-2:]:
+            raise ValueError(
+                f"Voxel-packed mode needs a brain mask of the image size, got {tuple(mask_brain.shape)} for {tuple(images.shape)}."
+            )
+        mask = mask_brain.reshape(images.shape[0], *images.shape[-2:]).to(images.device) > 0
 
         # Using CNN for Mapping
-        map_pred = self.maps_net(torch.cat((image_pred_acq1, image_pred_acq2, image_pred_acq3, image_pred_acq4, image_pred_acq5), 1))
-        # map_pred = self.maps_net(torch.cat((image_pred_acq1, image_pred_acq2, image_pred_acq3, image_pred_acq4, image_pred_acq5, b1.unsqueeze(1).to(image_pred_acq1.device)), 1))
+        map_pred = self.maps_net.forward_voxels(images, mask)
+
+        # batch index of every voxel, for the per-sample values
+        voxel_batch = torch.arange(mask.shape[0], device=mask.device).reshape(-1, 1, 1).expand_as(mask)[mask]
+
+        map_pred_t1 = map_pred[0] * max_value_t1.reshape(-1)[voxel_batch]
+        map_pred_t2 = map_pred[1] * max_value_t2.reshape(-1)[voxel_batch]
+        map_pred_pd = map_pred[2] / math.sin(math.pi / 180 * 4)
+        map_pred_ie = map_pred[3] * (1 - 0.5) + 0.5 # 0.5-1.0
 
-        map_pred_t1 = map_pred[:,0:1,:,:] * max_value_t1[0,:]
-        map_pred_t2 = map_pred[:,1:2,:,:] * max_value_t2[0,:]
-        # map_pred_pd = map_pred[:,2:3,:,:]
-        map_pred_pd = map_pred[:,2:3,:,:] / torch.sin(np.pi / 180 * torch.Tensor([4]).to(map_pred.device))
-        map_pred_ie = map_pred[:,3:4,:,:] * (1 - 0.5) + 0.5 # 0.5-1.0
+        def scatter(x: torch.Tensor) -> torch.Tensor:
+            # (C, N) voxels to (B, C, H, W) images
+            out = x.new_zeros((x.shape[0],) + mask.shape)
+            out[:, mask] = x
+            return out.transpose(0, 1)
 
-        map_pred_b1 = b1.unsqueeze(1).to(map_pred.device)
+        map_pred_b1 = b1.to(map_pred)
+        maps = torch.cat((scatter(torch.stack((map_pred_t1, map_pred_t2, map_pred_pd, map_pred_ie))), map_pred_b1.unsqueeze(1)), 1)
+        if not return_images:
+            return MapOutput(maps, None)
+
+        b1_terms = B1Terms(*[term.squeeze(1)[mask] for term in self.b1_terms(map_pred_b1.unsqueeze(1), slice_keys, seq_params)])
+        voxel_b1 = map_pred_b1[mask]
+        if seq_params is not None:
+            seq_params = seq_params.to(mask.device)[voxel_batch].t()
 
         for cascade in self.cascades:
-            [img_acq1, img_acq2, img_acq3, img_acq4, img_acq5] = cascade(map_pred_t1, map_pred_t2, map_pred_pd, map_pred_ie, map_pred_b1)
-        return map_pred_t1.squeeze(1), map_pred_t2.squeeze(1), map_pred_pd.squeeze(1), map_pred_ie.squeeze(1), map_pred_b1.squeeze(1), \
-                img_acq1, img_acq2, img_acq3, img_acq4, img_acq5
+            img_acqs = cascade(map_pred_t1, map_pred_t2, map_pred_pd, map_pred_ie, voxel_b1, b1_terms, seq_params)
+        return MapOutput(maps, scatter(torch.stack(img_acqs)))
 
 
 class QALASBlock(nn.Module):
@@ -278,107 +502,194 @@ class QALASBlock(nn.Module):
     the full variational network.
     """
 
-    def __init__(self):
+    def __init__(self, seq_params: Optional[SequenceParams] = None, steady_state: str = "closed_form", \
+                 forward_model: str = "analytic"):
         """
         Args:
-            model: Module for "regularization" component of variational
-                network.
+            seq_params: QALAS sequence parameters used by the forward model.
+            steady_state: How the steady-state magnetization is reached.
+                "closed_form" solves for the fixed point of the block directly,
+                "iterative" simulates 20 repetitions of the block (reference).
+            forward_model: "analytic" evaluates `qalas_forward_eq`, "lookup"
+                interpolates it in a precomputed `QALASLookupTable`.
         """
         super().__init__()
 
-    def qalas_forward_eq(self, x_t1: torch.Tensor, x_t2: torch.Tensor, x_m0: torch.Tensor, x_ie: torch.Tensor, x_b1: torch.Tensor) -> torch.Tensor:
-
-        h5_file_path = os.getenv("MESSAGE", "No value passed")
-
-        with h5py.File(h5_file_path, "r") as hf:
-            flip_ang = torch.Tensor([hf.attrs['scan_flip_ang'][0]]).to(x_t1.device) * x_b1.to(x_t1.device)     # Refocusing flip angle
-            tf = torch.Tensor([hf.attrs['scan_tf'][0]]).to(x_t1.device)                                # Turbo Factor
-            esp = torch.Tensor([hf.attrs['scan_esp'][0]]).to(x_t1.device)                            # ESP
-            etl = tf * esp                                                          #
-            t2_prep = torch.Tensor([hf.attrs['scan_t2_prep'][0]]).to(x_t1.device)                        # T2_prep
-            gap_bw_ro = torch.Tensor([hf.attrs['scan_gap_bw_ro'][0]]).to(x_t1.device)                         # Gap b/w readouts
-            tr = torch.Tensor([hf.attrs['scan_tr'][0]]).to(x_t1.device)                                # TR
-            time_relax_end = torch.Tensor([hf.attrs['scan_time_relax_end'][0]]).to(x_t1.device)                      # Relax time at the end
-            echo2use = hf.attrs['scan_echo2use'][0]                                                            # Index of echo to use
-
-
-            # Timings
-            delt_m1_m2 = t2_prep                                # (t2_prep = 0.1097)
-            delt_m0_m1 = gap_bw_ro - etl - delt_m1_m2           # (0.9 - 0.7296 - 0.1097 = 0.0607)
-            delt_m2_m3 = etl                                    # Duration of readout #1 = 0.7296
-            delt_m2_m6 = gap_bw_ro                              # Gap b/w readouts = 0.9
-            delt_m4_m5 = torch.Tensor([hf.attrs['scan_inv_pulse'][0]]).to(x_t1.device)          # Inversion pulse = 0.0128
-            delt_m5_m6 = torch.Tensor([hf.attrs['scan_gap_inv_readout'][0]]).to(x_t1.device)   # Gap b/w end of inversion pulse and start of readout #2 = 0.0355
-            delt_m3_m4 = delt_m2_m6 - delt_m2_m3 - delt_m4_m5 - delt_m5_m6 # Gap b/w end of readout #1 and start of inversion pulse = 0.9 - 0.7296 - 0.0128 - 0.0355 = 0.1221
-            delt_m6_m7 = etl                                    # Duration of readout #2 = 0.7296
-            delt_m7_m8 = gap_bw_ro - etl                        # From end of readout #2 to begin of readout #3 = 0.1704
-            delt_m8_m9 = etl                                    # Duration of readout #3 = 0.7296
-            delt_m9_m10 = gap_bw_ro - etl                       # From end of readout #3 to begin of readout #4 = 0.1704
-            delt_m10_m11 = etl                                  # Duration of readout #4 = 0.7296
-            delt_m11_m12 = gap_bw_ro - etl                      # From end of readout #4 to begin of readout #5 = 0.1704
-            delt_m12_m13 = etl                                  # Duration of readout #5 = 0.7296
-            total_duration = delt_m0_m1 + delt_m1_m2 + delt_m2_m3 + delt_m3_m4 + delt_m4_m5 + delt_m5_m6 + delt_m6_m7 + \
-                                delt_m7_m8 + delt_m8_m9 + delt_m9_m10 + delt_m10_m11 + delt_m11_m12 + delt_m12_m13
-            delt_m13_end = torch.maximum(tr - total_duration, torch.Tensor([0]).to(x_t1.device))
-            if time_relax_end > 0:
-                delt_m13_end = delt_m13_end + time_relax_end
-
-            # Const.
-            ET2 = torch.exp(-(delt_m1_m2 - hf.attrs['scan_crusher_after_T2prep'][0]) / (x_t2 + eps))
-            ET1 = torch.exp(-(delt_m1_m2 - hf.attrs['scan_crusher_after_T2prep'][0]) / (x_t1 + eps))
-            Ed1 = torch.exp(-(delt_m0_m1) / (x_t1 + eps))
-            Ed4 = torch.exp(-(delt_m3_m4) / (x_t1 + eps))
-            Ed6 = torch.exp(-(delt_m5_m6) / (x_t1 + eps))
-            Ed8 = torch.exp(-(delt_m7_m8) / (x_t1 + eps))
-            Ed10 = torch.exp(-(delt_m9_m10) / (x_t1 + eps))
-            Ed12 = torch.exp(-(delt_m11_m12) / (x_t1 + eps))
-            Ed14 = torch.exp(-(delt_m13_end) / (x_t1 + eps))
-            Eda = torch.exp(-(hf.attrs['scan_crusher_after_T2prep'][0]) / (x_t1 + eps))
-            Edb = torch.exp(-(0.) / (x_t1 + eps))
-            x_t1_star = x_t1 * (1 / (1 - x_t1 * torch.log(torch.cos(np.pi / 180 * flip_ang)) / esp))
-            x_m0_star = x_m0 * (1 - torch.exp(-esp / (x_t1 + eps))) / (1 - torch.exp(-esp / (x_t1_star + eps)))
-            Eetl = torch.exp(-etl / (x_t1_star + eps))
-            Eesp = torch.exp(-esp / (x_t1 + eps))
-
-        num_rep = 20 # number of repetitions to simulate to reach steady state
-        m_current = x_m0                                                                                # M0
-        for _ in range(num_rep):
-            m_current = x_m0 * (1 - Ed1) + m_current * Ed1                                              # M1 (del_t = 0.0607)
-            # m_current = m_current * ET2                                                               # M2, w/o b1 cor.
-            t2_rad = np.pi / 2 * x_b1.to(x_t1.device)                                                   # M2, w/ b1 cor.
-            m_current = m_current * (torch.sin(t2_rad) * torch.sin(t2_rad) * ET2 + \
-                                    torch.cos(t2_rad) * torch.cos(t2_rad) * ET1)                        # M2, w/ b1 cor.
-            m_current = x_m0 * (1 - Eda) + m_current * Eda                                              # M2 (del_t = 0.0097)
-            # current_img_acq1 = m_current                                                                ### Acq1
-            current_img_acq1 = m_current * torch.sin(np.pi / 180 * flip_ang)                            ### Acq1
-            m_current = x_m0_star * (1 - Eetl) + m_current * Eetl                                       # M3 (del_t = 0.7296)
-            m_current = x_m0 * (1 - Ed4) + m_current * Ed4                                              # M4 (del_t = 0.1221)
-            m_current = -m_current * x_ie                                                               # M5
-            m_current = x_m0 * (1 - Ed6) + m_current * Ed6                                              # M6 (del_t = 0.0355)
-            m_current = x_m0 * (1 - Edb) + m_current * Edb                                              # M6 (del_t = 0)
-            # current_img_acq2 = m_current                                                                ### Acq2
-            current_img_acq2 = m_current * torch.sin(np.pi / 180 * flip_ang)                            ### Acq2
-            m_current = x_m0_star * (1 - Eetl) + m_current * Eetl                                       # M7 (del_t = 0.7296)
-            m_current = x_m0 * (1 - Ed8) + m_current * Ed8                                              # M8 (del_t = 0.1704)
-            m_current = x_m0 * (1 - Edb) + m_current * Edb                                              # M8 (del_t = 0)
-            # current_img_acq3 = m_current                                                                ### Acq3
-            current_img_acq3 = m_current * torch.sin(np.pi / 180 * flip_ang)                            ### Acq3
-            m_current = x_m0_star * (1 - Eetl) + m_current * Eetl                                       # M9 (del_t = 0.7296)
-            m_current = x_m0 * (1 - Ed10) + m_current * Ed10                                            # M10 (del_t = 0.1704)
-            m_current = x_m0 * (1 - Edb) + m_current * Edb                                              # M10 (del_t = 0)
-            # current_img_acq4 = m_current                                                                ### Acq4
-            current_img_acq4 = m_current * torch.sin(np.pi / 180 * flip_ang)                            ### Acq4
-            m_current = x_m0_star * (1 - Eetl) + m_current * Eetl                                       # M11 (del_t = 0.7296)
-            m_current = x_m0 * (1 - Ed12) + m_current * Ed12                                            # M12 (del_t = 0.1704)
-            m_current = x_m0 * (1 - Edb) + m_current * Edb                                              # M12 (del_t = 0)
-            # current_img_acq5 = m_current                                                                ### Acq5
-            current_img_acq5 = m_current * torch.sin(np.pi / 180 * flip_ang)                            ### Acq5
-            m_current = x_m0_star * (1 - Eetl) + m_current * Eetl                                       # M13 (del_t = 0.7296)
-            m_current = x_m0 * (1 - Ed14) + m_current * Ed14                                            # M14
-
-        # return torch.abs(current_img_acq1), torch.abs(current_img_acq2), torch.abs(current_img_acq3), torch.abs(current_img_acq4), torch.abs(current_img_acq5)
+        if steady_state not in ("closed_form", "iterative"):
+            raise ValueError(f"Unknown steady_state mode {steady_state}")
+        if forward_model not in ("analytic", "lookup"):
+            raise ValueError(f"Unknown forward_model {forward_model}")
+
+        self.seq_params = seq_params
+        self.steady_state = steady_state
+        self.forward_model = forward_model
+
+    def lookup_table(self, device: torch.device) -> "QALASLookupTable":
+        if self.seq_params is None:
+            raise ValueError("QALASBlock requires sequence parameters, build them with SequenceParams.")
+
+        return QALASLookupTable.cached(self.seq_params, device)
+
+    def lookup_forward(
+        self,
+        x_t1: torch.Tensor,
+        x_t2: torch.Tensor,
+        x_m0: torch.Tensor,
+        x_ie: torch.Tensor,
+        x_b1: torch.Tensor,
+        seq_params: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, ...]:
+        if seq_params is None:
+            return self.lookup_table(x_t1.device)(x_t1, x_t2, x_m0, x_ie, x_b1)
+
+        # one table per distinct set of parameters in the batch
+        rows, groups = torch.unique(seq_params.reshape(seq_params.shape[0], -1).t(), dim=0, return_inverse=True)
+        if rows.shape[0] == 1:
+            return QALASLookupTable.cached(SequenceParams.from_tensor(rows[0]), x_t1.device)(x_t1, x_t2, x_m0, x_ie, x_b1)
+
+        groups = groups.reshape(seq_params.shape[1:]).to(x_t1.device).expand(x_t1.shape)
+        x_b1 = x_b1.to(x_t1.device).expand(x_t1.shape)
+        images = [x_t1.new_zeros(x_t1.shape) for _ in range(5)]
+        for group, row in enumerate(rows):
+            select = groups == group
+            table = QALASLookupTable.cached(SequenceParams.from_tensor(row), x_t1.device)
+            for image, signal in zip(images, table(x_t1[select], x_t2[select], x_m0[select], x_ie[select], x_b1[select])):
+                image[select] = signal
+
+        return tuple(images)
+
+    @staticmethod
+    def compute_b1_terms(x_b1: torch.Tensor, seq_params: Optional[SequenceParams]) -> B1Terms:
+        if seq_params is None:
+            raise ValueError("QALASBlock requires sequence parameters, build them with SequenceParams.")
+
+        flip_ang = seq_params.flip_ang * x_b1                                     # Refocusing flip angle
+        t2_rad = np.pi / 2 * x_b1                                               # M2, w/ b1 cor.
+
+        return B1Terms(
+            sin_flip_ang=torch.sin(np.pi / 180 * flip_ang),
+            log_cos_flip_ang=torch.log(torch.cos(np.pi / 180 * flip_ang)),
+            sin2_t2_rad=torch.sin(t2_rad) * torch.sin(t2_rad),
+            cos2_t2_rad=torch.cos(t2_rad) * torch.cos(t2_rad),
+        )
+
+    def qalas_forward_eq(self, x_t1: torch.Tensor, x_t2: torch.Tensor, x_m0: torch.Tensor, x_ie: torch.Tensor, x_b1: torch.Tensor, \
+                        b1_terms: Optional[B1Terms] = None, seq_params: Optional[SequenceParams] = None) -> torch.Tensor:
+
+        # per-sample parameters are tensors that broadcast against the maps
+        seq = self.seq_params if seq_params is None else seq_params
+        if seq is None:
+            raise ValueError("QALASBlock requires sequence parameters, build them with SequenceParams.")
+
+        if b1_terms is None:
+            b1_terms = self.compute_b1_terms(x_b1.to(x_t1.device), seq)
+        sin_flip_ang = b1_terms.sin_flip_ang
+        esp = seq.esp                                                           # ESP
+        etl = seq.etl                                                           # Turbo Factor * ESP
+
+        # Timings
+        delt_m1_m2 = seq.t2_prep                            # (t2_prep = 0.1097)
+        delt_m0_m1 = seq.delt_m0_m1                         # (0.9 - 0.7296 - 0.1097 = 0.0607)
+        delt_m3_m4 = seq.delt_m3_m4                         # Gap b/w end of readout #1 and start of inversion pulse = 0.9 - 0.7296 - 0.0128 - 0.0355 = 0.1221
+        delt_m5_m6 = seq.gap_inv_readout                    # Gap b/w end of inversion pulse and start of readout #2 = 0.0355
+        delt_m7_m8 = seq.delt_m7_m8                         # From end of readout #2 to begin of readout #3 = 0.1704
+        delt_m9_m10 = seq.delt_m7_m8                        # From end of readout #3 to begin of readout #4 = 0.1704
+        delt_m11_m12 = seq.delt_m7_m8                       # From end of readout #4 to begin of readout #5 = 0.1704
+        delt_m13_end = seq.delt_m13_end
+
+        # Const.
+        ET2 = torch.exp(-(delt_m1_m2 - seq.crusher_after_t2prep) / (x_t2 + eps))
+        ET1 = torch.exp(-(delt_m1_m2 - seq.crusher_after_t2prep) / (x_t1 + eps))
+        Ed1 = torch.exp(-(delt_m0_m1) / (x_t1 + eps))
+        Ed4 = torch.exp(-(delt_m3_m4) / (x_t1 + eps))
+        Ed6 = torch.exp(-(delt_m5_m6) / (x_t1 + eps))
+        Ed8 = torch.exp(-(delt_m7_m8) / (x_t1 + eps))
+        Ed10 = torch.exp(-(delt_m9_m10) / (x_t1 + eps))
+        Ed12 = torch.exp(-(delt_m11_m12) / (x_t1 + eps))
+        Ed14 = torch.exp(-(delt_m13_end) / (x_t1 + eps))
+        Eda = torch.exp(-(seq.crusher_after_t2prep) / (x_t1 + eps))
+        Edb = torch.exp(-(0.) / (x_t1 + eps))
+        x_t1_star = x_t1 * (1 / (1 - x_t1 * b1_terms.log_cos_flip_ang / esp))
+        x_m0_star = x_m0 * (1 - torch.exp(-esp / (x_t1 + eps))) / (1 - torch.exp(-esp / (x_t1_star + eps)))
+        Eetl = torch.exp(-etl / (x_t1_star + eps))
+
+        if self.steady_state == "iterative":
+            num_rep = 20 # number of repetitions to simulate to reach steady state
+            m_current = x_m0                                                                                # M0
+            for _ in range(num_rep):
+                m_current = x_m0 * (1 - Ed1) + m_current * Ed1                                              # M1 (del_t = 0.0607)
+                # m_current = m_current * ET2                                                               # M2, w/o b1 cor.
+                m_current = m_current * (b1_terms.sin2_t2_rad * ET2 + b1_terms.cos2_t2_rad * ET1)           # M2, w/ b1 cor.
+                m_current = x_m0 * (1 - Eda) + m_current * Eda                                              # M2 (del_t = 0.0097)
+                # current_img_acq1 = m_current                                                                ### Acq1
+                current_img_acq1 = m_current * sin_flip_ang                                                  ### Acq1
+                m_current = x_m0_star * (1 - Eetl) + m_current * Eetl                                       # M3 (del_t = 0.7296)
+                m_current = x_m0 * (1 - Ed4) + m_current * Ed4                                              # M4 (del_t = 0.1221)
+                m_current = -m_current * x_ie                                                               # M5
+                m_current = x_m0 * (1 - Ed6) + m_current * Ed6                                              # M6 (del_t = 0.0355)
+                m_current = x_m0 * (1 - Edb) + m_current * Edb                                              # M6 (del_t = 0)
+                # current_img_acq2 = m_current                                                                ### Acq2
+                current_img_acq2 = m_current * sin_flip_ang                                                  ### Acq2
+                m_current = x_m0_star * (1 - Eetl) + m_current * Eetl                                       # M7 (del_t = 0.7296)
+                m_current = x_m0 * (1 - Ed8) + m_current * Ed8                                              # M8 (del_t = 0.1704)
+                m_current = x_m0 * (1 - Edb) + m_current * Edb                                              # M8 (del_t = 0)
+                # current_img_acq3 = m_current                                                                ### Acq3
+                current_img_acq3 = m_current * sin_flip_ang                                                  ### Acq3
+                m_current = x_m0_star * (1 - Eetl) + m_current * Eetl                                       # M9 (del_t = 0.7296)
+                m_current = x_m0 * (1 - Ed10) + m_current * Ed10                                            # M10 (del_t = 0.1704)
+                m_current = x_m0 * (1 - Edb) + m_current * Edb                                              # M10 (del_t = 0)
+                # current_img_acq4 = m_current                                                                ### Acq4
+                current_img_acq4 = m_current * sin_flip_ang                                                  ### Acq4
+                m_current = x_m0_star * (1 - Eetl) + m_current * Eetl                                       # M11 (del_t = 0.7296)
+                m_current = x_m0 * (1 - Ed12) + m_current * Ed12                                            # M12 (del_t = 0.1704)
+                m_current = x_m0 * (1 - Edb) + m_current * Edb                                              # M12 (del_t = 0)
+                # current_img_acq5 = m_current                                                                ### Acq5
+                current_img_acq5 = m_current * sin_flip_ang                                                  ### Acq5
+                m_current = x_m0_star * (1 - Eetl) + m_current * Eetl                                       # M13 (del_t = 0.7296)
+                m_current = x_m0 * (1 - Ed14) + m_current * Ed14                                            # M14
+
+            # return torch.abs(current_img_acq1), torch.abs(current_img_acq2), torch.abs(current_img_acq3), torch.abs(current_img_acq4), torch.abs(current_img_acq5)
+            return current_img_acq1, current_img_acq2, current_img_acq3, current_img_acq4, current_img_acq5
+
+        # Every segment of the block is an affine map of the magnetization,
+        # m -> e * m + c, so the magnetization at any point of the block is
+        # a * m_start + b. Composing the whole block gives m_end = a * m_start + b,
+        # whose fixed point a * m_ss + b = m_ss is the steady state.
+        def relax(a, b, e, m_eq):
+            return a * e, b * e + m_eq * (1 - e)
+
+        a, b = torch.ones_like(x_m0), torch.zeros_like(x_m0)                                           # M0
+        a, b = relax(a, b, Ed1, x_m0)                                                                   # M1 (del_t = 0.0607)
+        E_t2_prep = b1_terms.sin2_t2_rad * ET2 + b1_terms.cos2_t2_rad * ET1                             # M2, w/ b1 cor.
+        a, b = a * E_t2_prep, b * E_t2_prep                                                                 # M2, w/ b1 cor.
+        a, b = relax(a, b, Eda, x_m0)                                                                   # M2 (del_t = 0.0097)
+        acq1 = (a, b)                                                                                   ### Acq1
+        a, b = relax(a, b, Eetl, x_m0_star)                                                             # M3 (del_t = 0.7296)
+        a, b = relax(a, b, Ed4, x_m0)                                                                   # M4 (del_t = 0.1221)
+        a, b = -a * x_ie, -b * x_ie                                                                     # M5
+        a, b = relax(a, b, Ed6, x_m0)                                                                   # M6 (del_t = 0.0355)
+        acq2 = (a, b)                                                                                   ### Acq2
+        a, b = relax(a, b, Eetl, x_m0_star)                                                             # M7 (del_t = 0.7296)
+        a, b = relax(a, b, Ed8, x_m0)                                                                   # M8 (del_t = 0.1704)
+        acq3 = (a, b)                                                                                   ### Acq3
+        a, b = relax(a, b, Eetl, x_m0_star)                                                             # M9 (del_t = 0.7296)
+        a, b = relax(a, b, Ed10, x_m0)                                                                  # M10 (del_t = 0.1704)
+        acq4 = (a, b)                                                                                   ### Acq4
+        a, b = relax(a, b, Eetl, x_m0_star)                                                             # M11 (del_t = 0.7296)
+        a, b = relax(a, b, Ed12, x_m0)                                                                  # M12 (del_t = 0.1704)
+        acq5 = (a, b)                                                                                   ### Acq5
+        a, b = relax(a, b, Eetl, x_m0_star)                                                             # M13 (del_t = 0.7296)
+        a, b = relax(a, b, Ed14, x_m0)                                                                  # M14
+
+        # the inversion makes a negative, so 1 - a stays away from zero
+        m_steady = b / (1 - a)
+        current_img_acq1, current_img_acq2, current_img_acq3, current_img_acq4, current_img_acq5 = [
+            (a_acq * m_steady + b_acq) * sin_flip_ang for a_acq, b_acq in (acq1, acq2, acq3, acq4, acq5)
+        ]
+
         return current_img_acq1, current_img_acq2, current_img_acq3, current_img_acq4, current_img_acq5
 
+    @torch.jit.unused
     def forward(
         self,
         init_map_t1: torch.Tensor,
@@ -386,9 +697,199 @@ class QALASBlock(nn.Module):
         init_map_pd: torch.Tensor,
         init_map_ie: torch.Tensor,
         init_map_b1: torch.Tensor,
+        b1_terms: Optional[B1Terms] = None,
+        seq_params: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
-
-        [init_img_acq1, init_img_acq2, init_img_acq3, init_img_acq4, init_img_acq5] = \
-            self.qalas_forward_eq(init_map_t1, init_map_t2, init_map_pd, init_map_ie, init_map_b1)
+        """
+        Args:
+            seq_params: Optional; Sequence parameters of shape
+                `(len(SEQUENCE_PARAM_FIELDS), ...)`, broadcastable against the
+                maps (e.g. `(F, B, 1, 1, 1)` for `(B, 1, H, W)` maps).
+                Defaults to the parameters of the block.
+        """
+        if self.forward_model == "lookup":
+            # the B1 terms are folded into the table
+            [init_img_acq1, init_img_acq2, init_img_acq3, init_img_acq4, init_img_acq5] = \
+                self.lookup_forward(init_map_t1, init_map_t2, init_map_pd, init_map_ie, init_map_b1, seq_params)
+        else:
+            if seq_params is not None:
+                seq_params = SequenceParams.from_tensor(seq_params.to(init_map_t1))
+            [init_img_acq1, init_img_acq2, init_img_acq3, init_img_acq4, init_img_acq5] = \
+                self.qalas_forward_eq(init_map_t1, init_map_t2, init_map_pd, init_map_ie, init_map_b1, b1_terms, seq_params)
 
         return init_img_acq1, init_img_acq2, init_img_acq3, init_img_acq4, init_img_acq5
+
+
+class QALASLookupTable:
+    """
+    Lookup-table approximation of the QALAS forward model.
+
+    The model is linear in PD, so the five readouts are simulated once with
+    `QALASBlock.qalas_forward_eq` (PD = 1) on a dense grid of T1 and T2
+    (log-spaced), IE and B1. At run time, they are evaluated by multilinear
+    interpolation between the 16 grid points around every voxel, like
+    `F.grid_sample` with border padding, and scaled by PD. Gradients flow
+    through the interpolation weights to T1, T2, IE and PD.
+
+    Tables are built once per set of sequence parameters and device, and the
+    `cache_size` most recently used ones are kept (about 32 MB each), see
+    `cached`. `approximation_error` compares the table to the analytic model.
+    """
+
+    # grid axes: (start, stop, size, log-spaced)
+    T1_AXIS = (0.01, 10.0, 96, True)
+    T2_AXIS = (0.001, 5.0, 96, True)
+    IE_AXIS = (0.5, 1.0, 6, False)
+    B1_AXIS = (0.3, 1.7, 29, False)
+
+    # maximum number of tables kept by `cached`, 0 to disable the cache
+    cache_size = 8
+
+    # least recently used tables, keyed by the numeric sequence parameters
+    # and the device
+    _tables: "OrderedDict[Tuple[Tuple[float, ...], str], QALASLookupTable]" = OrderedDict()
+
+    def __init__(self, seq_params: SequenceParams, table: Optional[torch.Tensor] = None):
+        """
+        Args:
+            seq_params: QALAS sequence parameters of the forward model.
+            table: Optional; Precomputed table of shape
+                `(T1, T2, IE, B1, 5)`, simulated if not given.
+        """
+        self.seq_params = seq_params
+        self.axes = (self.T1_AXIS, self.T2_AXIS, self.IE_AXIS, self.B1_AXIS)
+        self.table = self.simulate() if table is None else table
+
+        # flat index offsets of the 16 corners of a grid cell
+        strides = torch.tensor(self.table.shape[:4]).flip(0).cumprod(0).flip(0)[1:].tolist() + [1]
+        corners = torch.cartesian_prod(*[torch.tensor([0, 1])] * 4)
+        self.strides = strides
+        self.corner_offsets = (corners * torch.tensor(strides)).sum(1).to(self.table.device)
+        self.flat_table = self.table.reshape(-1, 5)
+
+    @staticmethod
+    def grid(axis: Tuple[float, float, int, bool]) -> torch.Tensor:
+        start, stop, size, log = axis
+        if log:
+            return torch.logspace(math.log10(start), math.log10(stop), size, dtype=torch.float64)
+
+        return torch.linspace(start, stop, size, dtype=torch.float64)
+
+    def simulate(self) -> torch.Tensor:
+        """
+        Simulate the readouts with PD = 1 on the whole grid, one B1 value at a
+        time.
+        """
+        block = QALASBlock(seq_params=self.seq_params)
+        # "ij"-indexed grids of T1, T2 and IE (meshgrid takes no indexing
+        # argument before torch 1.10)
+        grids = [self.grid(axis) for axis in self.axes[:3]]
+        t1, t2, ie = torch.cartesian_prod(*grids).reshape([len(grid) for grid in grids] + [3]).unbind(-1)
+
+        table = []
+        with torch.no_grad():
+            for b1 in self.grid(self.B1_AXIS):
+                signals = block.qalas_forward_eq(t1, t2, torch.ones_like(t1), ie, torch.full_like(t1, b1.item()))
+                table.append(torch.stack(signals, dim=-1))
+
+        return torch.stack(table, dim=3).float()
+
+    @classmethod
+    def cached(cls, seq_params: SequenceParams, device: Union[str, torch.device] = "cpu") -> "QALASLookupTable":
+        """
+        The table of the given sequence parameters on `device`, shared by all
+        QALASBlocks of the process while it is among the `cache_size` most
+        recently used ones. Parameters that only differ by their manufacturer
+        share a table.
+        """
+        device = torch.device(device)
+        numeric = tuple(float(getattr(seq_params, field)) for field in SEQUENCE_PARAM_FIELDS)
+        key = (numeric, str(device))
+        if key in cls._tables:
+            cls._tables.move_to_end(key)
+            return cls._tables[key]
+
+        # tables on other devices are copies of the CPU table
+        cpu_key = (numeric, "cpu")
+        if cpu_key in cls._tables:
+            cls._tables.move_to_end(cpu_key)
+            cpu_table = cls._tables[cpu_key]
+        else:
+            cpu_table = cls(seq_params)
+            cls._tables[cpu_key] = cpu_table
+        table = cpu_table if device.type == "cpu" else cls(seq_params, cpu_table.table.to(device))
+        cls._tables[key] = table
+
+        while len(cls._tables) > cls.cache_size:
+            cls._tables.popitem(last=False)
+
+        return table
+
+    def interpolate(self, x_t1: torch.Tensor, x_t2: torch.Tensor, x_ie: torch.Tensor, x_b1: torch.Tensor) -> torch.Tensor:
+        """
+        Readouts for PD = 1, of shape `(N, 5)` for `(N,)` parameters.
+        """
+        index = 0
+        fracs = []
+        for x, (start, stop, size, log), stride in zip((x_t1, x_t2, x_ie, x_b1), self.axes, self.strides):
+            if log:
+                coord = (torch.log(x.clamp(min=start)) - math.log(start)) / (math.log(stop / start) / (size - 1))
+            else:
+                coord = (x - start) / ((stop - start) / (size - 1))
+            coord = coord.clamp(0, size - 1)
+            lower = coord.detach().floor().clamp(max=size - 2)
+            fracs.append(coord - lower)
+            index = index + lower.long() * stride
+
+        # (N, 2, 2, 2, 2, 5) corners of the cell, then one linear
+        # interpolation per axis, from the last (B1) to the first (T1)
+        values = self.flat_table.index_select(0, (index.unsqueeze(-1) + self.corner_offsets).reshape(-1))
+        values = values.reshape(-1, 2, 2, 2, 2, 5)
+        for frac in reversed(fracs):
+            values = torch.lerp(values.select(-2, 0), values.select(-2, 1), frac.reshape((-1,) + (1,) * (values.dim() - 2)))
+
+        return values
+
+    def __call__(self, x_t1: torch.Tensor, x_t2: torch.Tensor, x_m0: torch.Tensor, x_ie: torch.Tensor, x_b1: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+        """
+        Same as `QALASBlock.qalas_forward_eq`, for maps of any (common) shape.
+        """
+        shape = x_t1.shape
+        x_b1 = x_b1.to(x_t1.device).expand(shape)
+        signals = self.interpolate(*[x.reshape(-1).to(self.table.dtype) for x in (x_t1, x_t2, x_ie, x_b1)])
+        signals = signals.to(x_t1.dtype) * x_m0.reshape(-1, 1)
+
+        return tuple(signal.reshape(shape) for signal in signals.unbind(-1))
+
+    def approximation_error(self, num_samples: int = 100000, seed: int = 0) -> Dict[str, float]:
+        """
+        Error of the table against the analytic model.
+
+        T1 and T2 (T2 <= T1) are sampled log-uniformly, IE and B1 uniformly
+        inside the grid, and the error of a sample is the norm of the error of
+        its five readouts relative to their norm.
+
+        Returns:
+            A dict with the mean, 99th percentile and max relative errors.
+        """
+        generator = torch.Generator().manual_seed(seed)
+        samples = []
+        for start, stop, _, log in self.axes:
+            u = torch.rand(num_samples, generator=generator, dtype=torch.float64)
+            samples.append(start * (stop / start) ** u if log else start + (stop - start) * u)
+        x_t1, x_t2, x_ie, x_b1 = samples
+        x_t2 = torch.minimum(x_t2, x_t1)
+
+        with torch.no_grad():
+            exact = torch.stack(
+                QALASBlock(seq_params=self.seq_params).qalas_forward_eq(x_t1, x_t2, torch.ones_like(x_t1), x_ie, x_b1),
+                dim=-1,
+            )
+            approx = self.interpolate(*[x.to(self.table.device, self.table.dtype) for x in (x_t1, x_t2, x_ie, x_b1)])
+
+        error = torch.linalg.norm(approx.cpu().double() - exact, dim=-1) / torch.linalg.norm(exact, dim=-1)
+        return {
+            "mean": error.mean().item(),
+            "p99": torch.quantile(error.float(), 0.99).item(),
+            "max": error.max().item(),
+        }
@@ -4,4 +4,8 @@ from .unet_module import UnetModule
 from .data_module import FastMriDataModule
 from .data_module_qalas import FastMriDataModuleQALAS
 # from .qalas_module import QALASModule
-from .qalas_map_module import QALAS_MAPModule
\ No newline at end of file
+from .qalas_map_module import QALAS_MAPModule
+from .qalas_pretrain_module import QALASPretrainModule
+from .callbacks_qalas import ConvergenceStoppingQALAS, update_run_summary
+from .warm_start_qalas import find_warm_start_checkpoint, load_maps_net
+from .grouped_qalas import split_grouped_checkpoint
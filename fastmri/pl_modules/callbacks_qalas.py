@@ -0,0 +1,307 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import json
+import math
+import os
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+import pytorch_lightning as pl
+import torch
+
+
+def update_run_summary(fname: Union[str, Path, os.PathLike], entries: Dict):
+    """
+    Merge entries into the JSON run summary of a training run.
+
+    Args:
+        fname: Path to the run summary, created if it does not exist.
+        entries: Entries to add to (or replace in) the summary.
+    """
+    fname = Path(fname)
+    summary = dict()
+    if fname.exists():
+        with open(fname, "r") as f:
+            summary = json.load(f)
+
+    summary.update(entries)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    with open(fname, "w") as f:
+        json.dump(summary, f, indent=4)
+
+
+def _find_loss(outputs) -> Optional[torch.Tensor]:
+    # on_train_batch_end receives the training_step outputs nested per
+    # optimizer and truncated backprop step
+    if isinstance(outputs, torch.Tensor):
+        return outputs
+    if isinstance(outputs, dict):
+        return _find_loss(outputs.get("loss"))
+    if isinstance(outputs, (list, tuple)):
+        for output in outputs:
+            loss = _find_loss(output)
+            if loss is not None:
+                return loss
+    return None
+
+
+class ConvergenceStoppingQALAS(pl.Callback):
+    """
+    Stop the per-subject training of QALAS_MAPModule once it has converged.
+
+    At each validation check (at the end of the training epoch in the
+    train_as_val mode of the module), the training image loss (averaged over the
+    steps since the previous check) and the validation image loss are
+    smoothed with an exponential moving average and compared to their
+    values at the previous check. Together with the relative change of the
+    predicted T1 and T2 maps logged by the module
+    (`val_metrics/map_change_t1` and `val_metrics/map_change_t2`), training
+    stops when all four quantities stay under their tolerances for
+    `patience` consecutive checks. The stop reason and the number of
+    trained epochs are written to the run summary at the end of training.
+    The state of the callback is saved with the checkpoints, so that a
+    resumed run keeps its moving averages, patience and history.
+
+    Args:
+        train_loss_tol: Tolerance on the relative change of the smoothed
+            training image loss.
+        val_loss_tol: Tolerance on the relative change of the smoothed
+            validation image loss.
+        map_change_tol: Tolerance on the relative change of the T1 and T2
+            maps.
+        smoothing: Weight of the previous value in the moving average (0
+            disables smoothing).
+        patience: Number of consecutive converged checks before stopping.
+        min_epochs: Never stop before this number of epochs.
+        summary_file: Path to the JSON run summary. Defaults to
+            `run_summary.json` in the trainer's `default_root_dir`.
+    """
+
+    def __init__(
+        self,
+        train_loss_tol: float = 1e-3,
+        val_loss_tol: float = 1e-3,
+        map_change_tol: float = 1e-3,
+        smoothing: float = 0.5,
+        patience: int = 2,
+        min_epochs: int = 0,
+        summary_file: Optional[Union[str, Path, os.PathLike]] = None,
+    ):
+        super().__init__()
+
+        if not 0 <= smoothing < 1:
+            raise ValueError("smoothing should be in [0, 1).")
+
+        self.train_loss_tol = train_loss_tol
+        self.val_loss_tol = val_loss_tol
+        self.map_change_tol = map_change_tol
+        self.smoothing = smoothing
+        self.patience = patience
+        self.min_epochs = min_epochs
+        self.summary_file = summary_file
+
+        self.train_loss_sum = 0.0
+        self.train_loss_steps = 0
+        self.smoothed_train_loss = None
+        self.smoothed_val_loss = None
+        self.wait = 0
+        self.stop_reason = None
+        self.stopped_epoch = None
+        self.history = []
+        self.start_time = None
+
+    def _smooth(self, previous: Optional[float], value: float) -> float:
+        if previous is None:
+            return value
+        return self.smoothing * previous + (1 - self.smoothing) * value
+
+    @staticmethod
+    def _relative_change(previous: Optional[float], value: float) -> float:
+        if previous is None or previous == 0:
+            return float("inf")
+        return abs(value - previous) / abs(previous)
+
+    def on_train_start(self, trainer, pl_module):
+        self.start_time = time.perf_counter()
+
+    def on_save_checkpoint(self, trainer, pl_module, checkpoint) -> Dict[str, Any]:
+        return {
+            "train_loss_sum": self.train_loss_sum,
+            "train_loss_steps": self.train_loss_steps,
+            "smoothed_train_loss": self.smoothed_train_loss,
+            "smoothed_val_loss": self.smoothed_val_loss,
+            "wait": self.wait,
+            "history": self.history,
+        }
+
+    def on_load_checkpoint(self, trainer, pl_module, callback_state: Dict[str, Any]):
+        self.train_loss_sum = callback_state["train_loss_sum"]
+        self.train_loss_steps = callback_state["train_loss_steps"]
+        self.smoothed_train_loss = callback_state["smoothed_train_loss"]
+        self.smoothed_val_loss = callback_state["smoothed_val_loss"]
+        self.wait = callback_state["wait"]
+        self.history = callback_state["history"]
+
+    def on_train_batch_end(
+        self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx
+    ):
+        loss = _find_loss(outputs)
+        if loss is not None:
+            self.train_loss_sum += float(loss.detach())
+            self.train_loss_steps += 1
+
+    def on_train_epoch_end(self, trainer, pl_module, unused=None):
+        # in train_as_val mode, the validation metrics are logged at the end
+        # of the training epoch instead of by a validation loop
+        if getattr(pl_module, "train_as_val", False) and pl_module.collect_train_as_val():
+            self._check(trainer)
+
+    def on_validation_end(self, trainer, pl_module):
+        if trainer.sanity_checking:
+            return
+
+        self._check(trainer)
+
+    def _check(self, trainer):
+        if self.train_loss_steps == 0:
+            return
+
+        metrics = trainer.callback_metrics
+        if "validation_loss" not in metrics:
+            return
+
+        train_loss = self.train_loss_sum / self.train_loss_steps
+        self.train_loss_sum = 0.0
+        self.train_loss_steps = 0
+        val_loss = float(metrics["validation_loss"])
+
+        smoothed_train_loss = self._smooth(self.smoothed_train_loss, train_loss)
+        smoothed_val_loss = self._smooth(self.smoothed_val_loss, val_loss)
+        changes = {
+            "train_loss": self._relative_change(self.smoothed_train_loss, smoothed_train_loss),
+            "val_loss": self._relative_change(self.smoothed_val_loss, smoothed_val_loss),
+            "map_t1": float(metrics.get("val_metrics/map_change_t1", float("inf"))),
+            "map_t2": float(metrics.get("val_metrics/map_change_t2", float("inf"))),
+        }
+        self.smoothed_train_loss = smoothed_train_loss
+        self.smoothed_val_loss = smoothed_val_loss
+
+        converged = (
+            changes["train_loss"] <= self.train_loss_tol
+            and changes["val_loss"] <= self.val_loss_tol
+            and changes["map_t1"] <= self.map_change_tol
+            and changes["map_t2"] <= self.map_change_tol
+        )
+        self.wait = self.wait + 1 if converged else 0
+
+        epoch = trainer.current_epoch + 1
+        self.history.append(
+            {
+                "epoch": epoch,
+                "smoothed_train_loss": smoothed_train_loss,
+                "smoothed_val_loss": smoothed_val_loss,
+                # changes are unknown (inf) at the first check
+                "relative_change": {
+                    k: v if math.isfinite(v) else None for k, v in changes.items()
+                },
+            }
+        )
+
+        should_stop = self.wait >= self.patience and epoch >= self.min_epochs
+        should_stop = trainer.training_type_plugin.reduce_boolean_decision(should_stop)
+        if should_stop:
+            trainer.should_stop = True
+            self.stop_reason = "converged"
+            self.stopped_epoch = epoch
+
+    def on_train_end(self, trainer, pl_module):
+        epochs = trainer.current_epoch + 1
+        if self.stop_reason is None:
+            if epochs >= trainer.max_epochs:
+                self.stop_reason = "max_epochs"
+            else:
+                self.stop_reason = "interrupted"
+
+        if not trainer.is_global_zero:
+            return
+
+        summary_file = self.summary_file
+        if summary_file is None:
+            summary_file = Path(trainer.default_root_dir) / "run_summary.json"
+        update_run_summary(
+            summary_file,
+            {
+                "stop_reason": self.stop_reason,
+                "epochs": epochs,
+                "max_epochs": trainer.max_epochs,
+                "stopped_epoch": self.stopped_epoch,
+                "train_time_s": time.perf_counter() - self.start_time,
+                "convergence_tolerances": {
+                    "train_loss": self.train_loss_tol,
+                    "val_loss": self.val_loss_tol,
+                    "map_change": self.map_change_tol,
+                    "smoothing": self.smoothing,
+                    "patience": self.patience,
+                    "min_epochs": self.min_epochs,
+                },
+                "convergence_history": self.history,
+            },
+        )
+
+    @staticmethod
+    def add_callback_specific_args(parent_parser):  # pragma: no-cover
+        """
+        Define parameters that only apply to this callback
+        """
+        parser = ArgumentParser(parents=[parent_parser], add_help=False)
+
+        parser.add_argument(
+            "--convergence_stopping",
+            action="store_true",
+            help="Stop training once the losses and the T1/T2 maps have converged",
+        )
+        parser.add_argument(
+            "--train_loss_tol",
+            default=1e-3,
+            type=float,
+            help="Tolerance on the relative change of the smoothed training image loss",
+        )
+        parser.add_argument(
+            "--val_loss_tol",
+            default=1e-3,
+            type=float,
+            help="Tolerance on the relative change of the smoothed validation image loss",
+        )
+        parser.add_argument(
+            "--map_change_tol",
+            default=1e-3,
+            type=float,
+            help="Tolerance on the relative change of the T1 and T2 maps between checks",
+        )
+        parser.add_argument(
+            "--loss_smoothing",
+            default=0.5,
+            type=float,
+            help="Weight of the previous value in the moving average of the losses",
+        )
+        parser.add_argument(
+            "--convergence_patience",
+            default=2,
+            type=int,
+            help="Number of consecutive converged validation checks before stopping",
+        )
+        parser.add_argument(
+            "--convergence_min_epochs",
+            default=0,
+            type=int,
+            help="Never stop before this number of epochs",
+        )
+
+        return parser
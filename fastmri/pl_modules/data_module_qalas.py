@@ -7,19 +7,26 @@ LICENSE file in the root directory of this source tree.
 
 from argparse import ArgumentParser
 from pathlib import Path
-from typing import Callable, Optional, Union
+from typing import Callable, List, Optional, Sequence, Union
 
 import fastmri
 import pytorch_lightning as pl
 import torch
-from fastmri.data import CombinedSliceDatasetQALAS, SliceDatasetQALAS
+from fastmri.data import (
+    CombinedSliceDatasetQALAS,
+    GroupedSliceDatasetQALAS,
+    SliceDatasetQALAS,
+    collate_grouped_qalas,
+    collate_qalas,
+    session_name_qalas,
+)
 
 
 def worker_init_fn(worker_id):
     """Handle random seeding for all mask_func."""
     worker_info = torch.utils.data.get_worker_info()
     data: Union[
-        SliceDatasetQALAS, CombinedSliceDatasetQALAS
+        SliceDatasetQALAS, CombinedSliceDatasetQALAS, GroupedSliceDatasetQALAS
     ] = worker_info.dataset  # pylint: disable=no-member
 
     # Check if we are using DDP
@@ -31,7 +38,7 @@ def worker_init_fn(worker_id):
     # for NumPy random seed we need it to be in this range
     base_seed = worker_info.seed  # pylint: disable=no-member
 
-    if isinstance(data, CombinedSliceDatasetQALAS):
+    if isinstance(data, (CombinedSliceDatasetQALAS, GroupedSliceDatasetQALAS)):
         for i, dataset in enumerate(data.datasets):
             if dataset.transform.mask_func_acq1 is not None:
                 if (
@@ -99,6 +106,9 @@ class FastMriDataModuleQALAS(pl.LightningDataModule):
         batch_size: int = 1,
         num_workers: int = 4,
         distributed_sampler: bool = False,
+        preload: bool = False,
+        sessions: Optional[Sequence[Path]] = None,
+        grouped: bool = False,
     ):
         """
         Args:
@@ -128,6 +138,17 @@ class FastMriDataModuleQALAS(pl.LightningDataModule):
             num_workers: Number of workers for PyTorch dataloader.
             distributed_sampler: Whether to use a distributed sampler. This
                 should be set to True if training with ddp.
+            preload: Whether to read the volumes into shared memory once
+                instead of reading every slice from the HDF5 files.
+            sessions: Optional; Session directories (see
+                `find_sessions_qalas`) to train on jointly. Every split then
+                combines the splits of all sessions, read slice by slice
+                through a shared, bounded HDF5 file cache, and data_path is
+                ignored.
+            grouped: Whether to serve the sessions side by side instead of
+                mixed, for one mapping network per session (see
+                `GroupedSliceDatasetQALAS`). Every batch then holds
+                batch_size slices of each session.
         """
         super().__init__()
 
@@ -145,6 +166,9 @@ class FastMriDataModuleQALAS(pl.LightningDataModule):
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.distributed_sampler = distributed_sampler
+        self.preload = preload
+        self.sessions = sessions
+        self.grouped = grouped
 
     def _create_data_loader(
         self,
@@ -167,8 +191,21 @@ class FastMriDataModuleQALAS(pl.LightningDataModule):
             volume_sample_rate = None  # default case, no subsampling
 
         # if desired, combine train and val together for the train split
-        dataset: Union[SliceDatasetQALAS, CombinedSliceDatasetQALAS]
-        if is_train and self.combine_train_val:
+        dataset: Union[SliceDatasetQALAS, CombinedSliceDatasetQALAS, GroupedSliceDatasetQALAS]
+        collate_fn = collate_qalas
+        if self.sessions is not None and not (data_partition in ("test", "challenge") and self.test_path is not None):
+            partitions = [data_partition, "val"] if is_train and self.combine_train_val else [data_partition]
+            if self.grouped:
+                dataset = GroupedSliceDatasetQALAS(
+                    [
+                        self._sessions_dataset(partitions, data_transform, sample_rate, volume_sample_rate, [session])
+                        for session in self.sessions
+                    ]
+                )
+                collate_fn = collate_grouped_qalas
+            else:
+                dataset = self._sessions_dataset(partitions, data_transform, sample_rate, volume_sample_rate)
+        elif is_train and self.combine_train_val:
             data_paths = [
                 self.data_path / f"{self.challenge}_train",
                 self.data_path / f"{self.challenge}_val",
@@ -187,6 +224,7 @@ class FastMriDataModuleQALAS(pl.LightningDataModule):
                 sample_rates=sample_rates,
                 volume_sample_rates=volume_sample_rates,
                 use_dataset_cache=self.use_dataset_cache_file,
+                preload=self.preload,
             )
         else:
             if data_partition in ("test", "challenge") and self.test_path is not None:
@@ -201,6 +239,7 @@ class FastMriDataModuleQALAS(pl.LightningDataModule):
                 volume_sample_rate=volume_sample_rate,
                 challenge=self.challenge,
                 use_dataset_cache=self.use_dataset_cache_file,
+                preload=self.preload,
             )
 
         # ensure that entire volumes go to the same GPU in the ddp setting
@@ -209,23 +248,56 @@ class FastMriDataModuleQALAS(pl.LightningDataModule):
             if is_train:
                 sampler = torch.utils.data.DistributedSampler(dataset)
             else:
-                sampler = fastmri.data.VolumeSampler(dataset, shuffle=False)
+                sampler = fastmri.data.VolumeSamplerQALAS(dataset, shuffle=False)
 
         dataloader = torch.utils.data.DataLoader(
             dataset=dataset,
             batch_size=self.batch_size,
             num_workers=self.num_workers,
             worker_init_fn=worker_init_fn,
+            collate_fn=collate_fn,
             sampler=sampler,
             shuffle=is_train if sampler is None else False,
         )
 
         return dataloader
 
+    def _sessions_dataset(
+        self,
+        partitions: List[str],
+        data_transform: Callable,
+        sample_rate: Optional[float] = None,
+        volume_sample_rate: Optional[float] = None,
+        sessions: Optional[Sequence[Path]] = None,
+    ) -> CombinedSliceDatasetQALAS:
+        sessions = self.sessions if sessions is None else sessions
+        roots = [
+            session / f"{self.challenge}_{partition}"
+            for session in sessions
+            for partition in partitions
+        ]
+        name_prefixes = [
+            f"{session_name_qalas(session, self.data_path)}/" for session in sessions for _ in partitions
+        ]
+
+        return CombinedSliceDatasetQALAS(
+            roots=roots,
+            transforms=[data_transform] * len(roots),
+            challenges=[self.challenge] * len(roots),
+            sample_rates=None if sample_rate is None else [sample_rate] * len(roots),
+            volume_sample_rates=None if volume_sample_rate is None else [volume_sample_rate] * len(roots),
+            use_dataset_cache=self.use_dataset_cache_file,
+            preload=self.preload,
+            name_prefixes=name_prefixes,
+        )
+
     def prepare_data(self):
         # call dataset for each split one time to make sure the cache is set up on the
         # rank 0 ddp process. if not using cache, don't do this
-        if self.use_dataset_cache_file:
+        if self.use_dataset_cache_file and self.sessions is not None:
+            _ = self._sessions_dataset(["train"], self.train_transform, self.sample_rate, self.volume_sample_rate)
+            _ = self._sessions_dataset(["val"], self.val_transform, 1.0)
+        elif self.use_dataset_cache_file:
             if self.test_path is not None:
                 test_path = self.test_path
             else:
@@ -327,6 +399,12 @@ class FastMriDataModuleQALAS(pl.LightningDataModule):
             type=bool,
             help="Whether to combine train and val splits for training",
         )
+        parser.add_argument(
+            "--preload",
+            default=False,
+            action="store_true",
+            help="Read the volumes into shared memory once instead of every slice from disk",
+        )
 
         # data loader arguments
         parser.add_argument(
@@ -0,0 +1,76 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import os
+from pathlib import Path
+from typing import List, Sequence, Union
+
+import torch
+from fastmri.data import SequenceParams
+from fastmri.models import CNN
+
+
+def split_grouped_checkpoint(
+    checkpoint_file: Union[str, Path, os.PathLike],
+    checkpoint_dirs: Sequence[Union[str, Path, os.PathLike]],
+    seq_params: Sequence[SequenceParams],
+) -> List[Path]:
+    """
+    Split the checkpoint of a grouped QALAS_MAPModule (`num_models > 1`)
+    into one QALAS_MAPModule checkpoint per mapping network.
+
+    Checkpoint k holds the k-th chunk of the mapping network weights, and the
+    hyperparameters of the grouped run with the sequence parameters of
+    session k, so it is used like the checkpoint of a single-session run,
+    e.g. by inference_qalas_map.py or as --init_from. The optimizer state is
+    not kept.
+
+    Args:
+        checkpoint_file: Checkpoint of a grouped run.
+        checkpoint_dirs: Checkpoint directory of every mapping network, in
+            model order.
+        seq_params: Sequence parameters of every mapping network, in model
+            order.
+
+    Returns:
+        The paths of the checkpoints, in model order.
+    """
+    checkpoint_file = Path(checkpoint_file)
+    checkpoint = torch.load(checkpoint_file, map_location="cpu")
+    hparams = dict(checkpoint["hyper_parameters"])
+    num_models = hparams.get("num_models", 1)
+    if not len(checkpoint_dirs) == len(seq_params) == num_models:
+        raise ValueError(
+            f"{checkpoint_file} has {num_models} mapping networks, got {len(checkpoint_dirs)} "
+            f"directories and {len(seq_params)} sequence parameters."
+        )
+
+    prefix = "qalas.maps_net.cnn."
+    shared = {k: v for k, v in checkpoint["state_dict"].items() if not k.startswith(prefix)}
+    states = CNN.split_state_dict(
+        {k[len(prefix) :]: v for k, v in checkpoint["state_dict"].items() if k.startswith(prefix)},
+        num_models,
+    )
+
+    out_files = []
+    for checkpoint_dir, params, state in zip(checkpoint_dirs, seq_params, states):
+        checkpoint_dir = Path(checkpoint_dir)
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+
+        model_checkpoint = {
+            key: checkpoint[key]
+            for key in ("epoch", "global_step", "pytorch-lightning_version")
+            if key in checkpoint
+        }
+        model_checkpoint["state_dict"] = dict(shared, **{prefix + k: v for k, v in state.items()})
+        model_checkpoint["hyper_parameters"] = dict(hparams, num_models=1, seq_params=params._asdict())
+
+        out_file = checkpoint_dir / checkpoint_file.name
+        torch.save(model_checkpoint, out_file)
+        out_files.append(out_file)
+
+    return out_files
@@ -13,23 +13,176 @@ import fastmri
 import numpy as np
 import pytorch_lightning as pl
 import torch
-from fastmri import evaluate
+from fastmri.losses import SSIMLoss
 from torchmetrics.metric import Metric
 
 
 class DistributedMetricSum(Metric):
-    def __init__(self, dist_sync_on_step=True):
+    def __init__(self, dist_sync_on_step=False):
         super().__init__(dist_sync_on_step=dist_sync_on_step)
 
         self.add_state("quantity", default=torch.tensor(0.0), dist_reduce_fx="sum")
 
     def update(self, batch: torch.Tensor):  # type: ignore
-        self.quantity += batch
+        # out of place, so that the sum can be a vector of several metrics
+        self.quantity = self.quantity + batch
 
     def compute(self):
         return self.quantity
 
 
+class VolumeMetricsQALAS:
+    """
+    Validation metrics of the QALAS maps and images, accumulated per volume.
+
+    The metrics of a batch are computed in one batched call for the T1, T2
+    and PD maps and the five images (`KEYS`): for every slice, the MSE, the
+    energy of the target (for the NMSE), the SSIM (with the kernel of
+    `SSIMLoss`), the maximum of the target (for the PSNR), and the change of
+    the T1 and T2 maps since the previous validation check (`STATS`). They
+    are written to a `(num_slices, len(STATS), len(KEYS))` tensor per volume,
+    indexed by slice number, so that the duplicate slices of ddp overwrite
+    each other. The tensors are released at the reset of every check.
+
+    The T1 and T2 maps kept for the map change are stored as float16 on the
+    CPU, for the first `max_change_volumes` volumes only, so that memory does
+    not grow with the number of validation volumes (e.g. in joint training
+    over many sessions). The map change is measured on these volumes, and
+    the volumes missing from a check are dropped at its reset.
+    """
+
+    KEYS = ("t1", "t2", "pd", "img1", "img2", "img3", "img4", "img5")
+    STATS = ("mse", "target_norm", "ssim", "max_value", "map_change", "map_norm")
+
+    def __init__(self, max_change_volumes: int = 64):
+        """
+        Args:
+            max_change_volumes: Maximum number of volumes whose maps are kept
+                to measure the map change.
+        """
+        self.max_change_volumes = max_change_volumes
+        self.ssim_loss = SSIMLoss()
+        self.stats = dict()
+        self.filled = dict()
+        # T1/T2 maps of the previous validation check (float16, CPU)
+        self.prev_maps = dict()
+        self.prev_filled = dict()
+
+    @staticmethod
+    def _volume(tensors, fname, num_slices, shape, dtype, device):
+        # tensor of a volume, grown to hold at least num_slices slices
+        tensor = tensors.get(fname)
+        if tensor is None or tensor.shape[0] < num_slices:
+            grown = torch.zeros((num_slices,) + tuple(shape), dtype=dtype, device=device)
+            if tensor is not None:
+                grown[: tensor.shape[0]] = tensor
+            tensors[fname] = tensor = grown
+
+        return tensor
+
+    def update(self, fnames, slice_nums, outputs, targets, max_values, track_changes=True):
+        """
+        Compute the metrics of a batch.
+
+        Args:
+            fnames: File name of every slice.
+            slice_nums: Slice numbers, shape `(B,)`.
+            outputs: Masked output maps and images, shape
+                `(B, len(KEYS), H, W)`.
+            targets: Masked target maps and images, shape
+                `(B, len(KEYS), H, W)`.
+            max_values: Maximum value of the T1, T2 and PD maps, shape
+                `(B, 3)`. The images use the maximum of their target.
+            track_changes: Whether to compute the change of the T1 and T2
+                maps since the previous check of the slices.
+        """
+        batch_size, num_keys = outputs.shape[:2]
+        outputs = outputs.double()
+        targets = targets.double()
+
+        # the PD maps are compared up to their scaling
+        outputs = torch.cat((outputs[:, :2], outputs[:, 2:3] / outputs[:, 2:3].amax(dim=(-2, -1), keepdim=True), outputs[:, 3:]), 1)
+        targets = torch.cat((targets[:, :2], targets[:, 2:3] / targets[:, 2:3].amax(dim=(-2, -1), keepdim=True), targets[:, 3:]), 1)
+        max_values = torch.cat((max_values.to(targets).reshape(batch_size, 3), targets[:, 3:].amax(dim=(-2, -1))), 1)
+
+        self.ssim_loss.to(outputs)
+        ssim = 1 - self.ssim_loss(
+            targets.flatten(0, 1).unsqueeze(1),
+            outputs.flatten(0, 1).unsqueeze(1),
+            max_values.flatten(),
+            reduced=False,
+        ).mean(dim=(1, 2, 3))
+
+        mse = torch.mean((targets - outputs) ** 2, dim=(-2, -1))
+        stats = torch.stack(
+            (
+                mse,
+                torch.mean(targets ** 2, dim=(-2, -1)),
+                ssim.view(batch_size, num_keys),
+                max_values,
+                torch.zeros_like(mse),
+                torch.zeros_like(mse),
+            ),
+            1,
+        )
+
+        if track_changes:
+            maps_cpu = outputs[:, :2].to("cpu", torch.float16)
+
+        for i, (fname, slice_num) in enumerate(zip(fnames, slice_nums.tolist())):
+            if track_changes and (fname in self.prev_maps or len(self.prev_maps) < self.max_change_volumes):
+                maps = outputs[i, :2]
+                prev_maps = self._volume(self.prev_maps, fname, slice_num + 1, maps.shape, torch.float16, "cpu")
+                prev_filled = self._volume(self.prev_filled, fname, slice_num + 1, (), torch.bool, "cpu")
+                if prev_filled[slice_num]:
+                    prev = prev_maps[slice_num].to(maps)
+                    stats[i, 4, :2] = torch.sum((maps - prev) ** 2, dim=(-2, -1))
+                    stats[i, 5, :2] = torch.sum(prev ** 2, dim=(-2, -1))
+                prev_maps[slice_num] = maps_cpu[i]
+                prev_filled[slice_num] = True
+
+            self._volume(self.stats, fname, slice_num + 1, stats.shape[1:], stats.dtype, stats.device)[slice_num] = stats[i]
+            self._volume(self.filled, fname, slice_num + 1, (), torch.bool, stats.device)[slice_num] = True
+
+    def compute(self):
+        """
+        Sum the metrics of the volumes.
+
+        Returns:
+            A dict of `(len(KEYS),)` tensors with the sums over the volumes of
+            the NMSE, SSIM and PSNR ("nmse", "ssim", "psnr"), and the sums over
+            the slices of the map changes and of the previous map norms
+            ("map_change", "map_norm"), and the number of volumes.
+        """
+        volumes = [stats[self.filled[fname]] for fname, stats in self.stats.items() if self.filled[fname].any()]
+        if not volumes:
+            zeros = torch.zeros(len(self.KEYS), dtype=torch.float64)
+            return {"nmse": zeros, "ssim": zeros, "psnr": zeros, "map_change": zeros, "map_norm": zeros}, 0
+
+        means = torch.stack([stats.mean(dim=0) for stats in volumes])
+        max_values = torch.stack([stats[:, 3].amax(dim=0) for stats in volumes])
+        sums = torch.stack([stats.sum(dim=0) for stats in volumes]).sum(dim=0)
+
+        metrics = {
+            "nmse": torch.sum(means[:, 0] / means[:, 1], dim=0),
+            "ssim": torch.sum(means[:, 2], dim=0),
+            "psnr": torch.sum(20 * torch.log10(max_values) - 10 * torch.log10(means[:, 0]), dim=0),
+            "map_change": sums[4],
+            "map_norm": sums[5],
+        }
+
+        return metrics, len(volumes)
+
+    def reset(self):
+        for fname in list(self.prev_maps):
+            if fname not in self.filled or not self.filled[fname].any():
+                # not seen by this check, its previous maps are stale
+                del self.prev_maps[fname], self.prev_filled[fname]
+
+        self.stats = dict()
+        self.filled = dict()
+
+
 class MriModuleQALAS_MAP(pl.LightningModule):
     """
     Abstract super class for deep larning reconstruction models.
@@ -50,22 +203,67 @@ class MriModuleQALAS_MAP(pl.LightningModule):
     Other methods from LightningModule can be overridden as needed.
     """
 
-    def __init__(self, num_log_images: int = 4):
+    def __init__(self, num_log_images: int = 4, train_as_val: bool = False, max_change_volumes: int = 64):
         """
         Args:
             num_log_images: Number of images to log. Defaults to 16.
+            train_as_val: Whether to compute the validation metrics from the
+                outputs of the training steps instead of a validation loop
+                (see `collect_train_as_val`).
+            max_change_volumes: Number of validation volumes (per process)
+                whose T1 and T2 maps are kept to measure their change between
+                checks (see `VolumeMetricsQALAS`).
         """
         super().__init__()
 
         self.num_log_images = num_log_images
+        self.train_as_val = train_as_val
         self.val_log_indices = None
 
+        # validation logs of the training steps of the epoch, in train_as_val
+        # mode
+        self.train_val_logs = []
+
         self.NMSE = DistributedMetricSum()
         self.SSIM = DistributedMetricSum()
         self.PSNR = DistributedMetricSum()
         self.ValLoss = DistributedMetricSum()
         self.TotExamples = DistributedMetricSum()
         self.TotSliceExamples = DistributedMetricSum()
+        self.MapChangeT1 = DistributedMetricSum()
+        self.MapChangeT2 = DistributedMetricSum()
+        self.MapNormT1 = DistributedMetricSum()
+        self.MapNormT2 = DistributedMetricSum()
+
+        self.volume_metrics = VolumeMetricsQALAS(max_change_volumes)
+
+    def add_to_queue(self, queue):
+        # ddp_cpu trains in spawned processes: send the epoch count back to
+        # the main process with the metrics, e.g. for the run summary
+        super().add_to_queue(queue)
+        queue.put(self.trainer.current_epoch)
+
+    def get_from_queue(self, queue):
+        super().get_from_queue(queue)
+        self.trainer.fit_loop.current_epoch = queue.get()
+
+    def collect_train_as_val(self) -> bool:
+        """
+        Whether the training steps of the current epoch collect validation
+        logs.
+
+        The validation split of a session is a copy of its training split
+        (see ssl_qalas_save_h5.m). In train_as_val mode there is no
+        validation loop: every `check_val_every_n_epoch` epochs, the
+        validation metrics are computed from the outputs of the training
+        steps, and logged at the end of the training epoch.
+        """
+        return self.train_as_val and (self.current_epoch + 1) % self.trainer.check_val_every_n_epoch == 0
+
+    def training_epoch_end(self, outputs):
+        if self.train_val_logs:
+            self.validation_epoch_end(self.train_val_logs)
+            self.train_val_logs = []
 
     def validation_step_end(self, val_logs):
         # check inputs
@@ -187,8 +385,12 @@ class MriModuleQALAS_MAP(pl.LightningModule):
 
         # pick a set of images to log if we don't have one already
         if self.val_log_indices is None:
+            if self.train_as_val:
+                num_batches = self.trainer.num_training_batches
+            else:
+                num_batches = len(self.trainer.val_dataloaders[0])
             self.val_log_indices = list(
-                np.random.permutation(len(self.trainer.val_dataloaders[0]))[
+                np.random.permutation(num_batches)[
                     : self.num_log_images
                 ]
             )
@@ -266,142 +468,14 @@ class MriModuleQALAS_MAP(pl.LightningModule):
                 self.log_image(f"{key}/error_init_forward", torch.cat((error_img1,error_img2,error_img3,error_img4,error_img5),-1))
 
         # compute evaluation metrics
-        mse_vals_t1 = defaultdict(dict)
-        mse_vals_t2 = defaultdict(dict)
-        mse_vals_pd = defaultdict(dict)
-        mse_vals_img1 = defaultdict(dict)
-        mse_vals_img2 = defaultdict(dict)
-        mse_vals_img3 = defaultdict(dict)
-        mse_vals_img4 = defaultdict(dict)
-        mse_vals_img5 = defaultdict(dict)
-        target_norms_t1 = defaultdict(dict)
-        target_norms_t2 = defaultdict(dict)
-        target_norms_pd = defaultdict(dict)
-        target_norms_img1 = defaultdict(dict)
-        target_norms_img2 = defaultdict(dict)
-        target_norms_img3 = defaultdict(dict)
-        target_norms_img4 = defaultdict(dict)
-        target_norms_img5 = defaultdict(dict)
-        ssim_vals_t1 = defaultdict(dict)
-        ssim_vals_t2 = defaultdict(dict)
-        ssim_vals_pd = defaultdict(dict)
-        ssim_vals_img1 = defaultdict(dict)
-        ssim_vals_img2 = defaultdict(dict)
-        ssim_vals_img3 = defaultdict(dict)
-        ssim_vals_img4 = defaultdict(dict)
-        ssim_vals_img5 = defaultdict(dict)
-        max_vals_t1 = dict()
-        max_vals_t2 = dict()
-        max_vals_pd = dict()
-        max_vals_img1 = dict()
-        max_vals_img2 = dict()
-        max_vals_img3 = dict()
-        max_vals_img4 = dict()
-        max_vals_img5 = dict()
-        for i, fname in enumerate(val_logs["fname"]):
-            slice_num = int(val_logs["slice_num"][i].cpu())
-            maxval_t1 = val_logs["max_value_t1"][i].cpu().numpy()
-            maxval_t2 = val_logs["max_value_t2"][i].cpu().numpy()
-            maxval_pd = val_logs["max_value_pd"][i].cpu().numpy()
-            output_t1 = val_logs["output_t1"][i].cpu().numpy()
-            output_t2 = val_logs["output_t2"][i].cpu().numpy()
-            output_pd = val_logs["output_pd"][i].cpu().numpy()
-            output_pd = output_pd / output_pd.max()
-            output_img1 = val_logs["output_img1"][i].cpu().numpy()
-            output_img2 = val_logs["output_img2"][i].cpu().numpy()
-            output_img3 = val_logs["output_img3"][i].cpu().numpy()
-            output_img4 = val_logs["output_img4"][i].cpu().numpy()
-            output_img5 = val_logs["output_img5"][i].cpu().numpy()
-            target_t1 = val_logs["target_t1"][i].cpu().numpy()
-            target_t2 = val_logs["target_t2"][i].cpu().numpy()
-            target_pd = val_logs["target_pd"][i].cpu().numpy()
-            target_pd = target_pd / target_pd.max()
-            target_img1 = val_logs["target_img1"][i].cpu().numpy()
-            target_img2 = val_logs["target_img2"][i].cpu().numpy()
-            target_img3 = val_logs["target_img3"][i].cpu().numpy()
-            target_img4 = val_logs["target_img4"][i].cpu().numpy()
-            target_img5 = val_logs["target_img5"][i].cpu().numpy()
-
-            mse_vals_t1[fname][slice_num] = torch.tensor(
-                evaluate.mse(target_t1, output_t1)
-            ).view(1)
-            mse_vals_t2[fname][slice_num] = torch.tensor(
-                evaluate.mse(target_t2, output_t2)
-            ).view(1)
-            mse_vals_pd[fname][slice_num] = torch.tensor(
-                evaluate.mse(target_pd, output_pd)
-            ).view(1)
-            mse_vals_img1[fname][slice_num] = torch.tensor(
-                evaluate.mse(target_img1, output_img1)
-            ).view(1)
-            mse_vals_img2[fname][slice_num] = torch.tensor(
-                evaluate.mse(target_img2, output_img2)
-            ).view(1)
-            mse_vals_img3[fname][slice_num] = torch.tensor(
-                evaluate.mse(target_img3, output_img3)
-            ).view(1)
-            mse_vals_img4[fname][slice_num] = torch.tensor(
-                evaluate.mse(target_img4, output_img4)
-            ).view(1)
-            mse_vals_img5[fname][slice_num] = torch.tensor(
-                evaluate.mse(target_img5, output_img5)
-            ).view(1)
-            target_norms_t1[fname][slice_num] = torch.tensor(
-                evaluate.mse(target_t1, np.zeros_like(target_t1))
-            ).view(1)
-            target_norms_t2[fname][slice_num] = torch.tensor(
-                evaluate.mse(target_t2, np.zeros_like(target_t2))
-            ).view(1)
-            target_norms_pd[fname][slice_num] = torch.tensor(
-                evaluate.mse(target_pd, np.zeros_like(target_pd))
-            ).view(1)
-            target_norms_img1[fname][slice_num] = torch.tensor(
-                evaluate.mse(target_img1, np.zeros_like(target_img1))
-            ).view(1)
-            target_norms_img2[fname][slice_num] = torch.tensor(
-                evaluate.mse(target_img2, np.zeros_like(target_img2))
-            ).view(1)
-            target_norms_img3[fname][slice_num] = torch.tensor(
-                evaluate.mse(target_img3, np.zeros_like(target_img3))
-            ).view(1)
-            target_norms_img4[fname][slice_num] = torch.tensor(
-                evaluate.mse(target_img4, np.zeros_like(target_img4))
-            ).view(1)
-            target_norms_img5[fname][slice_num] = torch.tensor(
-                evaluate.mse(target_img5, np.zeros_like(target_img5))
-            ).view(1)
-            ssim_vals_t1[fname][slice_num] = torch.tensor(
-                evaluate.ssim(target_t1[None, ...], output_t1[None, ...], maxval=maxval_t1)
-            ).view(1)
-            ssim_vals_t2[fname][slice_num] = torch.tensor(
-                evaluate.ssim(target_t2[None, ...], output_t2[None, ...], maxval=maxval_t2)
-            ).view(1)
-            ssim_vals_pd[fname][slice_num] = torch.tensor(
-                evaluate.ssim(target_pd[None, ...], output_pd[None, ...], maxval=maxval_pd)
-            ).view(1)
-            ssim_vals_img1[fname][slice_num] = torch.tensor(
-                evaluate.ssim(target_img1[None, ...], output_img1[None, ...], maxval=target_img1.max())
-            ).view(1)
-            ssim_vals_img2[fname][slice_num] = torch.tensor(
-                evaluate.ssim(target_img2[None, ...], output_img2[None, ...], maxval=target_img2.max())
-            ).view(1)
-            ssim_vals_img3[fname][slice_num] = torch.tensor(
-                evaluate.ssim(target_img3[None, ...], output_img3[None, ...], maxval=target_img3.max())
-            ).view(1)
-            ssim_vals_img4[fname][slice_num] = torch.tensor(
-                evaluate.ssim(target_img4[None, ...], output_img4[None, ...], maxval=target_img4.max())
-            ).view(1)
-            ssim_vals_img5[fname][slice_num] = torch.tensor(
-                evaluate.ssim(target_img5[None, ...], output_img5[None, ...], maxval=target_img5.max())
-            ).view(1)
-            max_vals_t1[fname] = maxval_t1
-            max_vals_t2[fname] = maxval_t2
-            max_vals_pd[fname] = maxval_pd
-            max_vals_img1[fname] = np.ones_like(maxval_t1)*target_img1.max()
-            max_vals_img2[fname] = np.ones_like(maxval_t1)*target_img2.max()
-            max_vals_img3[fname] = np.ones_like(maxval_t1)*target_img3.max()
-            max_vals_img4[fname] = np.ones_like(maxval_t1)*target_img4.max()
-            max_vals_img5[fname] = np.ones_like(maxval_t1)*target_img5.max()
+        self.volume_metrics.update(
+            val_logs["fname"],
+            val_logs["slice_num"],
+            torch.stack([val_logs[f"output_{key}"] for key in VolumeMetricsQALAS.KEYS], 1),
+            torch.stack([val_logs[f"target_{key}"] for key in VolumeMetricsQALAS.KEYS], 1),
+            torch.stack((val_logs["max_value_t1"], val_logs["max_value_t2"], val_logs["max_value_pd"]), 1),
+            track_changes=not self.trainer.sanity_checking,
+        )
 
         return {
             "val_loss_t1": val_logs["val_loss_t1"],
@@ -412,38 +486,6 @@ class MriModuleQALAS_MAP(pl.LightningModule):
             "val_loss_img3": val_logs["val_loss_img3"],
             "val_loss_img4": val_logs["val_loss_img4"],
             "val_loss_img5": val_logs["val_loss_img5"],
-            "mse_vals_t1": dict(mse_vals_t1),
-            "mse_vals_t2": dict(mse_vals_t2),
-            "mse_vals_pd": dict(mse_vals_pd),
-            "mse_vals_img1": dict(mse_vals_img1),
-            "mse_vals_img2": dict(mse_vals_img2),
-            "mse_vals_img3": dict(mse_vals_img3),
-            "mse_vals_img4": dict(mse_vals_img4),
-            "mse_vals_img5": dict(mse_vals_img5),
-            "target_norms_t1": dict(target_norms_t1),
-            "target_norms_t2": dict(target_norms_t2),
-            "target_norms_pd": dict(target_norms_pd),
-            "target_norms_img1": dict(target_norms_img1),
-            "target_norms_img2": dict(target_norms_img2),
-            "target_norms_img3": dict(target_norms_img3),
-            "target_norms_img4": dict(target_norms_img4),
-            "target_norms_img5": dict(target_norms_img5),
-            "ssim_vals_t1": dict(ssim_vals_t1),
-            "ssim_vals_t2": dict(ssim_vals_t2),
-            "ssim_vals_pd": dict(ssim_vals_pd),
-            "ssim_vals_img1": dict(ssim_vals_img1),
-            "ssim_vals_img2": dict(ssim_vals_img2),
-            "ssim_vals_img3": dict(ssim_vals_img3),
-            "ssim_vals_img4": dict(ssim_vals_img4),
-            "ssim_vals_img5": dict(ssim_vals_img5),
-            "max_vals_t1": max_vals_t1,
-            "max_vals_t2": max_vals_t2,
-            "max_vals_pd": max_vals_pd,
-            "max_vals_img1": max_vals_img1,
-            "max_vals_img2": max_vals_img2,
-            "max_vals_img3": max_vals_img3,
-            "max_vals_img4": max_vals_img4,
-            "max_vals_img5": max_vals_img5,
             "loss_weight_t1": val_logs["loss_weight_t1"],
             "loss_weight_t2": val_logs["loss_weight_t2"],
             "loss_weight_pd": val_logs["loss_weight_pd"],
@@ -457,6 +499,20 @@ class MriModuleQALAS_MAP(pl.LightningModule):
     def log_image(self, name, image):
         self.logger.experiment.add_image(name, image, global_step=self.global_step)
 
+    @staticmethod
+    def sync_metric(metric: DistributedMetricSum, value: torch.Tensor) -> torch.Tensor:
+        """
+        Sum a value over the processes.
+
+        The metrics are only synchronized here, at the end of a validation
+        epoch, with one all-reduce per metric.
+        """
+        metric.update(value)
+        total = metric.compute()
+        metric.reset()
+
+        return total
+
     def validation_epoch_end(self, val_logs):
         # aggregate losses
         losses_t1 = []
@@ -467,40 +523,7 @@ class MriModuleQALAS_MAP(pl.LightningModule):
         losses_img3 = []
         losses_img4 = []
         losses_img5 = []
-        mse_vals_t1 = defaultdict(dict)
-        mse_vals_t2 = defaultdict(dict)
-        mse_vals_pd = defaultdict(dict)
-        mse_vals_img1 = defaultdict(dict)
-        mse_vals_img2 = defaultdict(dict)
-        mse_vals_img3 = defaultdict(dict)
-        mse_vals_img4 = defaultdict(dict)
-        mse_vals_img5 = defaultdict(dict)
-        target_norms_t1 = defaultdict(dict)
-        target_norms_t2 = defaultdict(dict)
-        target_norms_pd = defaultdict(dict)
-        target_norms_img1 = defaultdict(dict)
-        target_norms_img2 = defaultdict(dict)
-        target_norms_img3 = defaultdict(dict)
-        target_norms_img4 = defaultdict(dict)
-        target_norms_img5 = defaultdict(dict)
-        ssim_vals_t1 = defaultdict(dict)
-        ssim_vals_t2 = defaultdict(dict)
-        ssim_vals_pd = defaultdict(dict)
-        ssim_vals_img1 = defaultdict(dict)
-        ssim_vals_img2 = defaultdict(dict)
-        ssim_vals_img3 = defaultdict(dict)
-        ssim_vals_img4 = defaultdict(dict)
-        ssim_vals_img5 = defaultdict(dict)
-        max_vals_t1 = dict()
-        max_vals_t2 = dict()
-        max_vals_pd = dict()
-        max_vals_img1 = dict()
-        max_vals_img2 = dict()
-        max_vals_img3 = dict()
-        max_vals_img4 = dict()
-        max_vals_img5 = dict()
-
-        # use dict updates to handle duplicate slices
+
         for val_log in val_logs:
             losses_t1.append(val_log["val_loss_t1"].view(-1))
             losses_t2.append(val_log["val_loss_t2"].view(-1))
@@ -510,315 +533,27 @@ class MriModuleQALAS_MAP(pl.LightningModule):
             losses_img3.append(val_log["val_loss_img3"].view(-1))
             losses_img4.append(val_log["val_loss_img4"].view(-1))
             losses_img5.append(val_log["val_loss_img5"].view(-1))
-            
-
-            for k in val_log["mse_vals_t1"].keys():
-                mse_vals_t1[k].update(val_log["mse_vals_t1"][k])
-            for k in val_log["mse_vals_t2"].keys():
-                mse_vals_t2[k].update(val_log["mse_vals_t2"][k])
-            for k in val_log["mse_vals_pd"].keys():
-                mse_vals_pd[k].update(val_log["mse_vals_pd"][k])
-            for k in val_log["mse_vals_img1"].keys():
-                mse_vals_img1[k].update(val_log["mse_vals_img1"][k])
-            for k in val_log["mse_vals_img2"].keys():
-                mse_vals_img2[k].update(val_log["mse_vals_img2"][k])
-            for k in val_log["mse_vals_img3"].keys():
-                mse_vals_img3[k].update(val_log["mse_vals_img3"][k])
-            for k in val_log["mse_vals_img4"].keys():
-                mse_vals_img4[k].update(val_log["mse_vals_img4"][k])
-            for k in val_log["mse_vals_img5"].keys():
-                mse_vals_img5[k].update(val_log["mse_vals_img5"][k])
-            for k in val_log["target_norms_t1"].keys():
-                target_norms_t1[k].update(val_log["target_norms_t1"][k])
-            for k in val_log["target_norms_t2"].keys():
-                target_norms_t2[k].update(val_log["target_norms_t2"][k])
-            for k in val_log["target_norms_pd"].keys():
-                target_norms_pd[k].update(val_log["target_norms_pd"][k])
-            for k in val_log["target_norms_img1"].keys():
-                target_norms_img1[k].update(val_log["target_norms_img1"][k])
-            for k in val_log["target_norms_img2"].keys():
-                target_norms_img2[k].update(val_log["target_norms_img2"][k])
-            for k in val_log["target_norms_img3"].keys():
-                target_norms_img3[k].update(val_log["target_norms_img3"][k])
-            for k in val_log["target_norms_img4"].keys():
-                target_norms_img4[k].update(val_log["target_norms_img4"][k])
-            for k in val_log["target_norms_img5"].keys():
-                target_norms_img5[k].update(val_log["target_norms_img5"][k])
-            for k in val_log["ssim_vals_t1"].keys():
-                ssim_vals_t1[k].update(val_log["ssim_vals_t1"][k])
-            for k in val_log["ssim_vals_t2"].keys():
-                ssim_vals_t2[k].update(val_log["ssim_vals_t2"][k])
-            for k in val_log["ssim_vals_pd"].keys():
-                ssim_vals_pd[k].update(val_log["ssim_vals_pd"][k])
-            for k in val_log["ssim_vals_img1"].keys():
-                ssim_vals_img1[k].update(val_log["ssim_vals_img1"][k])
-            for k in val_log["ssim_vals_img2"].keys():
-                ssim_vals_img2[k].update(val_log["ssim_vals_img2"][k])
-            for k in val_log["ssim_vals_img3"].keys():
-                ssim_vals_img3[k].update(val_log["ssim_vals_img3"][k])
-            for k in val_log["ssim_vals_img4"].keys():
-                ssim_vals_img4[k].update(val_log["ssim_vals_img4"][k])
-            for k in val_log["ssim_vals_img5"].keys():
-                ssim_vals_img5[k].update(val_log["ssim_vals_img5"][k])
-            for k in val_log["max_vals_t1"]:
-                max_vals_t1[k] = val_log["max_vals_t1"][k]
-            for k in val_log["max_vals_t2"]:
-                max_vals_t2[k] = val_log["max_vals_t2"][k]
-            for k in val_log["max_vals_pd"]:
-                max_vals_pd[k] = val_log["max_vals_pd"][k]
-            for k in val_log["max_vals_img1"]:
-                max_vals_img1[k] = val_log["max_vals_img1"][k]
-            for k in val_log["max_vals_img2"]:
-                max_vals_img2[k] = val_log["max_vals_img2"][k]
-            for k in val_log["max_vals_img3"]:
-                max_vals_img3[k] = val_log["max_vals_img3"][k]
-            for k in val_log["max_vals_img4"]:
-                max_vals_img4[k] = val_log["max_vals_img4"][k]
-            for k in val_log["max_vals_img5"]:
-                max_vals_img5[k] = val_log["max_vals_img5"][k]
-
-        # check to make sure we have all files in all metrics
-        assert (
-            mse_vals_t1.keys()
-            == mse_vals_t2.keys()
-            == mse_vals_pd.keys()
-            == mse_vals_img1.keys()
-            == mse_vals_img2.keys()
-            == mse_vals_img3.keys()
-            == mse_vals_img4.keys()
-            == mse_vals_img5.keys()
-            == target_norms_t1.keys()
-            == target_norms_t2.keys()
-            == target_norms_pd.keys()
-            == target_norms_img1.keys()
-            == target_norms_img2.keys()
-            == target_norms_img3.keys()
-            == target_norms_img4.keys()
-            == target_norms_img5.keys()
-            == ssim_vals_t1.keys()
-            == ssim_vals_t2.keys()
-            == ssim_vals_pd.keys()
-            == ssim_vals_img1.keys()
-            == ssim_vals_img2.keys()
-            == ssim_vals_img3.keys()
-            == ssim_vals_img4.keys()
-            == ssim_vals_img5.keys()
-            == max_vals_t1.keys()
-            == max_vals_t2.keys()
-            == max_vals_pd.keys()
-            == max_vals_img1.keys()
-            == max_vals_img2.keys()
-            == max_vals_img3.keys()
-            == max_vals_img4.keys()
-            == max_vals_img5.keys()
-        )
 
         # apply means across image volumes
-        metrics = {"nmse_t1": 0, "nmse_t2": 0, "nmse_pd": 0, \
-                    "nmse_img1": 0, "nmse_img2": 0, "nmse_img3": 0, "nmse_img4": 0, "nmse_img5": 0, \
-                    "ssim_t1": 0, "ssim_t2": 0, "ssim_pd": 0, \
-                    "ssim_img1": 0, "ssim_img2": 0, "ssim_img3": 0, "ssim_img4": 0, "ssim_img5": 0, \
-                    "psnr_t1": 0, "psnr_t2": 0, "psnr_pd": 0, \
-                    "psnr_img1": 0, "psnr_img2": 0, "psnr_img3": 0, "psnr_img4": 0, "psnr_img5": 0}
-        local_examples = 0
-        for fname in mse_vals_t1.keys():
-            local_examples = local_examples + 1
-            mse_val_t1 = torch.mean(
-                torch.cat([v.view(-1) for _, v in mse_vals_t1[fname].items()])
-            )
-            mse_val_t2 = torch.mean(
-                torch.cat([v.view(-1) for _, v in mse_vals_t2[fname].items()])
-            )
-            mse_val_pd = torch.mean(
-                torch.cat([v.view(-1) for _, v in mse_vals_pd[fname].items()])
-            )
-            mse_val_img1 = torch.mean(
-                torch.cat([v.view(-1) for _, v in mse_vals_img1[fname].items()])
-            )
-            mse_val_img2 = torch.mean(
-                torch.cat([v.view(-1) for _, v in mse_vals_img2[fname].items()])
-            )
-            mse_val_img3 = torch.mean(
-                torch.cat([v.view(-1) for _, v in mse_vals_img3[fname].items()])
-            )
-            mse_val_img4 = torch.mean(
-                torch.cat([v.view(-1) for _, v in mse_vals_img4[fname].items()])
-            )
-            mse_val_img5 = torch.mean(
-                torch.cat([v.view(-1) for _, v in mse_vals_img5[fname].items()])
-            )
-            target_norm_t1 = torch.mean(
-                torch.cat([v.view(-1) for _, v in target_norms_t1[fname].items()])
-            )
-            target_norm_t2 = torch.mean(
-                torch.cat([v.view(-1) for _, v in target_norms_t2[fname].items()])
-            )
-            target_norm_pd = torch.mean(
-                torch.cat([v.view(-1) for _, v in target_norms_pd[fname].items()])
-            )
-            target_norm_img1 = torch.mean(
-                torch.cat([v.view(-1) for _, v in target_norms_img1[fname].items()])
-            )
-            target_norm_img2 = torch.mean(
-                torch.cat([v.view(-1) for _, v in target_norms_img2[fname].items()])
-            )
-            target_norm_img3 = torch.mean(
-                torch.cat([v.view(-1) for _, v in target_norms_img3[fname].items()])
-            )
-            target_norm_img4 = torch.mean(
-                torch.cat([v.view(-1) for _, v in target_norms_img4[fname].items()])
-            )
-            target_norm_img5 = torch.mean(
-                torch.cat([v.view(-1) for _, v in target_norms_img5[fname].items()])
-            )
-            metrics["nmse_t1"] = metrics["nmse_t1"] + mse_val_t1 / target_norm_t1
-            metrics["nmse_t2"] = metrics["nmse_t2"] + mse_val_t2 / target_norm_t2
-            metrics["nmse_pd"] = metrics["nmse_pd"] + mse_val_pd / target_norm_pd
-            metrics["nmse_img1"] = metrics["nmse_img1"] + mse_val_img1 / target_norm_img1
-            metrics["nmse_img2"] = metrics["nmse_img2"] + mse_val_img2 / target_norm_img2
-            metrics["nmse_img3"] = metrics["nmse_img3"] + mse_val_img3 / target_norm_img3
-            metrics["nmse_img4"] = metrics["nmse_img4"] + mse_val_img4 / target_norm_img4
-            metrics["nmse_img5"] = metrics["nmse_img5"] + mse_val_img5 / target_norm_img5
-            metrics["psnr_t1"] = (
-                metrics["psnr_t1"]
-                + 20
-                * torch.log10(
-                    torch.tensor(
-                        max_vals_t1[fname], dtype=mse_val_t1.dtype, device=mse_val_t1.device
-                    )[0]
-                )
-                - 10 * torch.log10(mse_val_t1)
-            )
-            metrics["psnr_t2"] = (
-                metrics["psnr_t2"]
-                + 20
-                * torch.log10(
-                    torch.tensor(
-                        max_vals_t2[fname], dtype=mse_val_t2.dtype, device=mse_val_t2.device
-                    )[0]
-                )
-                - 10 * torch.log10(mse_val_t2)
-            )
-            metrics["psnr_pd"] = (
-                metrics["psnr_pd"]
-                + 20
-                * torch.log10(
-                    torch.tensor(
-                        max_vals_pd[fname], dtype=mse_val_pd.dtype, device=mse_val_pd.device
-                    )[0]
-                )
-                - 10 * torch.log10(mse_val_pd)
-            )
-            metrics["psnr_img1"] = (
-                metrics["psnr_img1"]
-                + 20
-                * torch.log10(
-                    torch.tensor(
-                        max_vals_img1[fname], dtype=mse_val_img1.dtype, device=mse_val_img1.device
-                    )[0]
-                )
-                - 10 * torch.log10(mse_val_img1)
-            )
-            metrics["psnr_img2"] = (
-                metrics["psnr_img2"]
-                + 20
-                * torch.log10(
-                    torch.tensor(
-                        max_vals_img2[fname], dtype=mse_val_img2.dtype, device=mse_val_img2.device
-                    )[0]
-                )
-                - 10 * torch.log10(mse_val_img2)
-            )
-            metrics["psnr_img3"] = (
-                metrics["psnr_img3"]
-                + 20
-                * torch.log10(
-                    torch.tensor(
-                        max_vals_img3[fname], dtype=mse_val_img3.dtype, device=mse_val_img3.device
-                    )[0]
-                )
-                - 10 * torch.log10(mse_val_img3)
-            )
-            metrics["psnr_img4"] = (
-                metrics["psnr_img4"]
-                + 20
-                * torch.log10(
-                    torch.tensor(
-                        max_vals_img4[fname], dtype=mse_val_img4.dtype, device=mse_val_img4.device
-                    )[0]
-                )
-                - 10 * torch.log10(mse_val_img4)
-            )
-            metrics["psnr_img5"] = (
-                metrics["psnr_img5"]
-                + 20
-                * torch.log10(
-                    torch.tensor(
-                        max_vals_img5[fname], dtype=mse_val_img5.dtype, device=mse_val_img5.device
-                    )[0]
-                )
-                - 10 * torch.log10(mse_val_img5)
-            )
-            metrics["ssim_t1"] = metrics["ssim_t1"] + torch.mean(
-                torch.cat([v.view(-1) for _, v in ssim_vals_t1[fname].items()])
-            )
-            metrics["ssim_t2"] = metrics["ssim_t2"] + torch.mean(
-                torch.cat([v.view(-1) for _, v in ssim_vals_t2[fname].items()])
-            )
-            metrics["ssim_pd"] = metrics["ssim_pd"] + torch.mean(
-                torch.cat([v.view(-1) for _, v in ssim_vals_pd[fname].items()])
-            )
-            metrics["ssim_img1"] = metrics["ssim_img1"] + torch.mean(
-                torch.cat([v.view(-1) for _, v in ssim_vals_img1[fname].items()])
-            )
-            metrics["ssim_img2"] = metrics["ssim_img2"] + torch.mean(
-                torch.cat([v.view(-1) for _, v in ssim_vals_img2[fname].items()])
-            )
-            metrics["ssim_img3"] = metrics["ssim_img3"] + torch.mean(
-                torch.cat([v.view(-1) for _, v in ssim_vals_img3[fname].items()])
-            )
-            metrics["ssim_img4"] = metrics["ssim_img4"] + torch.mean(
-                torch.cat([v.view(-1) for _, v in ssim_vals_img4[fname].items()])
-            )
-            metrics["ssim_img5"] = metrics["ssim_img5"] + torch.mean(
-                torch.cat([v.view(-1) for _, v in ssim_vals_img5[fname].items()])
-            )
+        volume_metrics, local_examples = self.volume_metrics.compute()
+        self.volume_metrics.reset()
 
         # reduce across ddp via sum
-        metrics["nmse_t1"] = self.NMSE(metrics["nmse_t1"])
-        metrics["nmse_t2"] = self.NMSE(metrics["nmse_t2"])
-        metrics["nmse_pd"] = self.NMSE(metrics["nmse_pd"])
-        metrics["nmse_img1"] = self.NMSE(metrics["nmse_img1"])
-        metrics["nmse_img2"] = self.NMSE(metrics["nmse_img2"])
-        metrics["nmse_img3"] = self.NMSE(metrics["nmse_img3"])
-        metrics["nmse_img4"] = self.NMSE(metrics["nmse_img4"])
-        metrics["nmse_img5"] = self.NMSE(metrics["nmse_img5"])
-        metrics["ssim_t1"] = self.SSIM(metrics["ssim_t1"])
-        metrics["ssim_t2"] = self.SSIM(metrics["ssim_t2"])
-        metrics["ssim_pd"] = self.SSIM(metrics["ssim_pd"])
-        metrics["ssim_img1"] = self.SSIM(metrics["ssim_img1"])
-        metrics["ssim_img2"] = self.SSIM(metrics["ssim_img2"])
-        metrics["ssim_img3"] = self.SSIM(metrics["ssim_img3"])
-        metrics["ssim_img4"] = self.SSIM(metrics["ssim_img4"])
-        metrics["ssim_img5"] = self.SSIM(metrics["ssim_img5"])
-        metrics["psnr_t1"] = self.PSNR(metrics["psnr_t1"])
-        metrics["psnr_t2"] = self.PSNR(metrics["psnr_t2"])
-        metrics["psnr_pd"] = self.PSNR(metrics["psnr_pd"])
-        metrics["psnr_img1"] = self.PSNR(metrics["psnr_img1"])
-        metrics["psnr_img2"] = self.PSNR(metrics["psnr_img2"])
-        metrics["psnr_img3"] = self.PSNR(metrics["psnr_img3"])
-        metrics["psnr_img4"] = self.PSNR(metrics["psnr_img4"])
-        metrics["psnr_img5"] = self.PSNR(metrics["psnr_img5"])
-
-        tot_examples = self.TotExamples(torch.tensor(local_examples))
-        val_loss = self.ValLoss((torch.sum(torch.cat(losses_t1)) * val_log["loss_weight_t1"] + torch.sum(torch.cat(losses_t2)) * val_log["loss_weight_t2"] + \
+        metrics = {}
+        for prefix, metric in (("nmse", self.NMSE), ("ssim", self.SSIM), ("psnr", self.PSNR)):
+            values = self.sync_metric(metric, volume_metrics[prefix])
+            for key, value in zip(VolumeMetricsQALAS.KEYS, values):
+                metrics[f"{prefix}_{key}"] = value
+
+        tot_examples = self.sync_metric(self.TotExamples, torch.tensor(local_examples))
+        val_loss = self.sync_metric(self.ValLoss, (torch.sum(torch.cat(losses_t1)) * val_log["loss_weight_t1"] + torch.sum(torch.cat(losses_t2)) * val_log["loss_weight_t2"] + \
                                     torch.sum(torch.cat(losses_pd)) * val_log["loss_weight_pd"] + \
                                     torch.sum(torch.cat(losses_img1)) * val_log["loss_weight_img1"] + torch.sum(torch.cat(losses_img2)) * val_log["loss_weight_img2"] + \
                                     torch.sum(torch.cat(losses_img3)) * val_log["loss_weight_img3"] + torch.sum(torch.cat(losses_img4)) * val_log["loss_weight_img4"] + \
                                     torch.sum(torch.cat(losses_img5)) * val_log["loss_weight_img5"]) \
                                 / (val_log["loss_weight_t1"] + val_log["loss_weight_t2"] + val_log["loss_weight_pd"] + \
                                     val_log["loss_weight_img1"] + val_log["loss_weight_img2"] + val_log["loss_weight_img3"] + val_log["loss_weight_img4"] + val_log["loss_weight_img5"]))
-        tot_slice_examples = self.TotSliceExamples(
+        tot_slice_examples = self.sync_metric(self.TotSliceExamples,
             torch.tensor(len(losses_t1), dtype=torch.float)
         )
 
@@ -826,6 +561,16 @@ class MriModuleQALAS_MAP(pl.LightningModule):
         for metric, value in metrics.items():
             self.log(f"val_metrics/{metric}", value / tot_examples)
 
+        # relative change of the T1/T2 maps since the previous check, only
+        # available from the second validation check on
+        map_change_t1 = self.sync_metric(self.MapChangeT1, volume_metrics["map_change"][0])
+        map_change_t2 = self.sync_metric(self.MapChangeT2, volume_metrics["map_change"][1])
+        map_norm_t1 = self.sync_metric(self.MapNormT1, volume_metrics["map_norm"][0])
+        map_norm_t2 = self.sync_metric(self.MapNormT2, volume_metrics["map_norm"][1])
+        if map_norm_t1 > 0 and map_norm_t2 > 0:
+            self.log("val_metrics/map_change_t1", torch.sqrt(map_change_t1 / map_norm_t1))
+            self.log("val_metrics/map_change_t2", torch.sqrt(map_change_t2 / map_norm_t2))
+
     def test_epoch_end(self, test_logs):
         outputs_t1 = defaultdict(dict)
         outputs_t2 = defaultdict(dict)
@@ -883,5 +628,17 @@ class MriModuleQALAS_MAP(pl.LightningModule):
             type=int,
             help="Number of images to log to Tensorboard",
         )
+        parser.add_argument(
+            "--train_as_val",
+            default=False,
+            action="store_true",
+            help="Compute the validation metrics from the training steps, without a validation loop",
+        )
+        parser.add_argument(
+            "--max_change_volumes",
+            default=64,
+            type=int,
+            help="Number of validation volumes whose maps are kept to measure the map change",
+        )
 
         return parser
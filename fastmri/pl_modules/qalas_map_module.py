@@ -6,10 +6,12 @@ LICENSE file in the root directory of this source tree.
 """
 
 from argparse import ArgumentParser
+from typing import Dict, Optional
 
 import fastmri
 import torch
 from fastmri.data import transforms_qalas
+from fastmri.data.sequence_params_qalas import SequenceParams
 from fastmri.models import QALAS_MAP
 
 from .mri_module_qalas_map import MriModuleQALAS_MAP
@@ -43,6 +45,12 @@ class QALAS_MAPModule(MriModuleQALAS_MAP):
         lr_step_size: int = 40,
         lr_gamma: float = 0.1,
         weight_decay: float = 0.0,
+        seq_params: Optional[Dict] = None,
+        steady_state: str = "closed_form",
+        forward_model: str = "analytic",
+        voxel_packed: bool = False,
+        num_models: int = 1,
+        b1_cache_size: int = 512,
         **kwargs,
     ):
         """
@@ -56,6 +64,21 @@ class QALAS_MAPModule(MriModuleQALAS_MAP):
             lr_step_size: Learning rate step size.
             lr_gamma: Learning rate gamma decay.
             weight_decay: Parameter for penalizing weights norm.
+            seq_params: QALAS sequence parameters as a dict (see
+                `SequenceParams._asdict`). They are saved with the checkpoint
+                hyperparameters so that inference does not need the data file.
+            steady_state: Steady-state solver of the QALAS forward model,
+                "closed_form" or the 20-repetition "iterative" reference.
+            forward_model: "analytic" QALAS forward model, or its "lookup"
+                table approximation, interpolated on a dense parameter grid.
+            voxel_packed: Whether to compute the maps and the simulated images
+                only for the voxels inside the brain mask.
+            num_models: Number of independent mapping networks trained side
+                by side, one per session (see `QALAS_MAP`). Split the
+                checkpoints with `split_grouped_checkpoint`.
+            b1_cache_size: Number of slices whose B1 terms of the forward
+                model are cached between epochs, 0 to recompute them for
+                every batch.
             num_sense_lines: Number of low-frequency lines to use for sensitivity map
                 computation, must be even or `None`. Default `None` will automatically
                 compute the number from masks. Default behaviour may cause some slices to
@@ -78,6 +101,12 @@ class QALAS_MAPModule(MriModuleQALAS_MAP):
         self.lr_step_size = lr_step_size
         self.lr_gamma = lr_gamma
         self.weight_decay = weight_decay
+        self.seq_params = SequenceParams(**seq_params) if seq_params is not None else None
+        self.steady_state = steady_state
+        self.forward_model = forward_model
+        self.voxel_packed = voxel_packed
+        self.num_models = num_models
+        self.b1_cache_size = b1_cache_size
 
         self.qalas = QALAS_MAP(
             num_cascades=self.num_cascades,
@@ -85,247 +114,164 @@ class QALAS_MAPModule(MriModuleQALAS_MAP):
             maps_layers=self.maps_layers,
             chans=self.chans,
             pools=self.pools,
+            seq_params=self.seq_params,
+            steady_state=self.steady_state,
+            forward_model=self.forward_model,
+            voxel_packed=self.voxel_packed,
+            num_models=self.num_models,
+            b1_cache_size=self.b1_cache_size,
         )
 
-        self.loss_l2_t1 = torch.nn.MSELoss()
-        self.loss_l2_t2 = torch.nn.MSELoss()
-        self.loss_l2_pd = torch.nn.MSELoss()
-        self.loss_l2_img1 = torch.nn.MSELoss()
-        self.loss_l2_img2 = torch.nn.MSELoss()
-        self.loss_l2_img3 = torch.nn.MSELoss()
-        self.loss_l2_img4 = torch.nn.MSELoss()
-        self.loss_l2_img5 = torch.nn.MSELoss()
-
-    def forward(self, masked_kspace_acq1, masked_kspace_acq2, masked_kspace_acq3, masked_kspace_acq4, masked_kspace_acq5, \
-                mask_acq1, mask_acq2, mask_acq3, mask_acq4, mask_acq5, mask_brain, \
-                # coil_sens, \
-                b1, ie, max_value_t1, max_value_t2, max_value_pd, num_low_frequencies):
-        return self.qalas(masked_kspace_acq1, masked_kspace_acq2, masked_kspace_acq3, masked_kspace_acq4, masked_kspace_acq5, \
-                        mask_acq1, mask_acq2, mask_acq3, mask_acq4, mask_acq5, mask_brain, \
-                        # coil_sens, \
-                        b1, ie, max_value_t1, max_value_t2, max_value_pd, num_low_frequencies)
+        # weights of the L2 losses of the T1, T2 and PD maps (their targets
+        # are placeholders in self-supervised training) and of the images
+        self.loss_weights = {
+            "t1": 0,
+            "t2": 0,
+            "pd": 0,
+            "img1": 1,
+            "img2": 1,
+            "img3": 1,
+            "img4": 1,
+            "img5": 1,
+        }
+
+    def forward(self, images, b1, max_value_t1, max_value_t2, mask_brain=None, seq_params=None, slice_keys=None, return_images=True):
+        return self.qalas(images, b1, max_value_t1, max_value_t2, mask_brain=mask_brain, seq_params=seq_params, \
+                        slice_keys=slice_keys, return_images=return_images)
+
+    def forward_batch(self, batch, slice_keys=None, return_images=True):
+        """
+        Run the model on a QALASSample batch.
+        """
+        return self(batch.images, batch.b1, batch.max_value_t1, batch.max_value_t2, mask_brain=batch.mask_brain, \
+                    seq_params=batch.seq_params, slice_keys=slice_keys, return_images=return_images)
+
+    def crop_and_mask(self, batch, output):
+        """
+        Crop the outputs and the targets of a batch to the same size, and
+        mask them with the brain mask.
+
+        Args:
+            batch: The QALASSample batch.
+            output: The MapOutput of the model, with the simulated images.
+
+        Returns:
+            The outputs, a dict of the t1, t2, pd, ie and b1 maps and of the
+            `(B, 5, H, W)` stack of the simulated images ("img"), and the
+            targets, a dict of the t1, t2 and pd maps and of the stack of the
+            acquired images.
+        """
+        # If raw k-space data were used, the acquired images are the coil
+        # combinations of the masked k-space (see QALAS_MAP.forward). If
+        # DICOM data were used, they are the inputs, the second one negated
+        acquired = batch.images * batch.images.new_tensor([1, -1, 1, 1, 1]).reshape(1, 5, 1, 1)
+
+        targets, maps = transforms_qalas.center_crop_to_smallest(batch.targets, output.maps)
+        targets, images = transforms_qalas.center_crop_to_smallest(targets, output.images)
+        targets, acquired = transforms_qalas.center_crop_to_smallest(targets, acquired)
+
+        mask = batch.mask_brain.unsqueeze(1)
+        maps = maps * mask
+        images = images * mask
+        targets = targets * mask
+        acquired = acquired * mask
+
+        outputs = dict(zip(("t1", "t2", "pd", "ie", "b1"), maps.unbind(1)), img=images)
+        targets = dict(zip(("t1", "t2", "pd"), targets.unbind(1)), img=acquired)
+
+        return outputs, targets
+
+    def losses(self, outputs, targets):
+        """
+        The L2 losses of non-zero weight.
+
+        The losses of the images are computed in one kernel over their
+        stack, the PD maps are compared up to their scaling.
+
+        Args:
+            outputs: Outputs of `crop_and_mask`.
+            targets: Targets of `crop_and_mask`.
+
+        Returns:
+            A dict of the losses, with the keys of `loss_weights`.
+        """
+        losses = {}
+        for key in ("t1", "t2", "pd"):
+            if self.loss_weights[key] != 0:
+                output, target = outputs[key], targets[key]
+                if key == "pd":
+                    output, target = output / output.max(), target / target.max()
+                losses[key] = torch.mean((output - target) ** 2)
+
+        keys = [f"img{i}" for i in range(1, 6)]
+        index = [i for i, key in enumerate(keys) if self.loss_weights[key] != 0]
+        if index:
+            output, target = outputs["img"], targets["img"]
+            if len(index) < len(keys):
+                output, target = output[:, index], target[:, index]
+            losses.update(zip([keys[i] for i in index], torch.mean((output - target) ** 2, dim=(0, 2, 3)).unbind()))
+
+        return losses
 
     def training_step(self, batch, batch_idx):
-        output_t1, output_t2, output_pd, output_ie, output_b1, \
-        output_img1, output_img2, output_img3, output_img4, output_img5 = \
-            self(batch.masked_kspace_acq1, batch.masked_kspace_acq2, batch.masked_kspace_acq3, batch.masked_kspace_acq4, batch.masked_kspace_acq5, \
-                batch.mask_acq1, batch.mask_acq2, batch.mask_acq3, batch.mask_acq4, batch.mask_acq5, batch.mask_brain, \
-                # batch.coil_sens, \
-                batch.b1, batch.ie, batch.max_value_t1, batch.max_value_t2, batch.max_value_pd, batch.num_low_frequencies)
-
-        # If raw k-space data were used, use following 5 lines
-        # img_acq1 = fastmri.complex_abs(fastmri.complex_mul(fastmri.ifft2c(batch.masked_kspace_acq1), fastmri.complex_conj(batch.coil_sens)).sum(dim=1, keepdim=True)) / np.sqrt(batch.masked_kspace_acq1.shape[2] * batch.masked_kspace_acq1.shape[3])
-        # img_acq2 = -fastmri.complex_abs(fastmri.complex_mul(fastmri.ifft2c(batch.masked_kspace_acq2), fastmri.complex_conj(batch.coil_sens)).sum(dim=1, keepdim=True)) / np.sqrt(batch.masked_kspace_acq2.shape[2] * batch.masked_kspace_acq2.shape[3])
-        # img_acq3 = fastmri.complex_abs(fastmri.complex_mul(fastmri.ifft2c(batch.masked_kspace_acq3), fastmri.complex_conj(batch.coil_sens)).sum(dim=1, keepdim=True)) / np.sqrt(batch.masked_kspace_acq3.shape[2] * batch.masked_kspace_acq3.shape[3])
-        # img_acq4 = fastmri.complex_abs(fastmri.complex_mul(fastmri.ifft2c(batch.masked_kspace_acq4), fastmri.complex_conj(batch.coil_sens)).sum(dim=1, keepdim=True)) / np.sqrt(batch.masked_kspace_acq4.shape[2] * batch.masked_kspace_acq4.shape[3])
-        # img_acq5 = fastmri.complex_abs(fastmri.complex_mul(fastmri.ifft2c(batch.masked_kspace_acq5), fastmri.complex_conj(batch.coil_sens)).sum(dim=1, keepdim=True)) / np.sqrt(batch.masked_kspace_acq5.shape[2] * batch.masked_kspace_acq5.shape[3])
-
-        # If DICOM data were used, use following 5 lines
-        img_acq1 = batch.masked_kspace_acq1
-        img_acq2 = -batch.masked_kspace_acq2
-        img_acq3 = batch.masked_kspace_acq3
-        img_acq4 = batch.masked_kspace_acq4
-        img_acq5 = batch.masked_kspace_acq5
-
-        target_t1, output_t1 = transforms_qalas.center_crop_to_smallest(batch.target_t1, output_t1)
-        target_t2, output_t2 = transforms_qalas.center_crop_to_smallest(batch.target_t2, output_t2)
-        target_pd, output_pd = transforms_qalas.center_crop_to_smallest(batch.target_pd, output_pd)
-        target_pd, output_ie = transforms_qalas.center_crop_to_smallest(batch.target_pd, output_ie)
-        target_pd, output_b1 = transforms_qalas.center_crop_to_smallest(batch.target_pd, output_b1)
-
-        target_t1, img_acq1 = transforms_qalas.center_crop_to_smallest(batch.target_t1, img_acq1.squeeze(1))
-        target_t1, img_acq2 = transforms_qalas.center_crop_to_smallest(batch.target_t1, img_acq2.squeeze(1))
-        target_t1, img_acq3 = transforms_qalas.center_crop_to_smallest(batch.target_t1, img_acq3.squeeze(1))
-        target_t1, img_acq4 = transforms_qalas.center_crop_to_smallest(batch.target_t1, img_acq4.squeeze(1))
-        target_t1, img_acq5 = transforms_qalas.center_crop_to_smallest(batch.target_t1, img_acq5.squeeze(1))
-
-        target_t1, output_img1 = transforms_qalas.center_crop_to_smallest(batch.target_t1, output_img1.squeeze(1))
-        target_t1, output_img2 = transforms_qalas.center_crop_to_smallest(batch.target_t1, output_img2.squeeze(1))
-        target_t1, output_img3 = transforms_qalas.center_crop_to_smallest(batch.target_t1, output_img3.squeeze(1))
-        target_t1, output_img4 = transforms_qalas.center_crop_to_smallest(batch.target_t1, output_img4.squeeze(1))
-        target_t1, output_img5 = transforms_qalas.center_crop_to_smallest(batch.target_t1, output_img5.squeeze(1))
-
-        target_t1 = target_t1 * batch.mask_brain
-        target_t2 = target_t2 * batch.mask_brain
-        target_pd = target_pd * batch.mask_brain
-
-        output_t1 = output_t1 * batch.mask_brain
-        output_t2 = output_t2 * batch.mask_brain
-        output_pd = output_pd * batch.mask_brain
-        output_ie = output_ie * batch.mask_brain
-        output_b1 = output_b1 * batch.mask_brain
-
-        img_acq1 = img_acq1 * batch.mask_brain
-        img_acq2 = img_acq2 * batch.mask_brain
-        img_acq3 = img_acq3 * batch.mask_brain
-        img_acq4 = img_acq4 * batch.mask_brain
-        img_acq5 = img_acq5 * batch.mask_brain
-
-        output_img1 = output_img1 * batch.mask_brain
-        output_img2 = output_img2 * batch.mask_brain
-        output_img3 = output_img3 * batch.mask_brain
-        output_img4 = output_img4 * batch.mask_brain
-        output_img5 = output_img5 * batch.mask_brain
+        output = self.forward_batch(batch, slice_keys=list(zip(batch.fname, batch.slice_num.tolist())))
+
+        outputs, targets = self.crop_and_mask(batch, output)
 
         if batch.mask_brain.sum() == 0:
-            target_t1 = target_t1 + 1e-5
-            target_t2 = target_t2 + 1e-5
-            target_pd = target_pd + 1e-5
-            output_t1 = output_t1 + 1e-5
-            output_t2 = output_t2 + 1e-5
-            output_pd = output_pd + 1e-5
-            output_ie = output_ie + 1e-5
-            output_b1 = output_b1 + 1e-5
-            img_acq1 = img_acq1 + 1e-5
-            img_acq2 = img_acq2 + 1e-5
-            img_acq3 = img_acq3 + 1e-5
-            img_acq4 = img_acq4 + 1e-5
-            img_acq5 = img_acq5 + 1e-5
-            output_img1 = output_img1 + 1e-5
-            output_img2 = output_img2 + 1e-5
-            output_img3 = output_img3 + 1e-5
-            output_img4 = output_img4 + 1e-5
-            output_img5 = output_img5 + 1e-5
-
-        loss_t1 = self.loss_l2_t1(output_t1.unsqueeze(1), target_t1.unsqueeze(1))
-        loss_t2 = self.loss_l2_t2(output_t2.unsqueeze(1), target_t2.unsqueeze(1))
-        loss_pd = self.loss_l2_pd(output_pd.unsqueeze(1) / output_pd.max(), target_pd.unsqueeze(1) / target_pd.max())
-        loss_img1 = self.loss_l2_img1(output_img1.unsqueeze(1), img_acq1.unsqueeze(1))
-        loss_img2 = self.loss_l2_img2(output_img2.unsqueeze(1), img_acq2.unsqueeze(1))
-        loss_img3 = self.loss_l2_img3(output_img3.unsqueeze(1), img_acq3.unsqueeze(1))
-        loss_img4 = self.loss_l2_img4(output_img4.unsqueeze(1), img_acq4.unsqueeze(1))
-        loss_img5 = self.loss_l2_img5(output_img5.unsqueeze(1), img_acq5.unsqueeze(1))
-        def loss_tv(img):
-            pixel_dif1 = img[..., 1:,:] - img[..., :-1,:]
-            pixel_dif2 = img[..., :,1:] - img[..., :,:-1]
-            reduce_axes = (-2,-1)
-            res1 = pixel_dif1.abs().sum(dim=reduce_axes)
-            res2 = pixel_dif2.abs().sum(dim=reduce_axes)
-            return (res1 + res2) / (img.shape[-1] * img.shape[-2])
-        loss_img1_tv = loss_tv(output_img1)
-        loss_img2_tv = loss_tv(output_img2)
-        loss_img3_tv = loss_tv(output_img3)
-        loss_img4_tv = loss_tv(output_img4)
-        loss_img5_tv = loss_tv(output_img5)
-
-        loss_weight_t1 = 0
-        loss_weight_t2 = 0
-        loss_weight_pd = 0
-        loss_weight_img1 = 1
-        loss_weight_img2 = 1
-        loss_weight_img3 = 1
-        loss_weight_img4 = 1
-        loss_weight_img5 = 1
-        loss_weight_img1_tv = 0
-        loss_weight_img2_tv = 0
-        loss_weight_img3_tv = 0
-        loss_weight_img4_tv = 0
-        loss_weight_img5_tv = 0
-        loss = (loss_t1 * loss_weight_t1 + loss_t2 * loss_weight_t2 + loss_pd * loss_weight_pd + \
-                loss_img1 * loss_weight_img1 + loss_img2 * loss_weight_img2 + loss_img3 * loss_weight_img3 + loss_img4 * loss_weight_img4 + loss_img5 * loss_weight_img5) \
-                 / (loss_weight_t1 + loss_weight_t2 + loss_weight_pd + \
-                    loss_weight_img1 + loss_weight_img2 + loss_weight_img3 + loss_weight_img4 + loss_weight_img5)
-
-        self.log("train_loss_t1", loss_t1)
-        self.log("train_loss_t2", loss_t2)
-        self.log("train_loss_pd", loss_pd)
-        self.log("train_loss_img1", loss_img1)
-        self.log("train_loss_img2", loss_img2)
-        self.log("train_loss_img3", loss_img3)
-        self.log("train_loss_img4", loss_img4)
-        self.log("train_loss_img5", loss_img5)
+            outputs = {key: value + 1e-5 for key, value in outputs.items()}
+            targets = {key: value + 1e-5 for key, value in targets.items()}
+
+        losses = self.losses(outputs, targets)
+        loss = sum(losses[key] * self.loss_weights[key] for key in losses) / sum(self.loss_weights.values())
+
+        # the mean over the samples of all sessions is 1 / num_models of the
+        # sum of the per-session losses: scale it back so that each mapping
+        # network gets the gradient of its own training run
+        loss = loss * self.num_models
+
+        for key, value in losses.items():
+            self.log(f"train_loss_{key}", value)
+
+        if self.collect_train_as_val():
+            with torch.no_grad():
+                self.train_val_logs.append(
+                    self.validation_step_end(
+                        self.validation_logs(
+                            batch,
+                            batch_idx,
+                            {key: value.detach() for key, value in outputs.items()},
+                            targets,
+                            {key: value.detach() for key, value in losses.items()},
+                        )
+                    )
+                )
 
         return loss
 
 
     def validation_step(self, batch, batch_idx):
-        output_t1, output_t2, output_pd, output_ie, output_b1, \
-        output_img1, output_img2, output_img3, output_img4, output_img5 = \
-            self.forward(batch.masked_kspace_acq1, batch.masked_kspace_acq2, batch.masked_kspace_acq3, batch.masked_kspace_acq4, batch.masked_kspace_acq5, \
-                        batch.mask_acq1, batch.mask_acq2, batch.mask_acq3, batch.mask_acq4, batch.mask_acq5, batch.mask_brain, \
-                        # batch.coil_sens, \
-                        batch.b1, batch.ie, batch.max_value_t1, batch.max_value_t2, batch.max_value_pd, batch.num_low_frequencies)
-
-        # If raw k-space data were used, use following 5 lines
-        # img_acq1 = fastmri.complex_abs(fastmri.complex_mul(fastmri.ifft2c(batch.masked_kspace_acq1), fastmri.complex_conj(batch.coil_sens)).sum(dim=1, keepdim=True)) / np.sqrt(batch.masked_kspace_acq1.shape[2] * batch.masked_kspace_acq1.shape[3])
-        # img_acq2 = -fastmri.complex_abs(fastmri.complex_mul(fastmri.ifft2c(batch.masked_kspace_acq2), fastmri.complex_conj(batch.coil_sens)).sum(dim=1, keepdim=True)) / np.sqrt(batch.masked_kspace_acq2.shape[2] * batch.masked_kspace_acq2.shape[3])
-        # img_acq3 = fastmri.complex_abs(fastmri.complex_mul(fastmri.ifft2c(batch.masked_kspace_acq3), fastmri.complex_conj(batch.coil_sens)).sum(dim=1, keepdim=True)) / np.sqrt(batch.masked_kspace_acq3.shape[2] * batch.masked_kspace_acq3.shape[3])
-        # img_acq4 = fastmri.complex_abs(fastmri.complex_mul(fastmri.ifft2c(batch.masked_kspace_acq4), fastmri.complex_conj(batch.coil_sens)).sum(dim=1, keepdim=True)) / np.sqrt(batch.masked_kspace_acq4.shape[2] * batch.masked_kspace_acq4.shape[3])
-        # img_acq5 = fastmri.complex_abs(fastmri.complex_mul(fastmri.ifft2c(batch.masked_kspace_acq5), fastmri.complex_conj(batch.coil_sens)).sum(dim=1, keepdim=True)) / np.sqrt(batch.masked_kspace_acq5.shape[2] * batch.masked_kspace_acq5.shape[3])
-
-        # If DICOM data were used, use following 5 lines
-        img_acq1 = batch.masked_kspace_acq1
-        img_acq2 = -batch.masked_kspace_acq2
-        img_acq3 = batch.masked_kspace_acq3
-        img_acq4 = batch.masked_kspace_acq4
-        img_acq5 = batch.masked_kspace_acq5
-
-        target_t1, output_t1 = transforms_qalas.center_crop_to_smallest(batch.target_t1, output_t1)
-        target_t2, output_t2 = transforms_qalas.center_crop_to_smallest(batch.target_t2, output_t2)
-        target_pd, output_pd = transforms_qalas.center_crop_to_smallest(batch.target_pd, output_pd)
-        target_pd, output_ie = transforms_qalas.center_crop_to_smallest(batch.target_pd, output_ie)
-        target_pd, output_b1 = transforms_qalas.center_crop_to_smallest(batch.target_pd, output_b1)
-
-        target_t1, img_acq1 = transforms_qalas.center_crop_to_smallest(batch.target_t1, img_acq1.squeeze(1))
-        target_t1, img_acq2 = transforms_qalas.center_crop_to_smallest(batch.target_t1, img_acq2.squeeze(1))
-        target_t1, img_acq3 = transforms_qalas.center_crop_to_smallest(batch.target_t1, img_acq3.squeeze(1))
-        target_t1, img_acq4 = transforms_qalas.center_crop_to_smallest(batch.target_t1, img_acq4.squeeze(1))
-        target_t1, img_acq5 = transforms_qalas.center_crop_to_smallest(batch.target_t1, img_acq5.squeeze(1))
-
-        target_t1, output_img1 = transforms_qalas.center_crop_to_smallest(batch.target_t1, output_img1.squeeze(1))
-        target_t1, output_img2 = transforms_qalas.center_crop_to_smallest(batch.target_t1, output_img2.squeeze(1))
-        target_t1, output_img3 = transforms_qalas.center_crop_to_smallest(batch.target_t1, output_img3.squeeze(1))
-        target_t1, output_img4 = transforms_qalas.center_crop_to_smallest(batch.target_t1, output_img4.squeeze(1))
-        target_t1, output_img5 = transforms_qalas.center_crop_to_smallest(batch.target_t1, output_img5.squeeze(1))
-
-        target_t1 = target_t1 * batch.mask_brain
-        target_t2 = target_t2 * batch.mask_brain
-        target_pd = target_pd * batch.mask_brain
-
-        output_t1 = output_t1 * batch.mask_brain
-        output_t2 = output_t2 * batch.mask_brain
-        output_pd = output_pd * batch.mask_brain
-        output_ie = output_ie * batch.mask_brain
-        output_b1 = output_b1 * batch.mask_brain
-
-        img_acq1 = img_acq1 * batch.mask_brain
-        img_acq2 = img_acq2 * batch.mask_brain
-        img_acq3 = img_acq3 * batch.mask_brain
-        img_acq4 = img_acq4 * batch.mask_brain
-        img_acq5 = img_acq5 * batch.mask_brain
-
-        output_img1 = output_img1 * batch.mask_brain
-        output_img2 = output_img2 * batch.mask_brain
-        output_img3 = output_img3 * batch.mask_brain
-        output_img4 = output_img4 * batch.mask_brain
-        output_img5 = output_img5 * batch.mask_brain
-
-        def loss_tv(img):
-            pixel_dif1 = img[..., 1:,:] - img[..., :-1,:]
-            pixel_dif2 = img[..., :,1:] - img[..., :,:-1]
-            reduce_axes = (-2,-1)
-            res1 = pixel_dif1.abs().sum(dim=reduce_axes)
-            res2 = pixel_dif2.abs().sum(dim=reduce_axes)
-            return (res1 + res2) / (img.shape[-1] * img.shape[-2])
-        loss_img1_tv = loss_tv(output_img1)
-        loss_img2_tv = loss_tv(output_img2)
-        loss_img3_tv = loss_tv(output_img3)
-        loss_img4_tv = loss_tv(output_img4)
-        loss_img5_tv = loss_tv(output_img5)
-
-        loss_weight_t1 = 0
-        loss_weight_t2 = 0
-        loss_weight_pd = 0
-        loss_weight_img1 = 1
-        loss_weight_img2 = 1
-        loss_weight_img3 = 1
-        loss_weight_img4 = 1
-        loss_weight_img5 = 1
-        loss_weight_img1_tv = 0
-        loss_weight_img2_tv = 0
-        loss_weight_img3_tv = 0
-        loss_weight_img4_tv = 0
-        loss_weight_img5_tv = 0
+        output = self.forward_batch(batch, slice_keys=list(zip(batch.fname, batch.slice_num.tolist())))
+
+        outputs, targets = self.crop_and_mask(batch, output)
+
+        return self.validation_logs(batch, batch_idx, outputs, targets, self.losses(outputs, targets))
+
+    def validation_logs(self, batch, batch_idx, outputs, targets, losses):
+        """
+        The dict returned by validation_step.
+
+        Args:
+            batch: The QALASSample batch.
+            batch_idx: Index of the batch.
+            outputs: Outputs of `crop_and_mask`.
+            targets: Targets of `crop_and_mask`.
+            losses: Losses of `losses`. The losses of zero weight are logged
+                as zeros.
+        """
+        zero = outputs["img"].new_zeros(())
+        output_imgs = torch.abs(outputs["img"])
+        target_imgs = torch.abs(targets["img"])
 
         return {
             "batch_idx": batch_idx,
@@ -334,66 +280,52 @@ class QALAS_MAPModule(MriModuleQALAS_MAP):
             "max_value_t1": batch.max_value_t1,
             "max_value_t2": batch.max_value_t2,
             "max_value_pd": torch.ones_like(batch.max_value_t1),
-            "output_t1": output_t1,
-            "output_t2": output_t2,
-            "output_pd": output_pd,
-            "output_ie": output_ie,
-            "output_b1": output_b1,
-            "output_img1": torch.abs(output_img1),
-            "output_img2": torch.abs(output_img2),
-            "output_img3": torch.abs(output_img3),
-            "output_img4": torch.abs(output_img4),
-            "output_img5": torch.abs(output_img5),
-            "target_t1": target_t1,
-            "target_t2": target_t2,
-            "target_pd": target_pd,
-            "target_img1": torch.abs(img_acq1),
-            "target_img2": torch.abs(img_acq2),
-            "target_img3": torch.abs(img_acq3),
-            "target_img4": torch.abs(img_acq4),
-            "target_img5": torch.abs(img_acq5),
-            "val_loss_t1": self.loss_l2_t1(output_t1.unsqueeze(1), target_t1.unsqueeze(1)),
-            "val_loss_t2": self.loss_l2_t2(output_t2.unsqueeze(1), target_t2.unsqueeze(1)),
-            "val_loss_pd": self.loss_l2_pd(output_pd.unsqueeze(1) / output_pd.max(), target_pd.unsqueeze(1) / target_pd.max()),
-            "val_loss_img1": self.loss_l2_img1(output_img1.unsqueeze(1), img_acq1.unsqueeze(1)),
-            "val_loss_img2": self.loss_l2_img2(output_img2.unsqueeze(1), img_acq2.unsqueeze(1)),
-            "val_loss_img3": self.loss_l2_img3(output_img3.unsqueeze(1), img_acq3.unsqueeze(1)),
-            "val_loss_img4": self.loss_l2_img4(output_img4.unsqueeze(1), img_acq4.unsqueeze(1)),
-            "val_loss_img5": self.loss_l2_img5(output_img5.unsqueeze(1), img_acq5.unsqueeze(1)),
-            "loss_weight_t1": loss_weight_t1,
-            "loss_weight_t2": loss_weight_t2,
-            "loss_weight_pd": loss_weight_pd,
-            "loss_weight_img1": loss_weight_img1,
-            "loss_weight_img2": loss_weight_img2,
-            "loss_weight_img3": loss_weight_img3,
-            "loss_weight_img4": loss_weight_img4,
-            "loss_weight_img5": loss_weight_img5,
+            "output_t1": outputs["t1"],
+            "output_t2": outputs["t2"],
+            "output_pd": outputs["pd"],
+            "output_ie": outputs["ie"],
+            "output_b1": outputs["b1"],
+            "output_img1": output_imgs[:, 0],
+            "output_img2": output_imgs[:, 1],
+            "output_img3": output_imgs[:, 2],
+            "output_img4": output_imgs[:, 3],
+            "output_img5": output_imgs[:, 4],
+            "target_t1": targets["t1"],
+            "target_t2": targets["t2"],
+            "target_pd": targets["pd"],
+            "target_img1": target_imgs[:, 0],
+            "target_img2": target_imgs[:, 1],
+            "target_img3": target_imgs[:, 2],
+            "target_img4": target_imgs[:, 3],
+            "target_img5": target_imgs[:, 4],
+            "val_loss_t1": losses.get("t1", zero),
+            "val_loss_t2": losses.get("t2", zero),
+            "val_loss_pd": losses.get("pd", zero),
+            "val_loss_img1": losses.get("img1", zero),
+            "val_loss_img2": losses.get("img2", zero),
+            "val_loss_img3": losses.get("img3", zero),
+            "val_loss_img4": losses.get("img4", zero),
+            "val_loss_img5": losses.get("img5", zero),
+            "loss_weight_t1": self.loss_weights["t1"],
+            "loss_weight_t2": self.loss_weights["t2"],
+            "loss_weight_pd": self.loss_weights["pd"],
+            "loss_weight_img1": self.loss_weights["img1"],
+            "loss_weight_img2": self.loss_weights["img2"],
+            "loss_weight_img3": self.loss_weights["img3"],
+            "loss_weight_img4": self.loss_weights["img4"],
+            "loss_weight_img5": self.loss_weights["img5"],
         }
 
-
     def test_step(self, batch, batch_idx):
-        output_t1, output_t2, output_pd, output_ie, \
-        output_img1, output_img2, output_img3, output_img4, output_img5 = \
-            self(batch.masked_kspace_acq1, batch.masked_kspace_acq2, batch.masked_kspace_acq3, batch.masked_kspace_acq4, batch.masked_kspace_acq5, \
-                batch.mask_acq1, batch.mask_acq2, batch.mask_acq3, batch.mask_acq4, batch.mask_acq5, batch.mask_brain, \
-                # batch.coil_sens, \
-                batch.b1, batch.ie, batch.max_value_t1, batch.max_value_t2, batch.max_value_pd, batch.num_low_frequencies)
+        maps = self.forward_batch(batch, return_images=False).maps
 
         # check for FLAIR 203
-        if output_t1.shape[-1] < batch.crop_size[1]:
-            crop_size = (output_t1.shape[-1], output_t1.shape[-1])
-        else:
-            crop_size = batch.crop_size
+        crop_size = tuple(batch.crop_size[0].tolist())
+        if maps.shape[-1] < crop_size[1]:
+            crop_size = (maps.shape[-1], maps.shape[-1])
 
-        output_t1 = transforms_qalas.center_crop(output_t1, crop_size)
-        output_t2 = transforms_qalas.center_crop(output_t2, crop_size)
-        output_pd = transforms_qalas.center_crop(output_pd, crop_size)
-        output_ie = transforms_qalas.center_crop(output_ie, crop_size)
-
-        output_t1 = output_t1 * batch.mask_brain
-        output_t2 = output_t2 * batch.mask_brain
-        output_pd = output_pd * batch.mask_brain
-        output_ie = output_ie * batch.mask_brain
+        maps = transforms_qalas.center_crop(maps, crop_size) * batch.mask_brain.unsqueeze(1)
+        output_t1, output_t2, output_pd, output_ie, output_b1 = maps.unbind(1)
 
         return {
             "fname": batch.fname,
@@ -402,6 +334,7 @@ class QALAS_MAPModule(MriModuleQALAS_MAP):
             "output_t2": output_t2.cpu().numpy(),
             "output_pd": output_pd.cpu().numpy(),
             "output_ie": output_ie.cpu().numpy(),
+            "output_b1": output_b1.cpu().numpy(),
         }
 
     def configure_optimizers(self):
@@ -455,6 +388,32 @@ class QALAS_MAPModule(MriModuleQALAS_MAP):
             type=float,
             help="Number of layers for mapping CNN in QALAS",
         )
+        parser.add_argument(
+            "--steady_state",
+            choices=("closed_form", "iterative"),
+            default="closed_form",
+            type=str,
+            help="Steady-state solver of the QALAS forward model",
+        )
+        parser.add_argument(
+            "--forward_model",
+            choices=("analytic", "lookup"),
+            default="analytic",
+            type=str,
+            help="QALAS forward model, analytic or interpolated in a lookup table",
+        )
+        parser.add_argument(
+            "--voxel_packed",
+            default=False,
+            action="store_true",
+            help="Run the mapping output layer and the forward model on brain voxels only",
+        )
+        parser.add_argument(
+            "--b1_cache_size",
+            default=512,
+            type=int,
+            help="Number of slices whose B1 terms are cached (least recently used), 0 to disable",
+        )
 
         # training params (opt)
         parser.add_argument(
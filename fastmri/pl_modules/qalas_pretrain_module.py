@@ -0,0 +1,194 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+from argparse import ArgumentParser
+from typing import Dict, Optional
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+from fastmri.data.sequence_params_qalas import SequenceParams
+from fastmri.models import QALAS_MAP
+
+
+class QALASPretrainModule(pl.LightningModule):
+    """
+    Supervised pretraining of the QALAS mapping network.
+
+    The mapping network is trained on a synthetic corpus written by
+    `generate_corpus_qalas`, to regress the known T1, T2, PD and IE maps of
+    every pseudo-slice. The network lives in a `QALAS_MAP` as in
+    `QALAS_MAPModule`, and the sequence parameters of the corpus are saved in
+    the hyperparameters, so the checkpoints can warm start the
+    self-supervised training (`--init_from` or `--init_library` in
+    `train_qalas.py`).
+    """
+
+    def __init__(
+        self,
+        maps_chans: int = 32,
+        maps_layers: int = 5,
+        lr: float = 0.0003,
+        lr_step_size: int = 40,
+        lr_gamma: float = 0.1,
+        weight_decay: float = 0.0,
+        seq_params: Optional[Dict] = None,
+        max_value_t1: float = 5.0,
+        max_value_t2: float = 2.5,
+        **kwargs,
+    ):
+        """
+        Args:
+            maps_chans: Number of channels for the mapping CNN.
+            maps_layers: Number of layers for the mapping CNN.
+            lr: Learning rate.
+            lr_step_size: Learning rate step size.
+            lr_gamma: Learning rate gamma decay.
+            weight_decay: Parameter for penalizing weights norm.
+            seq_params: Sequence parameters of the corpus as a dict (see
+                `SequenceParams._asdict`).
+            max_value_t1: Scaling of the T1 map (the `max_t1` attribute of
+                the data the network will be fine-tuned on).
+            max_value_t2: Scaling of the T2 map.
+        """
+        super().__init__(**kwargs)
+        self.save_hyperparameters()
+
+        self.maps_chans = maps_chans
+        self.maps_layers = maps_layers
+        self.lr = lr
+        self.lr_step_size = lr_step_size
+        self.lr_gamma = lr_gamma
+        self.weight_decay = weight_decay
+        self.seq_params = SequenceParams(**seq_params) if seq_params is not None else None
+        self.max_value_t1 = max_value_t1
+        self.max_value_t2 = max_value_t2
+
+        self.qalas = QALAS_MAP(
+            num_cascades=1,
+            maps_chans=self.maps_chans,
+            maps_layers=self.maps_layers,
+            seq_params=self.seq_params,
+        )
+
+        self.loss_l2_t1 = torch.nn.MSELoss()
+        self.loss_l2_t2 = torch.nn.MSELoss()
+        self.loss_l2_pd = torch.nn.MSELoss()
+        self.loss_l2_ie = torch.nn.MSELoss()
+
+    def forward(self, signals):
+        return self.qalas.maps_net(signals)
+
+    def targets(self, batch):
+        # targets in the output range of the mapping network, see QALAS_MAP
+        target_t1 = batch.t1 / self.max_value_t1
+        target_t2 = batch.t2 / self.max_value_t2
+        target_pd = torch.clamp(batch.pd * np.sin(np.pi / 180 * 4), 0, 1)
+        target_ie = (batch.ie - 0.5) / (1 - 0.5)
+
+        return target_t1, target_t2, target_pd, target_ie
+
+    def losses(self, batch):
+        map_pred = self(batch.signals)
+        target_t1, target_t2, target_pd, target_ie = self.targets(batch)
+        mask = batch.mask > 0
+
+        loss_t1 = self.loss_l2_t1(map_pred[:, 0][mask], target_t1[mask])
+        loss_t2 = self.loss_l2_t2(map_pred[:, 1][mask], target_t2[mask])
+        loss_pd = self.loss_l2_pd(map_pred[:, 2][mask], target_pd[mask])
+        loss_ie = self.loss_l2_ie(map_pred[:, 3][mask], target_ie[mask])
+
+        return loss_t1, loss_t2, loss_pd, loss_ie
+
+    def training_step(self, batch, batch_idx):
+        loss_t1, loss_t2, loss_pd, loss_ie = self.losses(batch)
+        loss = (loss_t1 + loss_t2 + loss_pd + loss_ie) / 4
+
+        self.log("train_loss_t1", loss_t1)
+        self.log("train_loss_t2", loss_t2)
+        self.log("train_loss_pd", loss_pd)
+        self.log("train_loss_ie", loss_ie)
+
+        return loss
+
+    def validation_step(self, batch, batch_idx):
+        loss_t1, loss_t2, loss_pd, loss_ie = self.losses(batch)
+        loss = (loss_t1 + loss_t2 + loss_pd + loss_ie) / 4
+
+        self.log("val_loss_t1", loss_t1)
+        self.log("val_loss_t2", loss_t2)
+        self.log("val_loss_pd", loss_pd)
+        self.log("val_loss_ie", loss_ie)
+        self.log("validation_loss", loss, prog_bar=True)
+
+    def configure_optimizers(self):
+        optim = torch.optim.Adam(
+            self.parameters(), lr=self.lr, weight_decay=self.weight_decay
+        )
+        scheduler = torch.optim.lr_scheduler.StepLR(
+            optim, self.lr_step_size, self.lr_gamma
+        )
+
+        return [optim], [scheduler]
+
+    @staticmethod
+    def add_model_specific_args(parent_parser):  # pragma: no-cover
+        """
+        Define parameters that only apply to this model
+        """
+        parser = ArgumentParser(parents=[parent_parser], add_help=False)
+
+        # network params
+        parser.add_argument(
+            "--maps_chans",
+            default=32,
+            type=int,
+            help="Number of channels for mapping CNN in QALAS",
+        )
+        parser.add_argument(
+            "--maps_layers",
+            default=5,
+            type=int,
+            help="Number of layers for mapping CNN in QALAS",
+        )
+        parser.add_argument(
+            "--max_value_t1",
+            default=5.0,
+            type=float,
+            help="Scaling of the T1 map",
+        )
+        parser.add_argument(
+            "--max_value_t2",
+            default=2.5,
+            type=float,
+            help="Scaling of the T2 map",
+        )
+
+        # training params (opt)
+        parser.add_argument(
+            "--lr", default=0.0003, type=float, help="Adam learning rate"
+        )
+        parser.add_argument(
+            "--lr_step_size",
+            default=40,
+            type=int,
+            help="Epoch at which to decrease step size",
+        )
+        parser.add_argument(
+            "--lr_gamma",
+            default=0.1,
+            type=float,
+            help="Extent to which step size should be decreased",
+        )
+        parser.add_argument(
+            "--weight_decay",
+            default=0.0,
+            type=float,
+            help="Strength of weight decay regularization",
+        )
+
+        return parser
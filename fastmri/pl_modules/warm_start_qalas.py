@@ -0,0 +1,146 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import json
+import os
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+from fastmri.data import SequenceParams
+
+
+def _matches(
+    hparams: Dict,
+    seq_params: SequenceParams,
+    maps_chans: Optional[int],
+    maps_layers: Optional[int],
+    rtol: float,
+) -> bool:
+    if hparams.get("seq_params") is None:
+        return False
+    if maps_chans is not None and hparams.get("maps_chans") != maps_chans:
+        return False
+    if maps_layers is not None and hparams.get("maps_layers") != maps_layers:
+        return False
+
+    other = hparams["seq_params"]
+    for key, value in seq_params._asdict().items():
+        if key not in other:
+            return False
+        if key == "manufacturer":
+            if str(other[key]).upper() != str(value).upper():
+                return False
+        elif not np.isclose(other[key], value, rtol=rtol, atol=0):
+            return False
+
+    return True
+
+
+def find_warm_start_checkpoint(
+    library: Union[str, Path, os.PathLike],
+    seq_params: SequenceParams,
+    maps_chans: Optional[int] = None,
+    maps_layers: Optional[int] = None,
+    rtol: float = 1e-3,
+) -> Optional[Path]:
+    """
+    Pick a checkpoint to warm start from in a local checkpoint library.
+
+    The library is any directory holding QALAS_MAPModule checkpoints, e.g.
+    the log directories of previous runs. Checkpoints are matched on the
+    scanner manufacturer and the sequence parameters saved in their
+    hyperparameters, and on the size of the mapping network if given. The
+    most recent match is returned.
+
+    Args:
+        library: Directory searched recursively for .ckpt files.
+        seq_params: Sequence parameters of the session to train.
+        maps_chans: Number of channels of the mapping network.
+        maps_layers: Number of layers of the mapping network.
+        rtol: Relative tolerance on the sequence parameters.
+
+    Returns:
+        The path to the checkpoint, or None if no checkpoint matches.
+    """
+    matches = []
+    for fname in Path(library).rglob("*.ckpt"):
+        checkpoint = torch.load(fname, map_location="cpu")
+        hparams = checkpoint.get("hyper_parameters", {})
+        if _matches(hparams, seq_params, maps_chans, maps_layers, rtol):
+            matches.append(fname)
+
+    if not matches:
+        return None
+
+    return max(matches, key=os.path.getmtime)
+
+
+def load_maps_net(
+    model: pl.LightningModule, checkpoint_file: Union[str, Path, os.PathLike]
+) -> Dict:
+    """
+    Initialize the mapping network of a QALAS_MAPModule from a checkpoint.
+
+    Only the `qalas.maps_net` weights are loaded, the optimizer state and
+    the training progress of the checkpoint are discarded. The mapping
+    networks of a grouped model (`num_models > 1`) all start from the
+    checkpoint weights.
+
+    Args:
+        model: Module to initialize.
+        checkpoint_file: Checkpoint of a previous QALAS_MAPModule run.
+
+    Returns:
+        A dict describing the reference run the weights come from, with its
+        number of epochs and, if its run summary is found next to the
+        checkpoint directory, its training time. Both are None for networks
+        pretrained on a synthetic corpus.
+    """
+    checkpoint_file = Path(checkpoint_file)
+    checkpoint = torch.load(checkpoint_file, map_location="cpu")
+
+    prefix = "qalas.maps_net."
+    state_dict = {
+        k[len(prefix) :]: v
+        for k, v in checkpoint["state_dict"].items()
+        if k.startswith(prefix)
+    }
+    if not state_dict:
+        raise ValueError(f"{checkpoint_file} has no {prefix[:-1]} weights.")
+    # a grouped model starts every mapping network from the same weights
+    num_models = model.qalas.num_models // checkpoint.get("hyper_parameters", {}).get("num_models", 1)
+    if num_models > 1:
+        state_dict = {k: torch.cat([v] * num_models) for k, v in state_dict.items()}
+    model.qalas.maps_net.load_state_dict(state_dict)
+
+    reference = {
+        "init_from": str(checkpoint_file),
+        "reference_epochs": checkpoint.get("epoch", -1) + 1,
+        "reference_train_time_s": None,
+    }
+
+    # checkpoints are saved in <default_root_dir>/checkpoints
+    summary_file = checkpoint_file.parent.parent / "run_summary.json"
+    if summary_file.exists():
+        with open(summary_file, "r") as f:
+            summary = json.load(f)
+        # a pretrained network has no self-supervised reference run, and a
+        # warm-started reference is compared to its own cold-start reference
+        if summary.get("pretrain"):
+            summary = {"epochs": None}
+        elif summary.get("warm_start") is not None:
+            summary = {
+                "epochs": summary["warm_start"]["reference_epochs"],
+                "train_time_s": summary["warm_start"]["reference_train_time_s"],
+            }
+        reference["reference_epochs"] = summary.get("epochs", reference["reference_epochs"])
+        reference["reference_train_time_s"] = summary.get("train_time_s")
+
+    return reference
@@ -0,0 +1,333 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Optional, Sequence, Tuple, Union
+
+import h5py
+import numpy as np
+import torch
+from fastmri.data import SequenceParams
+from fastmri.data.synthetic_qalas import create_corpus_qalas
+from fastmri.models.qalas_map import MapOutput, QALASBlock
+
+# default grids: log-spaced relaxation times (s), linear IE and B1
+T1_GRID = np.geomspace(0.05, 5.0, 100)
+T2_GRID = np.geomspace(0.005, 2.5, 60)
+IE_GRID = np.linspace(0.5, 1.0, 6)
+B1_BINS = np.linspace(0.5, 1.5, 21)
+
+
+class QALASDictionary:
+    """
+    Dictionary matching of the QALAS images.
+
+    For every B1 bin, the magnitude of the five readouts is simulated with
+    `QALASBlock.qalas_forward_eq` (PD = 1) on a T1 x T2 x IE grid. A voxel is
+    matched to the atom of its B1 bin with the largest normalized inner
+    product, and its PD is the scale factor between the voxel and the atom.
+    Matching runs in chunks of voxels, so memory stays bounded by
+    `chunk_size x num_atoms` scores.
+
+    Dictionaries only depend on the sequence parameters and the grids, so
+    `cached` keeps them on disk under a key derived from both.
+
+    Example:
+        dictionary = QALASDictionary.cached(SequenceParams.from_h5(fname), "~/.cache/qalas")
+        t1, t2, pd, ie = dictionary.match(signals, b1)
+    """
+
+    def __init__(
+        self,
+        seq_params: SequenceParams,
+        t1_grid: Sequence[float] = T1_GRID,
+        t2_grid: Sequence[float] = T2_GRID,
+        ie_grid: Sequence[float] = IE_GRID,
+        b1_bins: Sequence[float] = B1_BINS,
+    ):
+        """
+        Args:
+            seq_params: Sequence parameters of the forward model.
+            t1_grid: T1 values of the dictionary in seconds.
+            t2_grid: T2 values of the dictionary in seconds. Atoms with
+                T2 > T1 are left out.
+            ie_grid: Inversion efficiency values of the dictionary.
+            b1_bins: B1 values of the bins. Voxels are matched in the bin
+                with the closest B1.
+        """
+        self.seq_params = seq_params
+        self.t1_grid = np.asarray(t1_grid, dtype=np.float64)
+        self.t2_grid = np.asarray(t2_grid, dtype=np.float64)
+        self.ie_grid = np.asarray(ie_grid, dtype=np.float64)
+        self.b1_bins = np.asarray(b1_bins, dtype=np.float64)
+
+        # (num_atoms, 3) T1, T2 and IE of the atoms
+        self.params: Optional[torch.Tensor] = None
+        # (num_b1_bins, num_atoms, 5) unit-norm atoms and their norms
+        self.atoms: Optional[torch.Tensor] = None
+        self.atom_norms: Optional[torch.Tensor] = None
+
+    @property
+    def key(self) -> str:
+        """
+        Hash of the sequence parameters and the grids.
+        """
+        description = json.dumps(
+            {
+                "seq_params": self.seq_params._asdict(),
+                "t1_grid": self.t1_grid.tolist(),
+                "t2_grid": self.t2_grid.tolist(),
+                "ie_grid": self.ie_grid.tolist(),
+                "b1_bins": self.b1_bins.tolist(),
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha1(description.encode()).hexdigest()[:16]
+
+    def build(self) -> "QALASDictionary":
+        """
+        Simulate the atoms of every B1 bin.
+        """
+        t1, t2, ie = np.meshgrid(self.t1_grid, self.t2_grid, self.ie_grid, indexing="ij")
+        keep = t2 <= t1
+        params = torch.from_numpy(np.stack((t1[keep], t2[keep], ie[keep]), axis=1))
+
+        block = QALASBlock(seq_params=self.seq_params)
+        atoms = []
+        with torch.no_grad():
+            for b1 in self.b1_bins:
+                signals = block.qalas_forward_eq(
+                    params[:, 0],
+                    params[:, 1],
+                    torch.ones_like(params[:, 0]),
+                    params[:, 2],
+                    torch.full_like(params[:, 0], b1),
+                )
+                atoms.append(torch.abs(torch.stack(signals, dim=1)))
+        atoms = torch.stack(atoms)
+
+        self.params = params.float()
+        self.atom_norms = torch.linalg.norm(atoms, dim=-1).float()
+        self.atoms = (atoms / self.atom_norms.unsqueeze(-1)).float()
+
+        return self
+
+    def save(self, fname: Union[str, Path, os.PathLike]):
+        np.savez(
+            fname,
+            seq_params=json.dumps(self.seq_params._asdict()),
+            t1_grid=self.t1_grid,
+            t2_grid=self.t2_grid,
+            ie_grid=self.ie_grid,
+            b1_bins=self.b1_bins,
+            params=self.params.numpy(),
+            atoms=self.atoms.numpy(),
+            atom_norms=self.atom_norms.numpy(),
+        )
+
+    @classmethod
+    def load(cls, fname: Union[str, Path, os.PathLike]) -> "QALASDictionary":
+        with np.load(fname) as data:
+            dictionary = cls(
+                SequenceParams(**json.loads(str(data["seq_params"]))),
+                t1_grid=data["t1_grid"],
+                t2_grid=data["t2_grid"],
+                ie_grid=data["ie_grid"],
+                b1_bins=data["b1_bins"],
+            )
+            dictionary.params = torch.from_numpy(data["params"])
+            dictionary.atoms = torch.from_numpy(data["atoms"])
+            dictionary.atom_norms = torch.from_numpy(data["atom_norms"])
+
+        return dictionary
+
+    @classmethod
+    def cached(
+        cls,
+        seq_params: SequenceParams,
+        cache_dir: Optional[Union[str, Path, os.PathLike]] = None,
+        **grids,
+    ) -> "QALASDictionary":
+        """
+        Load the dictionary from the cache, or build and cache it.
+
+        Args:
+            seq_params: Sequence parameters of the forward model.
+            cache_dir: Optional; Cache directory, defaults to
+                `~/.cache/qalas_dictionary`.
+            grids: Optional; Grids passed to the constructor.
+        """
+        dictionary = cls(seq_params, **grids)
+        if cache_dir is None:
+            cache_dir = Path.home() / ".cache" / "qalas_dictionary"
+        fname = Path(cache_dir).expanduser() / f"qalas_dictionary_{dictionary.key}.npz"
+
+        if fname.exists():
+            return cls.load(fname)
+
+        dictionary.build()
+        fname.parent.mkdir(parents=True, exist_ok=True)
+        dictionary.save(fname)
+
+        return dictionary
+
+    def match(
+        self,
+        signals: torch.Tensor,
+        b1: torch.Tensor,
+        chunk_size: int = 256,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Match voxels to the dictionary.
+
+        Args:
+            signals: Magnitude of the five readouts, shape `(num_voxels, 5)`.
+            b1: B1 of the voxels, shape `(num_voxels,)`.
+            chunk_size: Number of voxels matched at once.
+
+        Returns:
+            T1, T2, PD and IE of the voxels, each of shape `(num_voxels,)`.
+        """
+        if self.atoms is None:
+            self.build()
+
+        device = signals.device
+        signals = torch.abs(signals).float()
+        atoms = self.atoms.to(device)
+        atom_norms = self.atom_norms.to(device)
+        params = self.params.to(device)
+
+        b1_bins = torch.as_tensor(self.b1_bins, dtype=torch.float32, device=device)
+        bins = torch.bucketize(b1.float(), (b1_bins[1:] + b1_bins[:-1]) / 2)
+
+        t1 = signals.new_zeros(signals.shape[0])
+        t2 = signals.new_zeros(signals.shape[0])
+        pd = signals.new_zeros(signals.shape[0])
+        ie = signals.new_zeros(signals.shape[0])
+        for b in torch.unique(bins).tolist():
+            voxels = torch.nonzero(bins == b).flatten()
+            for start in range(0, len(voxels), chunk_size):
+                chunk = voxels[start:start + chunk_size]
+                # the inner product with unit-norm atoms is maximal for the
+                # atom with the best normalized inner product
+                scores = torch.mm(signals[chunk], atoms[b].t())
+                score, best = torch.max(scores, dim=1)
+                t1[chunk] = params[best, 0]
+                t2[chunk] = params[best, 1]
+                ie[chunk] = params[best, 2]
+                pd[chunk] = score / atom_norms[b, best]
+
+        return t1, t2, pd, ie
+
+    def map_slices(
+        self,
+        images: torch.Tensor,
+        b1: torch.Tensor,
+        mask: Optional[torch.Tensor] = None,
+        chunk_size: int = 256,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Map slices of QALAS images.
+
+        Args:
+            images: QALAS images of shape `(B, 5, H, W)`.
+            b1: B1 maps of shape `(B, H, W)`.
+            mask: Optional; Brain masks of shape `(B, H, W)`. Voxels outside
+                are not matched and set to zero.
+            chunk_size: Number of voxels matched at once.
+
+        Returns:
+            T1, T2, PD and IE maps, each of shape `(B, H, W)`.
+        """
+        if mask is None:
+            mask = torch.ones_like(b1)
+        mask = mask.reshape(b1.shape).to(images.device) > 0
+
+        signals = images.permute(0, 2, 3, 1)[mask]
+        maps = self.match(signals, b1.to(images.device)[mask], chunk_size)
+
+        outputs = []
+        for voxel_map in maps:
+            output = voxel_map.new_zeros(mask.shape)
+            output[mask] = voxel_map
+            outputs.append(output)
+
+        return tuple(outputs)
+
+    def __call__(
+        self,
+        images: torch.Tensor,
+        b1: torch.Tensor,
+        max_value_t1: torch.Tensor,
+        max_value_t2: torch.Tensor,
+        mask_brain: Optional[torch.Tensor] = None,
+        seq_params: Optional[torch.Tensor] = None,
+        slice_keys=None,
+        return_images: bool = False,
+    ) -> MapOutput:
+        # same interface as QALAS_MAP for inference (maps only)
+        if return_images:
+            raise ValueError("Dictionary matching does not simulate the images.")
+
+        b1 = b1.reshape(images.shape[0], *images.shape[-2:]).to(images.device)
+        t1, t2, pd, ie = self.map_slices(images, b1, mask_brain)
+
+        return MapOutput(torch.stack((t1, t2, pd, ie, b1.to(t1)), 1), None)
+
+
+def write_dictionary_corpus(
+    data_file: Union[str, Path, os.PathLike],
+    out_file: Union[str, Path, os.PathLike],
+    dictionary: Optional[QALASDictionary] = None,
+    cache_dir: Optional[Union[str, Path, os.PathLike]] = None,
+    compression: Optional[str] = None,
+):
+    """
+    Write the images of a session and their dictionary maps as a corpus for
+    `SyntheticSliceDatasetQALAS`.
+
+    Pretraining the mapping network on this corpus (`pretrain_qalas.py`)
+    initializes the self-supervised training of the session close to the
+    dictionary solution.
+
+    Args:
+        data_file: QALAS h5 file of the session.
+        out_file: Path to the corpus to write.
+        dictionary: Optional; Dictionary to match with, by default the cached
+            dictionary of the sequence parameters of the session.
+        cache_dir: Optional; Cache directory of the dictionaries.
+        compression: Optional; h5py compression filter.
+    """
+    seq_params = SequenceParams.from_h5(data_file)
+    if dictionary is None:
+        dictionary = QALASDictionary.cached(seq_params, cache_dir)
+
+    with h5py.File(data_file, "r") as hf, h5py.File(out_file, "w") as out:
+        num_slices = hf["kspace_acq1"].shape[0]
+        slice_shape = hf["kspace_acq1"].shape[-2:]
+        max_t1 = float(np.asarray(hf.attrs["max_t1"]).reshape(-1)[0])
+        max_t2 = float(np.asarray(hf.attrs["max_t2"]).reshape(-1)[0])
+        create_corpus_qalas(out, num_slices, slice_shape, seq_params, max_t1, max_t2, compression)
+
+        for i in range(num_slices):
+            images = torch.from_numpy(
+                np.concatenate([hf[f"kspace_acq{acq}"][i] for acq in range(1, 6)])
+            ).unsqueeze(0)
+            b1 = torch.from_numpy(hf["reconstruction_b1"][i]).unsqueeze(0)
+            mask = torch.from_numpy(hf["mask_brain"][i]).unsqueeze(0)
+            t1, t2, pd, ie = dictionary.map_slices(images, b1, mask)
+
+            out["signals"][i] = images[0].numpy()
+            out["b1"][i] = b1[0].numpy()
+            out["t1"][i] = t1[0].numpy()
+            out["t2"][i] = t2[0].numpy()
+            out["pd"][i] = pd[0].numpy()
+            out["ie"][i] = ie[0].numpy()
+            out["mask"][i] = mask[0].numpy()
@@ -6,7 +6,7 @@ LICENSE file in the root directory of this source tree.
 """
 
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Optional, Sequence, Tuple
 
 import h5py
 import numpy as np
@@ -68,6 +68,124 @@ def save_reconstructions_qalas_forward(reconstructions_img1: Dict[str, np.ndarra
             hf.create_dataset("reconstruction_img4", data=recons_img4)
             hf.create_dataset("reconstruction_img5", data=recons_img5)
 
+class ReconstructionWriterQALAS:
+    """
+    Streaming writer of QALAS reconstructions.
+
+    The `reconstruction_*` datasets of a file are created up front with
+    one-slice chunks, and every batch of slices is written as soon as it is
+    computed, so that only one batch has to be held in memory.
+
+    A file is written under a temporary `<fname>.partial` name, and closed
+    and renamed to `fname` once all its slices are written. Only the files
+    in progress are open, and an interrupted run leaves `.partial` files
+    instead of truncated files that look finished.
+
+    gzip-compressed float32 files can be read by MATLAB's h5read. lzf and
+    float16 give smaller or faster files but need an HDF5 reader with the
+    lzf filter and half-precision support, such as h5py.
+
+    Example:
+        with ReconstructionWriterQALAS(out_dir) as writer:
+            writer.create("val_data.h5", num_slices, (W, H))
+            writer.write("val_data.h5", slice_nums, {"t1": t1, ...})
+    """
+
+    def __init__(
+        self,
+        out_dir: Path,
+        keys: Sequence[str] = ("t1", "t2", "pd", "ie", "b1"),
+        compression: Optional[str] = "gzip",
+        compression_opts: Optional[int] = None,
+        float16: bool = False,
+    ):
+        """
+        Args:
+            out_dir: Path to the output directory where the reconstructions
+                should be saved.
+            keys: Maps to save, as `reconstruction_<key>` datasets.
+            compression: Optional; "gzip", "lzf" or None.
+            compression_opts: Optional; gzip level (0-9), 4 by default.
+            float16: Whether to store the maps as float16 instead of float32.
+        """
+        if compression not in (None, "gzip", "lzf"):
+            raise ValueError(f"Unsupported compression {compression}")
+
+        self.out_dir = Path(out_dir)
+        self.keys = tuple(keys)
+        self.compression = compression
+        self.compression_opts = compression_opts if compression == "gzip" else None
+        self.dtype = np.float16 if float16 else np.float32
+        # files in progress and their written slices
+        self.files: Dict[str, h5py.File] = {}
+        self.written: Dict[str, np.ndarray] = {}
+
+        self.out_dir.mkdir(exist_ok=True, parents=True)
+
+    def create(self, fname: str, num_slices: int, slice_shape: Tuple[int, int]):
+        """
+        Create the output file and its datasets.
+
+        Args:
+            fname: Name of the output file.
+            num_slices: Number of slices of the volume.
+            slice_shape: Shape of one slice of the maps.
+        """
+        hf = h5py.File(self.partial_path(fname), "w")
+        for key in self.keys:
+            hf.create_dataset(
+                f"reconstruction_{key}",
+                shape=(num_slices,) + tuple(slice_shape),
+                dtype=self.dtype,
+                chunks=(1,) + tuple(slice_shape),
+                compression=self.compression,
+                compression_opts=self.compression_opts,
+            )
+        self.files[fname] = hf
+        self.written[fname] = np.zeros(num_slices, dtype=bool)
+
+    def partial_path(self, fname: str) -> Path:
+        return self.out_dir / f"{fname}.partial"
+
+    def write(self, fname: str, slice_nums: Sequence[int], maps: Dict[str, np.ndarray]):
+        """
+        Write a batch of slices, and finish the file once all its slices
+        are written.
+
+        Args:
+            fname: Name of a file created with `create`.
+            slice_nums: Slice indices of the batch, in increasing order.
+            maps: Dictionary mapping keys to `(len(slice_nums), ...)` arrays.
+        """
+        hf = self.files[fname]
+        for key in self.keys:
+            data = np.asarray(maps[key], dtype=self.dtype)
+            if list(slice_nums) == list(range(slice_nums[0], slice_nums[0] + len(slice_nums))):
+                hf[f"reconstruction_{key}"][slice_nums[0]:slice_nums[0] + len(slice_nums)] = data
+            else:
+                for i, slice_num in enumerate(slice_nums):
+                    hf[f"reconstruction_{key}"][slice_num] = data[i]
+
+        self.written[fname][list(slice_nums)] = True
+        if self.written[fname].all():
+            hf.close()
+            self.partial_path(fname).replace(self.out_dir / fname)
+            del self.files[fname], self.written[fname]
+
+    def close(self):
+        # unfinished files keep their .partial name
+        for hf in self.files.values():
+            hf.close()
+        self.files = {}
+        self.written = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def convert_fnames_to_v2(path: Path):
     """
     Converts filenames to conform to `v2` standard for knee data.
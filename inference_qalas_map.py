@@ -10,6 +10,7 @@ import time
 import pathlib
 from collections import defaultdict
 from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 import fastmri
 import fastmri.data.transforms_qalas as T
@@ -17,14 +18,12 @@ import numpy as np
 import requests
 import torch
 import pytorch_lightning as pl
-from fastmri.data import SliceDatasetQALAS
+from fastmri.data import SequenceParams, SliceDatasetQALAS, collate_qalas
 from fastmri.models import QALAS_MAP
 from fastmri.pl_modules import QALAS_MAPModule
+from fastmri.qalas_dictionary import QALASDictionary
 from tqdm import tqdm
 
-import subprocess
-import os
-
 MODEL_FNAMES = {
     "varnet_knee_mc": "knee_leaderboard_state_dict.pt",
     "varnet_brain_mc": "brain_leaderboard_state_dict.pt",
@@ -32,49 +31,50 @@ MODEL_FNAMES = {
 
 
 def run_model(batch, model, device):
-    crop_size = batch.crop_size
-
-    #TODO Maksim's passing data_path into qalas_map.py
-#    str_to_pass = args.default_root_dir + '/val_data.h5'
-    str_to_pass = str(args.data_path) + '/val_data.h5'
-    os.environ["MESSAGE"] = str(str_to_pass)
-    subprocess.run(["python", "script2.py"])
+    crop_size = tuple(batch.crop_size[0].tolist())
 
-    output_t1, output_t2, output_pd, output_ie, output_b1, \
-        output_img1, output_img2, output_img3, output_img4, output_img5 = \
-            model(batch.masked_kspace_acq1.to(device), batch.masked_kspace_acq2.to(device), batch.masked_kspace_acq3.to(device), batch.masked_kspace_acq4.to(device), batch.masked_kspace_acq5.to(device), \
-                batch.mask_acq1, batch.mask_acq2, batch.mask_acq3, batch.mask_acq4, batch.mask_acq5, batch.mask_brain, \
-                batch.b1, batch.ie, \
-                batch.max_value_t1.to(device), batch.max_value_t2.to(device), batch.max_value_pd.to(device), batch.num_low_frequencies.to(device))
+    mask_brain = batch.mask_brain.to(device)
+    maps = model(batch.images.to(device), batch.b1, batch.max_value_t1.to(device), batch.max_value_t2.to(device), \
+                 mask_brain=mask_brain, return_images=False).maps
 
     # detect FLAIR 203
-    if output_t1.shape[-1] < crop_size[1]:
-        crop_size = (output_t1.shape[-1], output_t1.shape[-1])
+    if maps.shape[-1] < crop_size[1]:
+        crop_size = (maps.shape[-1], maps.shape[-1])
 
-    output_t1 = T.center_crop(output_t1, crop_size)[0]
-    output_t2 = T.center_crop(output_t2, crop_size)[0]
-    output_pd = T.center_crop(output_pd, crop_size)[0]
-    output_ie = T.center_crop(output_ie, crop_size)[0]
-    output_b1 = T.center_crop(output_b1, crop_size)[0]
+    maps = T.center_crop(maps, crop_size) * mask_brain.unsqueeze(1)
 
-    output_t1 = output_t1 * batch.mask_brain.to(device)
-    output_t2 = output_t2 * batch.mask_brain.to(device)
-    output_pd = output_pd * batch.mask_brain.to(device)
-    output_ie = output_ie * batch.mask_brain.to(device)
-    output_b1 = output_b1 * batch.mask_brain.to(device)
-
-    return output_t1, output_t2, output_pd, output_ie, output_b1, int(batch.slice_num[0]), batch.fname[0]
+    return maps, [int(slice_num) for slice_num in batch.slice_num], list(batch.fname)
 
 def load_model(
     module_class: pl.LightningModule,
     fname: pathlib.Path,
+    seq_params: Optional[SequenceParams] = None,
+    voxel_packed: bool = False,
 ):
     print(f"loading model from {fname}")
     checkpoint = torch.load(fname, map_location=torch.device("cpu"))
     # checkpoint = torch.load(fname, map_location=torch.device("cuda")) # TODO Maksim's change 1/2
 
+    return build_model(module_class, checkpoint, fname, seq_params, voxel_packed)
+
+def build_model(
+    module_class: pl.LightningModule,
+    checkpoint: Dict,
+    fname: pathlib.Path,
+    seq_params: Optional[SequenceParams] = None,
+    voxel_packed: bool = False,
+):
+    # Checkpoints trained before the sequence parameters were stored in the
+    #  hyperparameters need them from the data file
+    hparams = dict(checkpoint["hyper_parameters"])
+    if hparams.get("seq_params") is None:
+        if seq_params is None:
+            raise ValueError(f"{fname} has no sequence parameters, please provide them.")
+        hparams["seq_params"] = seq_params._asdict()
+    hparams["voxel_packed"] = voxel_packed
+
     # Initialise model with stored params
-    module = module_class(**checkpoint["hyper_parameters"])
+    module = module_class(**hparams)
 
     # Load stored weights: this will error if the keys don't match the model weights, which will happen
     #  when we are loading a VarNet instead of an AdaptiveVarNet or vice-versa.
@@ -82,52 +82,287 @@ def load_model(
 
     return module
 
-def run_inference(challenge, state_dict_file, data_path, output_path, device):
-    # model = QALAS_MAP()
+class QALASInferenceEngine:
+    """
+    In-process inference of the QALAS maps.
 
-    model = load_model(QALAS_MAPModule, state_dict_file)
+    The checkpoint is read once, and a model is built once per set of
+    sequence parameters. The volumes of a data directory are read once and
+    mapped in batches of slices, sized to fit `max_memory_gb` unless
+    `batch_size` is given. `run` writes the maps straight into preallocated
+    `(num_slices, W, H)` arrays, while `write` streams every batch to
+    compressed h5 files.
 
-    # model.load_state_dict(torch.load(state_dict_file))
-    model = model.eval()
+    Example:
+        engine = QALASInferenceEngine("epoch=99.ckpt")
+        engine.write("h5_data/sub01/multicoil_val", "h5_data/sub01")
+    """
 
-    # data loader setup
-    data_transform = T.QALASDataTransform()
-    dataset = SliceDatasetQALAS(
-        root=data_path, transform=data_transform, challenge="multicoil"
-    )
-    dataloader = torch.utils.data.DataLoader(dataset, num_workers=4)
+    def __init__(
+        self,
+        state_dict_file: Union[str, Path],
+        device: Union[str, torch.device] = "cpu",
+        seq_params: Optional[SequenceParams] = None,
+        batch_size: Optional[int] = None,
+        num_workers: int = 0,
+        voxel_packed: bool = False,
+        max_memory_gb: float = 2.0,
+    ):
+        """
+        Args:
+            state_dict_file: Path to the Lightning checkpoint of a
+                QALAS_MAPModule.
+            device: Device to run the model on.
+            seq_params: Optional; Sequence parameters for checkpoints that do
+                not store them. By default they are read from the data.
+            batch_size: Optional; Number of slices mapped at once. By default
+                it is derived from max_memory_gb.
+            num_workers: Number of DataLoader workers.
+            voxel_packed: Whether to compute the maps for brain voxels only.
+            max_memory_gb: Memory budget of the model activations for one
+                batch, in GB.
+        """
+        self.state_dict_file = Path(state_dict_file)
+        self.device = torch.device(device)
+        self.seq_params = seq_params
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.voxel_packed = voxel_packed
+        self.max_memory_gb = max_memory_gb
+        self.models: Dict[SequenceParams, pl.LightningModule] = {}
+
+        print(f"loading model from {self.state_dict_file}")
+        self.checkpoint = torch.load(self.state_dict_file, map_location=torch.device("cpu"))
+
+    def model(self, seq_params: Optional[SequenceParams] = None) -> pl.LightningModule:
+        """
+        The model for the given sequence parameters, built on first use.
+        """
+        stored = self.checkpoint["hyper_parameters"].get("seq_params")
+        if stored is not None:
+            seq_params = SequenceParams(**stored)
+        elif self.seq_params is not None:
+            seq_params = self.seq_params
+
+        if seq_params not in self.models:
+            module = build_model(QALAS_MAPModule, self.checkpoint, self.state_dict_file, seq_params, self.voxel_packed)
+            self.models[seq_params] = module.eval().to(self.device)
+
+        return self.models[seq_params]
+
+    def batches(self, data_path: Union[str, Path]) -> Iterator[Tuple[str, int, List[int], Dict[str, np.ndarray]]]:
+        """
+        Map all volumes in a data directory, one batch of slices at a time.
+
+        The volumes are preloaded one at a time, so that memory holds a
+        single volume besides the batches in flight.
+
+        Args:
+            data_path: Directory with the QALAS h5 files.
+
+        Yields:
+            The file name, its number of slices, the slice indices of the
+            batch and a dictionary mapping "t1", "t2", "pd", "ie" and "b1" to
+            `(len(slice_nums), W, H)` maps.
+        """
+        data_path = Path(data_path)
+        # volumes of a directory may come from different scanners
+        file_seq_params = {fname.name: SequenceParams.from_h5(fname) for fname in sorted(data_path.glob("*.h5"))}
+
+        dataset = SliceDatasetQALAS(root=data_path, transform=T.QALASDataTransform(), challenge="multicoil")
+        volume_indices = defaultdict(list)
+        for i, (fname, _, _) in enumerate(dataset.examples):
+            volume_indices[fname].append(i)
+
+        for fname, indices in volume_indices.items():
+            dataset.preload_volumes([fname])
+            kspace = dataset.volumes[fname]["kspace_acq1"]
+            model = self.model(file_seq_params[fname.name])
+
+            # batches of slices of the volume
+            slices_per_batch = self.slices_per_batch(model, kspace.shape[-2] * kspace.shape[-1])
+            batches = [indices[start:start + slices_per_batch] for start in range(0, len(indices), slices_per_batch)]
+            dataloader = torch.utils.data.DataLoader(
+                dataset, batch_sampler=batches, num_workers=self.num_workers, collate_fn=collate_qalas
+            )
+
+            for batch in tqdm(dataloader, desc=f"Running inference on {fname.name}"):
+                with torch.no_grad():
+                    output, slice_nums, fnames = run_model(batch, model, self.device)
+
+                maps = {
+                    key: output[:, i].transpose(-2, -1).cpu().numpy()
+                    for i, key in enumerate(("t1", "t2", "pd", "ie", "b1"))
+                }
+                yield fnames[0], kspace.shape[0], slice_nums, maps
+
+        dataset.preload_volumes([])
+
+    def run(self, data_path: Union[str, Path]) -> Dict[str, Dict[str, np.ndarray]]:
+        """
+        Map all volumes in a data directory into memory.
+
+        Args:
+            data_path: Directory with the QALAS h5 files.
+
+        Returns:
+            A dictionary mapping "t1", "t2", "pd", "ie" and "b1" to
+            dictionaries from file names to `(num_slices, W, H)` maps, as
+            expected by `fastmri.save_reconstructions_qalas`.
+        """
+        outputs: Dict[str, Dict[str, np.ndarray]] = {key: {} for key in ("t1", "t2", "pd", "ie", "b1")}
+        for fname, num_slices, slice_nums, maps in self.batches(data_path):
+            for key, output in maps.items():
+                if fname not in outputs[key]:
+                    outputs[key][fname] = np.zeros((num_slices,) + output.shape[1:], dtype=output.dtype)
+                outputs[key][fname][slice_nums] = output
+
+        return outputs
+
+    def write(
+        self,
+        data_path: Union[str, Path],
+        output_path: Union[str, Path],
+        compression: Optional[str] = "gzip",
+        float16: bool = False,
+    ) -> int:
+        """
+        Map all volumes in a data directory and stream the maps to
+        `output_path / "reconstructions"` as soon as a batch is computed.
+
+        Args:
+            data_path: Directory with the QALAS h5 files.
+            output_path: Output directory.
+            compression: Optional; "gzip", "lzf" or None.
+            float16: Whether to store the maps as float16.
+
+        Returns:
+            The number of mapped slices.
+        """
+        total = 0
+        with fastmri.ReconstructionWriterQALAS(
+            Path(output_path) / "reconstructions", compression=compression, float16=float16
+        ) as writer:
+            for fname, num_slices, slice_nums, maps in self.batches(data_path):
+                if fname not in writer.files:
+                    writer.create(fname, num_slices, maps["t1"].shape[1:])
+                writer.write(fname, slice_nums, maps)
+                total = total + len(slice_nums)
+
+        return total
+
+    def slices_per_batch(self, model: pl.LightningModule, image_size: int) -> int:
+        """
+        Number of slices of `image_size` voxels mapped at once.
 
-    # run the model
-    start_time = time.perf_counter()
-    outputs_t1 = defaultdict(list)
-    outputs_t2 = defaultdict(list)
-    outputs_pd = defaultdict(list)
-    outputs_ie = defaultdict(list)
-    outputs_b1 = defaultdict(list)
-    model = model.to(device)
+        The activations of the mapping CNN dominate: a few `maps_chans`-wide
+        feature maps are alive at once, plus the inputs, maps and masks.
+        """
+        if self.batch_size is not None:
+            return self.batch_size
 
-    for batch in tqdm(dataloader, desc="Running inference"):
-        with torch.no_grad():
-            output_t1, output_t2, output_pd, output_ie, output_b1, slice_num, fname = run_model(batch, model, device)
-        outputs_t1[fname].append((slice_num, np.transpose(np.squeeze(output_t1.cpu()),(1,0))))
-        outputs_t2[fname].append((slice_num, np.transpose(np.squeeze(output_t2.cpu()),(1,0))))
-        outputs_pd[fname].append((slice_num, np.transpose(np.squeeze(output_pd.cpu()),(1,0))))
-        outputs_ie[fname].append((slice_num, np.transpose(np.squeeze(output_ie.cpu()),(1,0))))
-        outputs_b1[fname].append((slice_num, np.transpose(np.squeeze(output_b1.cpu()),(1,0))))
+        bytes_per_slice = 4 * image_size * (3 * model.maps_chans + 32)
+        return max(1, int(self.max_memory_gb * 1024 ** 3 // bytes_per_slice))
 
-    # save outputs
-    for fname in outputs_t1:
-        outputs_t1[fname] = np.stack([out for _, out in sorted(outputs_t1[fname])])
-        outputs_t2[fname] = np.stack([out for _, out in sorted(outputs_t2[fname])])
-        outputs_pd[fname] = np.stack([out for _, out in sorted(outputs_pd[fname])])
-        outputs_ie[fname] = np.stack([out for _, out in sorted(outputs_ie[fname])])
-        outputs_b1[fname] = np.stack([out for _, out in sorted(outputs_b1[fname])])
+    def save(self, outputs: Dict[str, Dict[str, np.ndarray]], output_path: Union[str, Path]):
+        fastmri.save_reconstructions_qalas(outputs["t1"], outputs["t2"], outputs["pd"], outputs["ie"], outputs["b1"], \
+                                            Path(output_path) / "reconstructions")
 
-    fastmri.save_reconstructions_qalas(outputs_t1, outputs_t2, outputs_pd, outputs_ie, outputs_b1, output_path / "reconstructions")
+    def __call__(
+        self,
+        data_path: Union[str, Path],
+        output_path: Union[str, Path],
+        compression: Optional[str] = "gzip",
+        float16: bool = False,
+    ):
+        start_time = time.perf_counter()
+        num_slices = self.write(data_path, output_path, compression, float16)
+        end_time = time.perf_counter()
 
-    end_time = time.perf_counter()
+        print(f"Elapsed time for {num_slices} slices: {end_time-start_time}")
 
-    print(f"Elapsed time for {len(dataloader)} slices: {end_time-start_time}")
+
+class QALASDictionaryEngine(QALASInferenceEngine):
+    """
+    Inference of the QALAS maps by dictionary matching, without a trained
+    network.
+
+    The dictionary of every set of sequence parameters is read from (or
+    built into) `cache_dir`, and volumes are mapped and written like with
+    `QALASInferenceEngine`.
+
+    Example:
+        engine = QALASDictionaryEngine()
+        engine.write("h5_data/sub01/multicoil_val", "h5_data/sub01")
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[Union[str, Path]] = None,
+        device: Union[str, torch.device] = "cpu",
+        batch_size: Optional[int] = None,
+        num_workers: int = 0,
+        max_memory_gb: float = 2.0,
+    ):
+        """
+        Args:
+            cache_dir: Optional; Cache directory of the dictionaries.
+            device: Device to match on.
+            batch_size: Optional; Number of slices mapped at once. By default
+                it is derived from max_memory_gb.
+            num_workers: Number of DataLoader workers.
+            max_memory_gb: Memory budget of the images of one batch, in GB.
+        """
+        self.cache_dir = cache_dir
+        self.device = torch.device(device)
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.max_memory_gb = max_memory_gb
+        self.models: Dict[SequenceParams, QALASDictionary] = {}
+
+    def model(self, seq_params: Optional[SequenceParams] = None) -> QALASDictionary:
+        """
+        The dictionary for the given sequence parameters, built on first use.
+        """
+        if seq_params not in self.models:
+            self.models[seq_params] = QALASDictionary.cached(seq_params, self.cache_dir)
+
+        return self.models[seq_params]
+
+    def slices_per_batch(self, model: QALASDictionary, image_size: int) -> int:
+        """
+        Number of slices of `image_size` voxels mapped at once.
+
+        Matching works on chunks of voxels, so only the images, masks and
+        maps of the batch scale with the number of slices.
+        """
+        if self.batch_size is not None:
+            return self.batch_size
+
+        bytes_per_slice = 4 * image_size * 16
+        return max(1, int(self.max_memory_gb * 1024 ** 3 // bytes_per_slice))
+
+
+def run_inference(challenge, state_dict_file, data_path, output_path, device, voxel_packed=False, batch_size=None, num_workers=0, max_memory_gb=2.0, \
+                  compression="gzip", float16=False, dictionary=False, dictionary_cache=None):
+    if dictionary:
+        engine = QALASDictionaryEngine(
+            dictionary_cache,
+            device=device,
+            batch_size=batch_size,
+            num_workers=num_workers,
+            max_memory_gb=max_memory_gb,
+        )
+    else:
+        engine = QALASInferenceEngine(
+            state_dict_file,
+            device=device,
+            batch_size=batch_size,
+            num_workers=num_workers,
+            voxel_packed=voxel_packed,
+            max_memory_gb=max_memory_gb,
+        )
+    engine(data_path, output_path, compression, float16)
 
 
 if __name__ == "__main__":
@@ -164,6 +399,55 @@ if __name__ == "__main__":
         required=True,
         help="Path for saving reconstructions",
     )
+    parser.add_argument(
+        "--voxel_packed",
+        default=False,
+        action="store_true",
+        help="Compute the maps for brain voxels only",
+    )
+    parser.add_argument(
+        "--batch_size",
+        default=None,
+        type=int,
+        help="Number of slices mapped at once (default: derived from --max_memory_gb)",
+    )
+    parser.add_argument(
+        "--max_memory_gb",
+        default=2.0,
+        type=float,
+        help="Memory budget for the slices mapped at once, in GB",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=("gzip", "lzf", "none"),
+        default="gzip",
+        type=str,
+        help="Compression of the saved maps (lzf cannot be read by MATLAB)",
+    )
+    parser.add_argument(
+        "--float16",
+        default=False,
+        action="store_true",
+        help="Store the maps as float16 (needs a reader with half-precision support)",
+    )
+    parser.add_argument(
+        "--num_workers",
+        default=0,
+        type=int,
+        help="Number of workers to use in data loader",
+    )
+    parser.add_argument(
+        "--dictionary",
+        default=False,
+        action="store_true",
+        help="Map by dictionary matching instead of a trained network (no --state_dict_file)",
+    )
+    parser.add_argument(
+        "--dictionary_cache",
+        default=None,
+        type=Path,
+        help="Cache directory of the dictionaries (default: ~/.cache/qalas_dictionary)",
+    )
 
     args = parser.parse_args()
 
@@ -173,4 +457,12 @@ if __name__ == "__main__":
         args.data_path,
         args.output_path,
         torch.device(args.device),
+        args.voxel_packed,
+        args.batch_size,
+        args.num_workers,
+        args.max_memory_gb,
+        None if args.compression == "none" else args.compression,
+        args.float16,
+        args.dictionary,
+        args.dictionary_cache,
     )
@@ -17,7 +17,7 @@ import numpy as np
 import requests
 import torch
 import pytorch_lightning as pl
-from fastmri.data import SliceDatasetQALAS
+from fastmri.data import SliceDatasetQALAS, collate_qalas
 from fastmri.models import QALAS_MAP
 from fastmri.pl_modules import QALAS_MAPModule
 from tqdm import tqdm
@@ -29,30 +29,17 @@ MODEL_FNAMES = {
 
 
 def run_model(batch, model, device):
-    crop_size = batch.crop_size
+    crop_size = tuple(batch.crop_size[0].tolist())
 
-    output_t1, output_t2, output_pd, output_ie, output_b1, \
-        output_img1, output_img2, output_img3, output_img4, output_img5 = \
-            model(batch.masked_kspace_acq1.to(device), batch.masked_kspace_acq2.to(device), batch.masked_kspace_acq3.to(device), batch.masked_kspace_acq4.to(device), batch.masked_kspace_acq5.to(device), \
-                batch.mask_acq1, batch.mask_acq2, batch.mask_acq3, batch.mask_acq4, batch.mask_acq5, batch.mask_brain, \
-                batch.coil_sens, batch.b1, batch.ie, \
-                batch.max_value_t1.to(device), batch.max_value_t2.to(device), batch.max_value_pd.to(device), batch.num_low_frequencies.to(device))
+    output_imgs = model(batch.images.to(device), batch.b1, batch.max_value_t1.to(device), batch.max_value_t2.to(device), \
+                        mask_brain=batch.mask_brain.to(device)).images
 
     # detect FLAIR 203
-    if output_img1.shape[-1] < crop_size[1]:
-        crop_size = (output_img1.shape[-1], output_img1.shape[-1])
+    if output_imgs.shape[-1] < crop_size[1]:
+        crop_size = (output_imgs.shape[-1], output_imgs.shape[-1])
 
-    output_img1 = T.center_crop(output_img1, crop_size)[0]
-    output_img2 = T.center_crop(output_img2, crop_size)[0]
-    output_img3 = T.center_crop(output_img3, crop_size)[0]
-    output_img4 = T.center_crop(output_img4, crop_size)[0]
-    output_img5 = T.center_crop(output_img5, crop_size)[0]
-
-    output_img1 = output_img1 * batch.mask_brain.to(device)
-    output_img2 = output_img2 * batch.mask_brain.to(device)
-    output_img3 = output_img3 * batch.mask_brain.to(device)
-    output_img4 = output_img4 * batch.mask_brain.to(device)
-    output_img5 = output_img5 * batch.mask_brain.to(device)
+    output_imgs = T.center_crop(output_imgs, crop_size)[0] * batch.mask_brain.to(device)
+    output_img1, output_img2, output_img3, output_img4, output_img5 = output_imgs.split(1)
 
     return output_img1, output_img2, output_img3, output_img4, output_img5, int(batch.slice_num[0]), batch.fname[0]
 
@@ -86,7 +73,7 @@ def run_inference(challenge, state_dict_file, data_path, output_path, device):
     dataset = SliceDatasetQALAS(
         root=data_path, transform=data_transform, challenge="multicoil"
     )
-    dataloader = torch.utils.data.DataLoader(dataset, num_workers=4)
+    dataloader = torch.utils.data.DataLoader(dataset, num_workers=4, collate_fn=collate_qalas)
 
     # run the model
     start_time = time.perf_counter()
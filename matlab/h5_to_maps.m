@@ -11,11 +11,19 @@ sub_ses_run_ = strrep(sub_ses_run, '/', '_');
 
 display(sub_ses_run)
 
-T1 = h5read(['h5_data/',strrep(sub_ses_run, '-', ''),'/reconstructions/val_data.h5'],'/reconstruction_t1');
-T2 = h5read(['h5_data/',strrep(sub_ses_run, '-', ''),'/reconstructions/val_data.h5'],'/reconstruction_t2');
-PD = h5read(['h5_data/',strrep(sub_ses_run, '-', ''),'/reconstructions/val_data.h5'],'/reconstruction_pd');
-IE = h5read(['h5_data/',strrep(sub_ses_run, '-', ''),'/reconstructions/val_data.h5'],'/reconstruction_ie');
-manufacturer = h5readatt(['h5_data/',strrep(sub_ses_run, '-', ''),'/multicoil_val/val_data.h5'], '/', 'scan_manufacturer');
+% maps of the training file (--train_as_val), or of its validation copy
+file_recon = ['h5_data/',strrep(sub_ses_run, '-', ''),'/reconstructions/train_data.h5'];
+file_data = ['h5_data/',strrep(sub_ses_run, '-', ''),'/multicoil_train/train_data.h5'];
+if ~isfile(file_recon)
+    file_recon = ['h5_data/',strrep(sub_ses_run, '-', ''),'/reconstructions/val_data.h5'];
+    file_data = ['h5_data/',strrep(sub_ses_run, '-', ''),'/multicoil_val/val_data.h5'];
+end
+
+T1 = h5read(file_recon,'/reconstruction_t1');
+T2 = h5read(file_recon,'/reconstruction_t2');
+PD = h5read(file_recon,'/reconstruction_pd');
+IE = h5read(file_recon,'/reconstruction_ie');
+manufacturer = h5readatt(file_data, '/', 'scan_manufacturer');
 
 info_NIFTI = niftiinfo([dir_bids, '/', sub_ses, '/anat/', f_QALAS]);
 
@@ -20,8 +20,16 @@ savepath = [dir_tool, '/matlab/h5_data/', strrep(sub_ses_run, '-', ''), '/multic
 savename = 'train_data.h5';
 savepath_val = [dir_tool, '/matlab/h5_data/', strrep(sub_ses_run, '-', ''), '/multicoil_val/'];
 savename_val = 'val_data.h5';
+%% Provide info on the validation copy
+
+write_val_copy      = 0;
+% 1 (write multicoil_val/val_data.h5, a copy of the training file, for a separate validation loop)
+% 0 (no copy > train with --train_as_val and map multicoil_train)
+
 mkdir(savepath)
-mkdir(savepath_val)
+if write_val_copy == 1
+    mkdir(savepath_val)
+end
 mkdir([savepath, '/../multicoil_test'])
 mkdir([savepath, '/../reconstructions'])
 
@@ -245,6 +253,23 @@ h5write(file_name, '/mask_acq5', mask(:,1));
 h5create(file_name,'/mask_brain',[Ny,Nx,Nz],'Datatype','single');
 h5write(file_name, '/mask_brain', single(bmask));
 
+% Tag the datasets that hold a single value, so that the data loader does not
+% read them (see find_constant_datasets in fastmri/data/mri_data_qalas.py)
+if compare_ref_map == 0
+    h5writeatt(file_name,'/reconstruction_t1','constant_value',5);
+    h5writeatt(file_name,'/reconstruction_t2','constant_value',2.5);
+    h5writeatt(file_name,'/reconstruction_pd','constant_value',1);
+    h5writeatt(file_name,'/reconstruction_ie','constant_value',1);
+end
+if load_b1_map == 0
+    h5writeatt(file_name,'/reconstruction_b1','constant_value',1);
+end
+if all(mask(:) == 1)
+    for i = 1:5
+        h5writeatt(file_name,['/mask_acq', num2str(i)],'constant_value',1);
+    end
+end
+
 att_norm_t1 = norm(T1_map(:));
 att_max_t1  = max(T1_map(:));
 att_norm_t2 = norm(T2_map(:));
@@ -379,7 +404,9 @@ dset.writexml(xmlstring);
 
 % Write the dataset
 dset.close();
-copyfile(file_name, file_name_val)
+if write_val_copy == 1
+    copyfile(file_name, file_name_val)
+end
 
 toc
 
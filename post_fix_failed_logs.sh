@@ -38,7 +38,9 @@ while read p; do sub_ses=$(echo $p)   # Read a line from the session list and st
                  sub_ses_run=${sub_ses}'/'$(echo $f_QALAS | grep -o 'run-[1-9]')  # Combine sub/ses with run number
 
                  # === If corresponding HDF5 reconstruction exists ===
-                 if [[ -e $dir_tool/matlab/h5_data/${sub_ses_run//-/}/reconstructions/val_data.h5 ]]; then
+                 # (train_data.h5 with --train_as_val, val_data.h5 otherwise)
+                 dir_recon=$dir_tool/matlab/h5_data/${sub_ses_run//-/}/reconstructions
+                 if [[ -e $dir_recon/train_data.h5 || -e $dir_recon/val_data.h5 ]]; then
                     # MATLAB processing command (currently commented out)
                     echo $f_QALAS   # Just print file name
 
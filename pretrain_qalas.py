@@ -0,0 +1,241 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import pathlib
+import time
+from argparse import ArgumentParser
+
+import pytorch_lightning as pl
+import torch
+from fastmri.data import SequenceParams, SyntheticSliceDatasetQALAS, generate_corpus_qalas
+from fastmri.pl_modules import QALASPretrainModule, update_run_summary
+from fastmri.qalas_dictionary import write_dictionary_corpus
+
+
+def generate(args):
+    seq_params = SequenceParams.from_h5(args.seq_params_file)
+    generate_corpus_qalas(
+        args.corpus_path,
+        seq_params,
+        num_slices=args.num_slices,
+        slice_size=args.slice_size,
+        chunk_slices=args.chunk_slices,
+        max_t1=args.max_value_t1,
+        max_t2=args.max_value_t2,
+        noise_level=args.noise_level,
+        num_workers=args.num_workers,
+        compression=None if args.compression == "none" else args.compression,
+        seed=args.seed,
+    )
+
+
+def dictionary(args):
+    write_dictionary_corpus(
+        args.data_file,
+        args.corpus_path,
+        cache_dir=args.dictionary_cache,
+        compression=None if args.compression == "none" else args.compression,
+    )
+
+
+def pretrain(args):
+    pl.seed_everything(args.seed)
+
+    # ------------
+    # data
+    # ------------
+    # the last pseudo-slices of the corpus are held out for validation
+    corpus = SyntheticSliceDatasetQALAS(args.corpus_path)
+    num_val = max(1, int(len(corpus) * args.val_fraction))
+    train_dataset = SyntheticSliceDatasetQALAS(args.corpus_path, stop=len(corpus) - num_val)
+    val_dataset = SyntheticSliceDatasetQALAS(args.corpus_path, start=len(corpus) - num_val)
+    train_loader = torch.utils.data.DataLoader(
+        train_dataset, batch_size=args.batch_size, num_workers=args.num_workers or 0, shuffle=True
+    )
+    val_loader = torch.utils.data.DataLoader(
+        val_dataset, batch_size=args.batch_size, num_workers=args.num_workers or 0
+    )
+
+    # ------------
+    # model
+    # ------------
+    model = QALASPretrainModule(
+        maps_chans=args.maps_chans,
+        maps_layers=args.maps_layers,
+        lr=args.lr,
+        lr_step_size=args.lr_step_size,
+        lr_gamma=args.lr_gamma,
+        weight_decay=args.weight_decay,
+        seq_params=corpus.seq_params._asdict(),
+        max_value_t1=corpus.max_t1,
+        max_value_t2=corpus.max_t2,
+    )
+
+    # ------------
+    # trainer
+    # ------------
+    trainer = pl.Trainer.from_argparse_args(args, accelerator="cpu", log_every_n_steps=1)
+    start_time = time.perf_counter()
+    trainer.fit(model, train_loader, val_loader)
+
+    if trainer.is_global_zero:
+        update_run_summary(
+            args.default_root_dir / "run_summary.json",
+            {
+                "pretrain": True,
+                "corpus_path": str(args.corpus_path),
+                "epochs": trainer.current_epoch + 1,
+                "train_time_s": time.perf_counter() - start_time,
+            },
+        )
+
+
+def build_args():
+    parser = ArgumentParser()
+
+    # client arguments
+    parser.add_argument(
+        "--mode",
+        default="train",
+        choices=("generate", "dictionary", "train"),
+        type=str,
+        help="Generate the synthetic corpus, write a corpus of dictionary maps of a session, "
+        "or pretrain the mapping network on a corpus",
+    )
+    parser.add_argument(
+        "--corpus_path",
+        type=pathlib.Path,
+        required=True,
+        help="Path to the synthetic corpus (.h5)",
+    )
+    parser.add_argument(
+        "--num_workers",
+        default=None,
+        type=int,
+        help="Number of processes for generation, or of data loading workers",
+    )
+
+    # corpus config
+    parser.add_argument(
+        "--seq_params_file",
+        type=pathlib.Path,
+        help="QALAS h5 file of the vendor protocol to simulate",
+    )
+    parser.add_argument(
+        "--data_file",
+        type=pathlib.Path,
+        help="QALAS h5 file of the session to match with the dictionary",
+    )
+    parser.add_argument(
+        "--dictionary_cache",
+        default=None,
+        type=pathlib.Path,
+        help="Cache directory of the dictionaries (default: ~/.cache/qalas_dictionary)",
+    )
+    parser.add_argument(
+        "--num_slices",
+        default=2048,
+        type=int,
+        help="Number of pseudo-slices in the corpus",
+    )
+    parser.add_argument(
+        "--slice_size",
+        default=64,
+        type=int,
+        help="Size of a pseudo-slice",
+    )
+    parser.add_argument(
+        "--chunk_slices",
+        default=32,
+        type=int,
+        help="Number of pseudo-slices simulated per task",
+    )
+    parser.add_argument(
+        "--noise_level",
+        default=0.01,
+        type=float,
+        help="Noise standard deviation relative to the maximum signal",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=("gzip", "lzf", "none"),
+        default="none",
+        type=str,
+        help="Compression of the corpus",
+    )
+
+    # training config
+    parser.add_argument(
+        "--batch_size",
+        default=16,
+        type=int,
+        help="Number of pseudo-slices per batch",
+    )
+    parser.add_argument(
+        "--val_fraction",
+        default=0.05,
+        type=float,
+        help="Fraction of the corpus held out for validation",
+    )
+
+    # module config
+    parser = QALASPretrainModule.add_model_specific_args(parser)
+    parser.set_defaults(
+        maps_chans=64,  # number of channels for mapping est. CNN (defalut: 64)
+        maps_layers=5,  # number of layers for mapping est. CNN (default: 5)
+        lr=0.001,  # Adam learning rate (default: 0.001)
+    )
+
+    # trainer config
+    parser = pl.Trainer.add_argparse_args(parser)
+    parser.set_defaults(
+        seed=42,  # random seed
+        deterministic=True,  # makes things slower, but deterministic
+        default_root_dir=pathlib.Path("qalas_pretrain_log"),  # directory for logs and checkpoints
+        max_epochs=50,  # max number of epochs
+    )
+
+    args = parser.parse_args()
+    args.default_root_dir = pathlib.Path(args.default_root_dir)
+
+    if args.mode == "generate" and args.seq_params_file is None:
+        parser.error("--seq_params_file is required to generate a corpus")
+    if args.mode == "dictionary" and args.data_file is None:
+        parser.error("--data_file is required to write a dictionary corpus")
+
+    if args.mode == "train":
+        # configure checkpointing in checkpoint_dir
+        checkpoint_dir = args.default_root_dir / "checkpoints"
+        if not checkpoint_dir.exists():
+            checkpoint_dir.mkdir(parents=True)
+
+        args.callbacks = [
+            pl.callbacks.ModelCheckpoint(
+                dirpath=checkpoint_dir,
+                save_top_k=True,
+                verbose=True,
+                monitor="validation_loss",
+                mode="min",
+            )
+        ]
+
+    return args
+
+
+def run_cli():
+    args = build_args()
+
+    if args.mode == "generate":
+        generate(args)
+    elif args.mode == "dictionary":
+        dictionary(args)
+    else:
+        pretrain(args)
+
+
+if __name__ == "__main__":
+    run_cli()
@@ -46,7 +46,7 @@ if [ -e qalas_log/$sub_ses_run/checkpoints/epoch*.ckpt ]; then
 
     echo "CHECKPOINT FOUND, RESUMING PROCESSING"
     ls -lrt qalas_log/$sub_ses_run/checkpoints/epoch*.ckpt
-    python train_qalas.py --data_path matlab/h5_data/${sub_ses_run//-/} --check_val_every_n_epoch 4 --default_root_dir qalas_log/$sub_ses_run --use_dataset_cache_file False --resume_from_checkpoint qalas_log/$sub_ses_run/checkpoints/epoch*.ckpt
+    python train_qalas.py --data_path matlab/h5_data/${sub_ses_run//-/} --check_val_every_n_epoch 4 --train_as_val --default_root_dir qalas_log/$sub_ses_run --use_dataset_cache_file False --resume_from_checkpoint qalas_log/$sub_ses_run/checkpoints/epoch*.ckpt
     echo "PROCESSING WAS MADE STARTING FROM A CHECKPOINT"
     ls -lrt qalas_log/$sub_ses_run/checkpoints/epoch*.ckpt
 
@@ -59,12 +59,12 @@ else
     cd -
 
     # Train the model
-    python train_qalas.py --data_path matlab/h5_data/${sub_ses_run//-/} --check_val_every_n_epoch 4 --default_root_dir qalas_log/$sub_ses_run --use_dataset_cache_file False
+    python train_qalas.py --data_path matlab/h5_data/${sub_ses_run//-/} --check_val_every_n_epoch 4 --train_as_val --default_root_dir qalas_log/$sub_ses_run --use_dataset_cache_file False
 
 fi
 
 # === Produce maps ===
-python inference_qalas_map.py --data_path matlab/h5_data/${sub_ses_run//-/}/multicoil_val --state_dict_file qalas_log/$sub_ses_run/checkpoints/epoch*.ckpt --output_path matlab/h5_data/${sub_ses_run//-/}
+python inference_qalas_map.py --data_path matlab/h5_data/${sub_ses_run//-/}/multicoil_train --state_dict_file qalas_log/$sub_ses_run/checkpoints/epoch*.ckpt --output_path matlab/h5_data/${sub_ses_run//-/}
 
 # === Move the last checkpoint ===
 mkdir qalas_log/$sub_ses_run/checkpoints/old/
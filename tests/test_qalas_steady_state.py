@@ -0,0 +1,67 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import json
+
+import pytest
+import torch
+
+from fastmri.data.sequence_params_qalas import SequenceParams
+from fastmri.models.qalas_map import QALASBlock
+
+# (Manufacturer, EchoTrainLength, RepetitionTime) of the BIDS sidecars
+VENDORS = [
+    ("Siemens", 128, 0.0057),
+    ("Philips", 120, 0.0061),
+    ("GE", 128, 0.0056),
+]
+
+
+def vendor_seq_params(tmp_path, manufacturer, echo_train_length, repetition_time):
+    fname = tmp_path / "qalas.json"
+    with open(fname, "w") as f:
+        json.dump(
+            {
+                "Manufacturer": manufacturer,
+                "EchoTrainLength": echo_train_length,
+                "RepetitionTime": repetition_time,
+            },
+            f,
+        )
+
+    return SequenceParams.from_bids_json(fname)
+
+
+def random_maps(shape, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+
+    def uniform(low, high):
+        return low + (high - low) * torch.rand(shape, generator=generator, dtype=torch.float64)
+
+    x_t1 = uniform(0.2, 4.0)
+    x_t2 = uniform(0.01, 2.0)
+    x_pd = uniform(0.1, 1.0)
+    x_ie = uniform(0.6, 1.0)
+    x_b1 = uniform(0.6, 1.4)
+
+    return x_t1, x_t2, x_pd, x_ie, x_b1
+
+
+@pytest.mark.parametrize("manufacturer, echo_train_length, repetition_time", VENDORS)
+def test_closed_form_matches_iterative(tmp_path, manufacturer, echo_train_length, repetition_time):
+    seq_params = vendor_seq_params(tmp_path, manufacturer, echo_train_length, repetition_time)
+    x_t1, x_t2, x_pd, x_ie, x_b1 = random_maps((2, 1, 16, 16))
+
+    closed_form = QALASBlock(seq_params, steady_state="closed_form")
+    iterative = QALASBlock(seq_params, steady_state="iterative")
+
+    expected = iterative.qalas_forward_eq(x_t1, x_t2, x_pd, x_ie, x_b1)
+    actual = closed_form.qalas_forward_eq(x_t1, x_t2, x_pd, x_ie, x_b1)
+
+    assert len(actual) == len(expected) == 5
+    for acq_actual, acq_expected in zip(actual, expected):
+        torch.testing.assert_close(acq_actual, acq_expected)
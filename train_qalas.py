@@ -7,25 +7,30 @@ LICENSE file in the root directory of this source tree.
 
 import os
 import pathlib
+import time
 from argparse import ArgumentParser
 
 import pytorch_lightning as pl
+from pytorch_lightning.plugins import DDPSpawnPlugin
+from fastmri.data import SequenceParams, find_sessions_qalas, session_name_qalas
 from fastmri.data.mri_data import fetch_dir
 from fastmri.data.subsample import create_mask_for_mask_type
 from fastmri.data.transforms_qalas import QALASDataTransform
-from fastmri.pl_modules import FastMriDataModuleQALAS, QALAS_MAPModule
+from fastmri.models import QALASLookupTable
+from fastmri.pl_modules import (
+    ConvergenceStoppingQALAS,
+    FastMriDataModuleQALAS,
+    QALAS_MAPModule,
+    find_warm_start_checkpoint,
+    load_maps_net,
+    split_grouped_checkpoint,
+    update_run_summary,
+)
 
 import torch.multiprocessing
 torch.multiprocessing.set_sharing_strategy('file_system')
 
-import subprocess
-
-def cli_main(args):
-    pl.seed_everything(args.seed)
-
-    # ------------
-    # data
-    # ------------
+def build_data_module(args, data_path=None, sessions=None, grouped=False):
     # this creates a k-space mask for transforming input data
     if args.mask_type == 'qalas':
         mask = create_mask_for_mask_type(
@@ -46,8 +51,8 @@ def cli_main(args):
     val_transform = QALASDataTransform()
     test_transform = QALASDataTransform()
     # ptl data module - this handles data loaders
-    data_module = FastMriDataModuleQALAS(
-        data_path=args.data_path,
+    return FastMriDataModuleQALAS(
+        data_path=args.data_path if data_path is None else data_path,
         challenge=args.challenge,
         train_transform=train_transform,
         val_transform=val_transform,
@@ -58,18 +63,14 @@ def cli_main(args):
         batch_size=args.batch_size,
         num_workers=args.num_workers,
         distributed_sampler=(args.accelerator in ("ddp", "ddp_cpu")),
+        preload=args.preload,
+        sessions=sessions,
+        grouped=grouped,
     )
 
-    # ------------
-    # model
-    # ------------
 
-    #TODO Maksim's passing data_path into qalas_map.py
-    str_to_pass = str(args.data_path) + '/multicoil_train/train_data.h5'
-    os.environ["MESSAGE"] = str_to_pass
-#    subprocess.run(["python", "script2.py"])
-    
-    model = QALAS_MAPModule(
+def build_model(args, seq_params, num_models=1):
+    return QALAS_MAPModule(
         num_cascades=args.num_cascades,
         pools=args.pools,
         chans=args.chans,
@@ -79,25 +80,318 @@ def cli_main(args):
         lr_step_size=args.lr_step_size,
         lr_gamma=args.lr_gamma,
         weight_decay=args.weight_decay,
+        seq_params=seq_params._asdict(),
+        steady_state=args.steady_state,
+        forward_model=args.forward_model,
+        voxel_packed=args.voxel_packed,
+        num_models=num_models,
+        b1_cache_size=args.b1_cache_size,
+        train_as_val=args.train_as_val,
+        max_change_volumes=args.max_change_volumes,
     )
 
+
+def build_callbacks(args, default_root_dir):
+    # configure checkpointing in checkpoint_dir
+    checkpoint_dir = default_root_dir / "checkpoints"
+    if not checkpoint_dir.exists():
+        checkpoint_dir.mkdir(parents=True)
+
+    callbacks = [
+        pl.callbacks.ModelCheckpoint(
+            dirpath=checkpoint_dir,
+            save_top_k=True,
+            verbose=True,
+            monitor="validation_loss",
+            mode="min",
+            # with --train_as_val, validation_loss is logged at the end of
+            # the training epoch
+            save_on_train_epoch_end=True if args.train_as_val else None,
+            every_n_epochs=args.check_val_every_n_epoch if args.train_as_val else None,
+        )
+    ]
+    if args.convergence_stopping:
+        callbacks.append(
+            ConvergenceStoppingQALAS(
+                train_loss_tol=args.train_loss_tol,
+                val_loss_tol=args.val_loss_tol,
+                map_change_tol=args.map_change_tol,
+                smoothing=args.loss_smoothing,
+                patience=args.convergence_patience,
+                min_epochs=args.convergence_min_epochs,
+                summary_file=default_root_dir / "run_summary.json",
+            )
+        )
+
+    return callbacks
+
+
+class DDPSpawnPluginQALAS(DDPSpawnPlugin):
+    def post_dispatch(self):
+        super().post_dispatch()
+
+        # the spawned processes hand their last weights over in a
+        # .tmp_end.ckpt file next to the checkpoints: remove it, so that the
+        # checkpoint directory only holds the checkpoint (see submit_CPU.sh)
+        checkpoint_callback = self.lightning_module.trainer.checkpoint_callback
+        if checkpoint_callback is not None and checkpoint_callback.dirpath is not None:
+            for fname in pathlib.Path(checkpoint_callback.dirpath).glob("*.tmp_end.ckpt"):
+                fname.unlink()
+
+
+def build_trainer(args, **kwargs):
+    # CPU training, in one process or, with --accelerator ddp_cpu, in
+    # --num_processes processes synchronized over gloo: the train slices are
+    # sharded over the processes and whole volumes go to each process for
+    # validation (see FastMriDataModuleQALAS). With --train_as_val, the
+    # validation metrics come from the training steps and the val split is
+    # not read
+    if args.train_as_val:
+        kwargs.setdefault("limit_val_batches", 0)
+    if args.accelerator == "ddp_cpu":
+        # the processes share the CPUs of the job
+        cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        os.environ.setdefault("OMP_NUM_THREADS", str(max(1, cpus // args.num_processes)))
+        return pl.Trainer.from_argparse_args(
+            args,
+            accelerator="ddp_cpu",
+            plugins=[DDPSpawnPluginQALAS(find_unused_parameters=False)],
+            log_every_n_steps=1,
+            **kwargs,
+        )
+
+    return pl.Trainer.from_argparse_args(args, accelerator="cpu", log_every_n_steps=1, **kwargs)
+
+
+def cli_main(args):
+    pl.seed_everything(args.seed)
+
+    # ------------
+    # data
+    # ------------
+    data_module = build_data_module(args)
+
+    # ------------
+    # model
+    # ------------
+
+    # sequence parameters are read once and saved with the checkpoint
+    seq_params = SequenceParams.from_h5(args.data_path / f"{args.challenge}_train" / "train_data.h5")
+
+    model = build_model(args, seq_params)
+
+    # warm start the mapping network from a previous run with the same
+    # scanner and protocol, and fine-tune it with a shorter schedule
+    init_from = args.init_from
+    if init_from is None and args.init_library is not None and args.mode == "train":
+        init_from = find_warm_start_checkpoint(
+            args.init_library,
+            seq_params,
+            maps_chans=args.maps_chans,
+            maps_layers=args.maps_layers,
+        )
+        if init_from is None:
+            print(f"No checkpoint in {args.init_library} matches, training from scratch")
+    warm_start = None
+    if init_from is not None:
+        warm_start = load_maps_net(model, init_from)
+        print(f"Warm start from {init_from}")
+        if args.warm_start_epochs is not None:
+            args.max_epochs = args.warm_start_epochs
+
+    # error of the lookup-table forward model against the analytic model
+    forward_model_error = None
+    if args.forward_model == "lookup":
+        forward_model_error = QALASLookupTable.cached(seq_params).approximation_error()
+        print(f"Lookup-table forward model relative error: {forward_model_error}")
+
     # ------------
     # trainer
     # ------------
     #trainer = pl.Trainer.from_argparse_args(args, gpus=[0], log_every_n_steps=1) # TODO MAKSIM'S CHANGE 1/2
-    trainer = pl.Trainer.from_argparse_args(args, accelerator="cpu", log_every_n_steps=1)
+    trainer = build_trainer(args)
 
     # ------------
     # run
     # ------------
     if args.mode == "train":
+        start_time = time.perf_counter()
         trainer.fit(model, datamodule=data_module)
+        train_time = time.perf_counter() - start_time
+
+        if trainer.is_global_zero:
+            epochs = trainer.current_epoch + 1
+            summary = {"epochs": epochs, "train_time_s": train_time}
+            if forward_model_error is not None:
+                summary["forward_model_error"] = forward_model_error
+            if warm_start is not None:
+                if warm_start["reference_epochs"] is not None:
+                    warm_start["epochs_speedup"] = warm_start["reference_epochs"] / epochs
+                if warm_start["reference_train_time_s"] is not None:
+                    warm_start["time_speedup"] = warm_start["reference_train_time_s"] / train_time
+                summary["warm_start"] = warm_start
+            update_run_summary(args.default_root_dir / "run_summary.json", summary)
     elif args.mode == "test":
         trainer.test(model, datamodule=data_module)
     else:
         raise ValueError(f"unrecognized mode {args.mode}")
 
 
+def cli_joint(args):
+    pl.seed_everything(args.seed)
+    sessions = find_sessions_qalas(args.data_path, args.challenge, args.sessions_file)
+    print(f"Joint training on {len(sessions)} sessions")
+
+    # ------------
+    # joint training
+    # ------------
+    # one model for all sessions: every sample carries the sequence
+    # parameters of its file, the model ones are only a default
+    data_module = build_data_module(args, sessions=sessions)
+    model = build_model(args, SequenceParams.from_h5(sessions[0] / f"{args.challenge}_train" / "train_data.h5"))
+    if args.init_from is not None:
+        load_maps_net(model, args.init_from)
+        print(f"Warm start from {args.init_from}")
+
+    trainer = build_trainer(args)
+    start_time = time.perf_counter()
+    trainer.fit(model, datamodule=data_module)
+    train_time = time.perf_counter() - start_time
+
+    joint_checkpoint = args.callbacks[0].best_model_path
+    if trainer.is_global_zero:
+        update_run_summary(
+            args.default_root_dir / "run_summary.json",
+            {
+                "joint": True,
+                "sessions": [str(session) for session in sessions],
+                "epochs": trainer.current_epoch + 1,
+                "train_time_s": train_time,
+            },
+        )
+
+    # ------------
+    # per-session fine-tuning
+    # ------------
+    # short runs warm started from the joint model, logged in
+    # <default_root_dir>/<session> (see session_name_qalas)
+    checkpoints = {session: joint_checkpoint for session in sessions}
+    if args.finetune_epochs > 0:
+        for session in sessions:
+            session_root = args.default_root_dir / session_name_qalas(session, args.data_path)
+            seq_params = SequenceParams.from_h5(session / f"{args.challenge}_train" / "train_data.h5")
+            model = build_model(args, seq_params)
+            warm_start = load_maps_net(model, joint_checkpoint)
+
+            callbacks = build_callbacks(args, session_root)
+            trainer = build_trainer(
+                args,
+                default_root_dir=session_root,
+                max_epochs=args.finetune_epochs,
+                callbacks=callbacks,
+                resume_from_checkpoint=None,
+            )
+            start_time = time.perf_counter()
+            trainer.fit(model, datamodule=build_data_module(args, data_path=session))
+            checkpoints[session] = callbacks[0].best_model_path
+
+            if trainer.is_global_zero:
+                update_run_summary(
+                    session_root / "run_summary.json",
+                    {
+                        "epochs": trainer.current_epoch + 1,
+                        "train_time_s": time.perf_counter() - start_time,
+                        "warm_start": warm_start,
+                    },
+                )
+
+    # ------------
+    # inference
+    # ------------
+    if args.joint_inference and trainer.is_global_zero:
+        map_sessions(args, sessions, checkpoints)
+
+
+def cli_grouped(args):
+    pl.seed_everything(args.seed)
+    sessions = find_sessions_qalas(args.data_path, args.challenge, args.sessions_file)
+    print(f"Grouped training of {len(sessions)} models")
+
+    # ------------
+    # grouped training
+    # ------------
+    # one mapping network per session, trained side by side as one grouped
+    # CNN on batches holding the same number of slices of every session
+    seq_params = [
+        SequenceParams.from_h5(session / f"{args.challenge}_train" / "train_data.h5")
+        for session in sessions
+    ]
+    data_module = build_data_module(args, sessions=sessions, grouped=True)
+    model = build_model(args, seq_params[0], num_models=len(sessions))
+    if args.init_from is not None:
+        load_maps_net(model, args.init_from)
+        print(f"Warm start from {args.init_from}")
+
+    trainer = build_trainer(args)
+    start_time = time.perf_counter()
+    trainer.fit(model, datamodule=data_module)
+    train_time = time.perf_counter() - start_time
+
+    if not trainer.is_global_zero:
+        return
+
+    # ------------
+    # per-session checkpoints
+    # ------------
+    # independent checkpoints in <default_root_dir>/<session>/checkpoints
+    # (see session_name_qalas), from the epoch with the best validation loss
+    # over all sessions
+    grouped_checkpoint = args.callbacks[0].best_model_path
+    checkpoints = split_grouped_checkpoint(
+        grouped_checkpoint,
+        [args.default_root_dir / session_name_qalas(session, args.data_path) / "checkpoints" for session in sessions],
+        seq_params,
+    )
+    epochs = trainer.current_epoch + 1
+    update_run_summary(
+        args.default_root_dir / "run_summary.json",
+        {
+            "grouped": True,
+            "sessions": [str(session) for session in sessions],
+            "epochs": epochs,
+            "train_time_s": train_time,
+        },
+    )
+    for session in sessions:
+        update_run_summary(
+            args.default_root_dir / session_name_qalas(session, args.data_path) / "run_summary.json",
+            {"epochs": epochs, "train_time_s": train_time, "grouped_checkpoint": grouped_checkpoint},
+        )
+
+    # ------------
+    # inference
+    # ------------
+    if args.joint_inference:
+        map_sessions(args, sessions, dict(zip(sessions, checkpoints)))
+
+
+def map_sessions(args, sessions, checkpoints):
+    # maps of the val split of every session (of the train split with
+    # --train_as_val, the val split being a copy of it), written next to its
+    # data like inference_qalas_map.py; engines are shared by the sessions of
+    # a model
+    from inference_qalas_map import QALASInferenceEngine
+
+    engines = {}
+    for session in sessions:
+        if checkpoints[session] not in engines:
+            engines[checkpoints[session]] = QALASInferenceEngine(
+                checkpoints[session], voxel_packed=args.voxel_packed
+            )
+        split = "train" if args.train_as_val else "val"
+        engines[checkpoints[session]].write(session / f"{args.challenge}_{split}", session)
+
+
 def build_args():
     parser = ArgumentParser()
 
@@ -168,6 +462,61 @@ def build_args():
         weight_decay=0.0,  # weight regularization strength
     )
 
+    # warm start config
+    parser.add_argument(
+        "--init_from",
+        default=None,
+        type=pathlib.Path,
+        help="Checkpoint to initialize the mapping network from",
+    )
+    parser.add_argument(
+        "--init_library",
+        default=None,
+        type=pathlib.Path,
+        help="Directory of checkpoints to pick --init_from from, by manufacturer and sequence parameters",
+    )
+    parser.add_argument(
+        "--warm_start_epochs",
+        default=None,
+        type=int,
+        help="Number of epochs when warm starting, replaces --max_epochs (default: keep --max_epochs)",
+    )
+
+    # multi-session config
+    parser.add_argument(
+        "--joint",
+        default=False,
+        action="store_true",
+        help="Train one model on all sessions under --data_path (one subdirectory per session)",
+    )
+    parser.add_argument(
+        "--grouped",
+        default=False,
+        action="store_true",
+        help="Train one independent model per session under --data_path side by side in one process",
+    )
+    parser.add_argument(
+        "--sessions_file",
+        default=None,
+        type=pathlib.Path,
+        help="Text file listing the sessions of --joint or --grouped, one directory per line (default: all sessions)",
+    )
+    parser.add_argument(
+        "--finetune_epochs",
+        default=0,
+        type=int,
+        help="Number of epochs of per-session fine-tuning after --joint training (0: none)",
+    )
+    parser.add_argument(
+        "--joint_inference",
+        default=False,
+        action="store_true",
+        help="Map the val split (train split with --train_as_val) of every session after --joint or --grouped training",
+    )
+
+    # early stopping config
+    parser = ConvergenceStoppingQALAS.add_callback_specific_args(parser)
+
     # trainer config
     parser = pl.Trainer.add_argparse_args(parser)
     parser.set_defaults(
@@ -184,20 +533,21 @@ def build_args():
     path_update = args.default_root_dir
     args.default_root_dir=pathlib.Path(path_update) # TODO Maksim's addition to turn str into path
 
-    # configure checkpointing in checkpoint_dir
-    checkpoint_dir = args.default_root_dir / "checkpoints"
-    if not checkpoint_dir.exists():
-        checkpoint_dir.mkdir(parents=True)
+    if args.joint and args.preload:
+        parser.error("--joint reads the sessions slice by slice, --preload is not supported")
+    if args.grouped:
+        if args.joint:
+            parser.error("--joint and --grouped are exclusive")
+        if args.preload:
+            parser.error("--grouped reads the sessions slice by slice, --preload is not supported")
+        if args.accelerator in ("ddp", "ddp_cpu") or args.voxel_packed:
+            parser.error("--grouped does not support ddp or --voxel_packed")
+    if args.train_as_val and args.accelerator in ("ddp", "ddp_cpu"):
+        # every rank sees a shard of the train split, so the volume metrics
+        # would be averages over partial volumes
+        parser.error("--train_as_val does not support ddp")
 
-    args.callbacks = [
-        pl.callbacks.ModelCheckpoint(
-            dirpath=args.default_root_dir / "checkpoints",
-            save_top_k=True,
-            verbose=True,
-            monitor="validation_loss",
-            mode="min",
-        )
-    ]
+    args.callbacks = build_callbacks(args, args.default_root_dir)
 
     # set default checkpoint if one exists in our checkpoint directory
 
@@ -215,7 +565,12 @@ def run_cli():
     # ---------------------
     # RUN TRAINING
     # ---------------------
-    cli_main(args)
+    if args.joint:
+        cli_joint(args)
+    elif args.grouped:
+        cli_grouped(args)
+    else:
+        cli_main(args)
 
 
 if __name__ == "__main__":